@@ -0,0 +1,78 @@
+"""
+Codec Benchmark
+
+Compares JSON and MessagePack for shopcart payloads of growing size: the
+payload size, the time of the codec alone (dumps, loads) and the time of a
+whole encode (Shopcart.serialize() and dumps) and decode (loads and
+Shopcart.deserialize()).
+
+Usage:
+  python -m benchmarks.bench_codecs --items 1 10 100 1000
+"""
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+
+def parse_args(argv=None):
+    """Reads the benchmark settings from the command line"""
+    parser = argparse.ArgumentParser(description="Compare JSON and MessagePack shopcart payloads")
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 100, 1000], help="items per shopcart")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best one is reported")
+    parser.add_argument("--seed", type=int, default=2820, help="random seed for the data")
+    return parser.parse_args(argv)
+
+
+def best_time_us(function, repeat):
+    """Returns the best time of one call in microseconds"""
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def main(argv=None):
+    """Runs the benchmark and prints a row per shopcart size and codec"""
+    args = parse_args(argv)
+    # the codecs need no database, keep the service from connecting to one
+    os.environ.setdefault("DATABASE_URI", "sqlite://")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    # pylint: disable=import-outside-toplevel
+    import factory.random
+    from service import app
+    from service.common import media
+    from service.models import Shopcart
+    from tests.factories import ShopcartFactory, ItemFactory
+
+    app.logger.setLevel(logging.CRITICAL)
+    factory.random.reseed_random(args.seed)
+
+    results = {}
+    print(
+        f"{'items':>6} {'codec':<8} {'bytes':>9} {'dumps us':>10} {'loads us':>10} {'encode us':>10} {'decode us':>10}"
+    )
+    for count in args.items:
+        shopcart = ShopcartFactory(items=[])
+        shopcart.items.extend(ItemFactory.build_batch(count, shopcart=None, shopcart_id=shopcart.id))
+        for name, media_type in (("json", media.JSON), ("msgpack", media.MSGPACK)):
+            body = shopcart.serialize()
+            payload = media.dumps(body, media_type)
+            # the lambdas are timed before the loop moves on, so they see this iteration's values
+            # pylint: disable=cell-var-from-loop
+            dumps = best_time_us(lambda: media.dumps(body, media_type), args.repeat)
+            loads = best_time_us(lambda: media.loads(payload, media_type), args.repeat)
+            encode = best_time_us(lambda: media.dumps(shopcart.serialize(), media_type), args.repeat)
+            decode = best_time_us(lambda: Shopcart().deserialize(media.loads(payload, media_type)), args.repeat)
+            # pylint: enable=cell-var-from-loop
+            results[(count, name)] = {
+                "bytes": len(payload), "dumps_us": dumps, "loads_us": loads, "encode_us": encode, "decode_us": decode
+            }
+            print(
+                f"{count:>6} {name:<8} {len(payload):>9} {dumps:>10.1f} {loads:>10.1f} {encode:>10.1f} {decode:>10.1f}"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
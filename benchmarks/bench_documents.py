@@ -0,0 +1,107 @@
+"""
+Cart Document Benchmark
+
+Compares the two ways GET /shopcarts/{id} can read a shopcart for carts of
+growing size: "rows" loads the shopcart and its items and serializes them,
+"document" fetches the document CART_DOCUMENTS keeps in sync and sends its
+bytes as they are. For each mode it reports the time of one GET, the SQL
+statements it sends, and the time of the write that keeps the document
+in sync (one item count update), since document mode moves the work there.
+Like bench_routes it drives the routes in-process with Flask's test client,
+without gunicorn or HTTP, and only drops the tables of a database that is
+not SQLite when --destroy is given.
+
+Usage:
+  python -m benchmarks.bench_documents --items 1 10 100 1000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import timeit
+from benchmarks.bench_routes import check_database
+
+
+def parse_args(argv=None):
+    """Reads the benchmark settings from the command line"""
+    parser = argparse.ArgumentParser(description="Compare row and document reads of shopcarts")
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 100, 1000], help="items per shopcart")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best one is reported")
+    parser.add_argument("--seed", type=int, default=2820, help="random seed for the data")
+    parser.add_argument(
+        "--database-uri",
+        default=os.getenv("BENCH_DATABASE_URI"),
+        help="database to benchmark against (default: a temporary SQLite file)",
+    )
+    parser.add_argument(
+        "--destroy",
+        action="store_true",
+        help="allow dropping the tables of a database that is not SQLite",
+    )
+    return parser.parse_args(argv)
+
+
+def best_time_us(function, repeat):
+    """Returns the best time of one call in microseconds"""
+    number, _ = timeit.Timer(function).autorange()
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def main(argv=None):
+    """Runs the benchmark and prints a row per shopcart size and mode"""
+    args = parse_args(argv)
+    check_database(args.database_uri, args.destroy)
+    workdir = tempfile.mkdtemp(prefix="shopcart-bench-")
+    # the service reads its configuration at import time
+    os.environ["DATABASE_URI"] = args.database_uri or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    # pylint: disable=import-outside-toplevel
+    import factory.random
+    from sqlalchemy import event
+    from service import app
+    from service.models import Item, Shopcart, db
+    from tests.factories import ItemFactory
+    from benchmarks.bench_routes import StatementCounter
+
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    factory.random.reseed_random(args.seed)
+    db.drop_all()
+    db.create_all()
+    client = app.test_client()
+    counter = StatementCounter()
+    event.listen(db.engine, "before_cursor_execute", counter)
+
+    def update_count(item_id):
+        item = Item.find(item_id)
+        item.count += 1
+        item.update()
+
+    results = {}
+    print(f"{'items':>6} {'mode':<9} {'bytes':>9} {'get us':>10} {'sql/get':>8} {'write us':>10}")
+    for count in args.items:
+        Shopcart.DOCUMENTS = True
+        shopcart = Shopcart(customer_id=count)
+        shopcart.items.extend(ItemFactory.build_batch(count, shopcart=None))
+        shopcart.create()
+        url = f"/shopcarts/{shopcart.id}"
+        item_id = shopcart.items[0].id
+        db.session.remove()
+        for mode in ("rows", "document"):
+            Shopcart.DOCUMENTS = mode == "document"
+            payload = client.get(url).data
+            counter.reset()
+            client.get(url)
+            statements = counter.count
+            get = best_time_us(lambda: client.get(url), args.repeat)  # pylint: disable=cell-var-from-loop
+            write = best_time_us(lambda: update_count(item_id), args.repeat)  # pylint: disable=cell-var-from-loop
+            results[(count, mode)] = {"bytes": len(payload), "get_us": get, "statements": statements, "write_us": write}
+            print(f"{count:>6} {mode:<9} {len(payload):>9} {get:>10.1f} {statements:>8} {write:>10.1f}")
+    event.remove(db.engine, "before_cursor_execute", counter)
+    return results
+
+
+if __name__ == "__main__":
+    main()
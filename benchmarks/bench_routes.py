@@ -0,0 +1,331 @@
+"""
+Benchmark Suite for the Shopcart REST API
+
+Seeds shopcarts and items with the test factories, drives every route in
+service/routes.py but the /admin ones from a pool of client threads and reports req/s, latency
+percentiles and SQL statements per request. Results are saved as JSON so that
+two commits can be compared.
+
+The routes are called in-process through Flask's test client, not over HTTP
+through gunicorn, so the numbers leave out the server stack: sockets,
+keep-alive, worker and thread scheduling (gunicorn.conf.py) and the cost of
+sending compressed responses. Use them to compare the application code of
+two commits, not as the capacity of a deployment.
+
+Seeding drops and creates every table of the database it runs against, so a
+--database-uri that is not SQLite also needs --destroy.
+
+Usage:
+  python -m benchmarks.bench_routes --carts 200 --items 5 --requests 500 --concurrency 8
+  python -m benchmarks.bench_routes --compare benchmarks/results/<old>.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args(argv=None):
+    """Reads the benchmark settings from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmark the shopcart REST API")
+    parser.add_argument("--carts", type=int, default=100, help="shopcarts to seed")
+    parser.add_argument("--items", type=int, default=5, help="items seeded per shopcart")
+    parser.add_argument("--requests", type=int, default=200, help="requests sent per route")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--seed", type=int, default=2820, help="random seed for the data and requests")
+    parser.add_argument(
+        "--database-uri",
+        default=os.getenv("BENCH_DATABASE_URI"),
+        help="database to benchmark against (default: a temporary SQLite file)",
+    )
+    parser.add_argument(
+        "--destroy",
+        action="store_true",
+        help="allow dropping the tables of a database that is not SQLite",
+    )
+    parser.add_argument("--routes", nargs="*", help="only run these routes")
+    parser.add_argument("--output", help="JSON file for the results (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def check_database(database_uri, destroy):
+    """Refuses to seed a database that is not SQLite unless --destroy was given"""
+    if database_uri and not database_uri.startswith("sqlite") and not destroy:
+        sys.exit(
+            f"Refusing to drop the tables of {database_uri.split('@')[-1]}: "
+            "benchmarks reseed the database, pass --destroy if it holds nothing you need"
+        )
+
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def git_commit():
+    """Returns the short hash of the checked out commit"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+######################################################################
+#  S Q L   S T A T E M E N T   C O U N T E R
+######################################################################
+class StatementCounter:
+    """Counts the SQL statements sent through an engine"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        """Starts counting from zero"""
+        with self._lock:
+            self.count = 0
+
+
+######################################################################
+#  R O U T E   S C E N A R I O S
+######################################################################
+def build_scenarios(fixture):
+    """
+    Returns a function per route that sends one request
+
+    Each function takes the request number and a random generator and
+    returns the response of the Flask test client. The update and delete
+    scenarios also time the GET or POST that prepares them.
+    """
+    # pylint: disable=import-outside-toplevel
+    from tests.factories import ShopcartFactory, ItemFactory
+
+    carts = fixture["carts"]
+    items = fixture["items"]
+    products = fixture["products"]
+
+    def cart_for(rng):
+        return rng.choice(carts)
+
+    def item_for(rng):
+        return rng.choice(items)
+
+    def new_item(client, cart_id, rng):
+        item = ItemFactory(shopcart_id=cart_id, shopcart=None, product_id=rng.randint(1000, 10**6))
+        return client.post(f"/shopcarts/{cart_id}/items", json=item.serialize())
+
+    def new_cart(client):
+        return client.post("/shopcarts", json=ShopcartFactory().serialize())
+
+    return {
+        "index": lambda client, n, rng: client.get("/"),
+        "list_all_shopcarts": lambda client, n, rng: client.get("/shopcarts"),
+        "get_many_shopcarts": lambda client, n, rng: client.get(
+            "/shopcarts?ids=" + ",".join(str(cart_for(rng)) for _ in range(20))
+        ),
+        "get_shopcarts": lambda client, n, rng: client.get(f"/shopcarts/{cart_for(rng)}"),
+        "list_all_items": lambda client, n, rng: client.get(f"/shopcarts/{cart_for(rng)}/items"),
+        "get_items": lambda client, n, rng: _get_item(client, *item_for(rng)),
+        "create_shopcart": lambda client, n, rng: new_cart(client),
+        "create_item": lambda client, n, rng: new_item(client, cart_for(rng), rng),
+        "update_shopcarts": lambda client, n, rng: _update_shopcart(client, cart_for(rng)),
+        "update_items": lambda client, n, rng: _update_item(client, *item_for(rng)),
+        "delete_items": lambda client, n, rng: _delete_item(client, new_item(client, cart_for(rng), rng)),
+        "delete_shopcarts": lambda client, n, rng: _delete_shopcart(client, new_cart(client)),
+        "list_changes": lambda client, n, rng: client.get("/shopcarts/changes?limit=100"),
+        "sync_items": lambda client, n, rng: client.get(f"/shopcarts/{cart_for(rng)}/items?since=0"),
+        "list_items_by_product": lambda client, n, rng: client.get(
+            f"/items?product_id={rng.choice(products)}&limit=100"
+        ),
+        "reprice_product": lambda client, n, rng: client.put(
+            f"/products/{rng.choice(products)}/price", json={"price": round(rng.uniform(1, 100), 2)}
+        ),
+        "health_live": lambda client, n, rng: client.get("/health/live"),
+        "health_ready": lambda client, n, rng: client.get("/health/ready"),
+    }
+
+
+def _get_item(client, cart_id, item_id):
+    """Sends a GET for an item"""
+    return client.get(f"/shopcarts/{cart_id}/items/{item_id}")
+
+
+def _update_shopcart(client, cart_id):
+    """Sends a PUT for a shopcart with its current body"""
+    body = client.get(f"/shopcarts/{cart_id}").get_json()
+    body["items"] = []
+    return client.put(f"/shopcarts/{cart_id}", json=body)
+
+
+def _update_item(client, cart_id, item_id):
+    """Sends a PUT for an item with its current body"""
+    body = client.get(f"/shopcarts/{cart_id}/items/{item_id}").get_json()
+    body["count"] += 1
+    return client.put(f"/shopcarts/{cart_id}/items/{item_id}", json=body)
+
+
+def _delete_item(client, created):
+    """Deletes an item created for the benchmark"""
+    item = created.get_json()
+    return client.delete(f"/shopcarts/{item['shopcart_id']}/items/{item['id']}")
+
+
+def _delete_shopcart(client, created):
+    """Deletes a shopcart created for the benchmark"""
+    return client.delete(f"/shopcarts/{created.get_json()['id']}")
+
+
+######################################################################
+#  B E N C H M A R K   R U N N E R
+######################################################################
+def seed(carts, items_per_cart):
+    """Creates the shopcarts and items the routes read"""
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+    from tests.factories import ShopcartFactory, ItemFactory
+
+    db.drop_all()
+    db.create_all()
+    fixture = {"carts": [], "items": [], "products": list(range(1, items_per_cart + 1))}
+    for _ in range(carts):
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        fixture["carts"].append(shopcart.id)
+        for product_id in range(1, items_per_cart + 1):
+            item = ItemFactory(shopcart=shopcart, product_id=product_id)
+            item.create()
+            fixture["items"].append((shopcart.id, item.id))
+    db.session.remove()
+    return fixture
+
+
+def run_route(app, send, requests, concurrency, rng_seed, counter):
+    """Sends the requests of one route and measures them"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(start):
+        client = app.test_client()
+        rng = random.Random(rng_seed + start)
+        for number in range(start, requests, concurrency):
+            began = time.perf_counter()
+            response = send(client, number, rng)
+            elapsed = time.perf_counter() - began
+            with lock:
+                latencies.append(elapsed * 1000)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+    counter.reset()
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    duration = time.perf_counter() - began
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "duration_s": round(duration, 4),
+        "req_per_s": round(len(latencies) / duration, 2) if duration else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "queries_per_request": round(counter.count / len(latencies), 2) if latencies else 0.0,
+    }
+
+
+def compare(results, baseline):
+    """Prints the change of every metric against an earlier run"""
+    print(f"\nCompared with {baseline.get('commit', 'baseline')}:")
+    for route, metrics in results["routes"].items():
+        old = baseline.get("routes", {}).get(route)
+        if not old:
+            continue
+        changes = []
+        for name in ("req_per_s", "p95_ms", "queries_per_request"):
+            if old[name]:
+                changes.append(f"{name} {100.0 * (metrics[name] - old[name]) / old[name]:+.1f}%")
+        print(f"  {route:<22} " + ", ".join(changes))
+
+
+def main(argv=None):
+    """Runs the benchmark suite"""
+    args = parse_args(argv)
+    check_database(args.database_uri, args.destroy)
+    workdir = tempfile.mkdtemp(prefix="shopcart-bench-")
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # the service reads its configuration at import time
+    os.environ["DATABASE_URI"] = database_uri
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    # pylint: disable=import-outside-toplevel
+    import factory.random
+    from sqlalchemy import event
+    from service import app
+    from service.models import db
+
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    factory.random.reseed_random(args.seed)
+    fixture = seed(args.carts, args.items)
+
+    counter = StatementCounter()
+    event.listen(db.engine, "before_cursor_execute", counter)
+    scenarios = build_scenarios(fixture)
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "carts": args.carts,
+            "items_per_cart": args.items,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "database": db.engine.url.render_as_string(hide_password=True),
+        },
+        "routes": {},
+    }
+    print(f"{'route':<22} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8} {'errors':>6}")
+    for route, send in scenarios.items():
+        if args.routes and route not in args.routes:
+            continue
+        metrics = run_route(app, send, args.requests, args.concurrency, args.seed, counter)
+        results["routes"][route] = metrics
+        print(
+            f"{route:<22} {metrics['req_per_s']:>9.1f} {metrics['p50_ms']:>8.2f} {metrics['p95_ms']:>8.2f}"
+            f" {metrics['p99_ms']:>8.2f} {metrics['queries_per_request']:>8.2f} {metrics['errors']:>6}"
+        )
+    event.remove(db.engine, "before_cursor_execute", counter)
+
+    output = args.output or os.path.join("benchmarks", "results", f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            compare(results, json.load(baseline_file))
+    return results
+
+
+if __name__ == "__main__":
+    main()
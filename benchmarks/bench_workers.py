@@ -0,0 +1,111 @@
+"""
+Gunicorn Worker Benchmark
+
+Starts gunicorn the way the Procfile used to (no config file) and with
+gunicorn.conf.py, with the same number of workers, and reports how long it
+took until every worker was up and serving, and the memory of each worker:
+RSS, PSS (shared pages split between the processes sharing them) and USS
+(pages only that worker holds). Linux only, it reads /proc.
+
+Usage:
+  python -m benchmarks.bench_workers --workers 4
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+
+def parse_args(argv=None):
+    """Reads the benchmark settings from the command line"""
+    parser = argparse.ArgumentParser(description="Compare gunicorn worker startup and memory")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=8089, help="port to bind")
+    parser.add_argument(
+        "--database-uri",
+        default=os.getenv("BENCH_DATABASE_URI"),
+        help="database the service connects to (default: a temporary SQLite file)",
+    )
+    return parser.parse_args(argv)
+
+
+def children(pid):
+    """Returns the pids of the child processes of pid"""
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as children_file:
+        return [int(child) for child in children_file.read().split()]
+
+
+def memory(pid):
+    """Returns the RSS, PSS and USS of a process in MiB"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup", encoding="utf-8") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    uss = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return {name: round(kb / 1024, 1) for name, kb in (("rss", fields["Rss"]), ("pss", fields["Pss"]), ("uss", uss))}
+
+
+def serving(port):
+    """True when the service answers on port"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def run(name, config, args, env):
+    """Starts gunicorn with a config file and measures it"""
+    command = [sys.executable, "-m", "gunicorn", "--config", config, "--bind", f"127.0.0.1:{args.port}", "service:app"]
+    started = time.perf_counter()
+    master = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while len(children(master.pid)) < args.workers or not serving(args.port):
+            if master.poll() is not None:
+                raise SystemExit(f"{name}: gunicorn exited with {master.returncode}")
+            time.sleep(0.02)
+        startup = time.perf_counter() - started
+        time.sleep(0.5)  # let the workers settle
+        workers = [memory(pid) for pid in children(master.pid)]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+    result = {"startup_s": round(startup, 2)}
+    for key in ("rss", "pss", "uss"):
+        result[f"worker_{key}_mib"] = round(sum(worker[key] for worker in workers) / len(workers), 1)
+    return result
+
+
+def main(argv=None):
+    """Runs both configurations and prints them side by side"""
+    args = parse_args(argv)
+    directory = tempfile.mkdtemp(prefix="shopcart-bench-")
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    env = dict(os.environ, DATABASE_URI=database_uri, GUNICORN_WORKERS=str(args.workers))
+    # gunicorn reads ./gunicorn.conf.py unless told otherwise, so give the
+    # old setup an empty config with just the Procfile's worker count
+    defaults = os.path.join(directory, "defaults.conf.py")
+    with open(defaults, "w", encoding="utf-8") as config_file:
+        config_file.write(f"workers = {args.workers}\n")
+
+    results = {
+        "procfile defaults": run("procfile defaults", defaults, args, env),
+        "gunicorn.conf.py": run("gunicorn.conf.py", "gunicorn.conf.py", args, env),
+    }
+    print(f"{'setup':20} {'startup s':>10} {'RSS MiB':>9} {'PSS MiB':>9} {'USS MiB':>9}   (per worker)")
+    for name, result in results.items():
+        print(
+            f"{name:20} {result['startup_s']:>10} {result['worker_rss_mib']:>9} "
+            f"{result['worker_pss_mib']:>9} {result['worker_uss_mib']:>9}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
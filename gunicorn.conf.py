@@ -0,0 +1,55 @@
+"""
+Gunicorn Configuration
+
+Loaded by gunicorn from the working directory (see Procfile). The app is
+imported once in the master and shared copy-on-write by the forked workers,
+so every setting here can be overridden with an environment variable.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# Import the app in the master before forking. Workers then share the
+# imported modules instead of each importing the whole app again.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# The service waits on the database far more than it computes, so run a
+# couple of threads in each of the usual 2 * CPU + 1 workers.
+#
+# A long-poll or event stream of GET /shopcarts/changes holds a thread for up
+# to CHANGES_MAX_WAIT seconds, so a few of them tie up a gthread worker and
+# one ties up a sync worker (GUNICORN_THREADS=1). A sync worker is also killed
+# once a request outlives timeout, which is why service/config.py keeps
+# CHANGES_MAX_WAIT 5 seconds under GUNICORN_TIMEOUT. For many change feed
+# clients set GUNICORN_WORKER_CLASS=gevent (pip install gevent) and
+# GUNICORN_PRELOAD=false, so that gevent patches the standard library before
+# the app is imported; a waiting request then costs a greenlet, not a thread.
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread" if threads > 1 else "sync")
+
+# Keep client connections open between requests behind the load balancer,
+# and recycle workers now and then without restarting all of them at once
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Gives a worker its own database connections and background threads"""
+    if not preload_app:
+        return
+    from service import app, models, routes  # pylint: disable=import-outside-toplevel
+
+    # the pools still hold the master's connections: forget them without
+    # closing them, so that the master and the other workers keep theirs
+    with app.app_context():
+        for engine in [models.db.engine] + models.shards.engines:
+            engine.dispose(close=False)
+    # threads do not survive fork
+    if routes.increments.running:
+        routes.increments.after_fork()
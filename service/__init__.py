@@ -5,17 +5,23 @@ This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
 import sys
+import atexit
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from service import config
-from service.common import log_handlers
+from service.common import compression, load_shedding, log_handlers, profiling, rate_limit, slow_queries, tracing
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object(config)
+if app.config["TRUSTED_PROXIES"]:
+    # take the client address from the hop the nearest trusted proxy saw
+    trusted = app.config["TRUSTED_PROXIES"]
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted, x_proto=trusted, x_host=trusted)
 
 # Dependencies require we import the routes AFTER the Flask app is created
 # pylint: disable=wrong-import-position, wrong-import-order
-from service import routes, models  # noqa: E402, E261
+from service import routes, models, repository  # noqa: E402, E261
 # pylint: disable=wrong-import-position
 from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
@@ -33,4 +39,33 @@ except Exception as error:  # pylint: disable=broad-except
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
+profiling.init_profiling(app, [models.db.engine] + models.shards.engines)
+tracing.init_tracing(app, [models.db.engine] + models.shards.engines, routes.traces)
+slow_queries.init_slow_query_log(app, [models.db.engine] + models.shards.engines, routes.slow_queries)
+compression.init_compression(app)
+load_shedding.init_load_shedding(app, [models.db.engine] + models.shards.engines, routes.shedder)
+
+routes.repository = repository.repository_for(app.config["STORAGE_BACKEND"])
+
+memory = app.config["STORAGE_BACKEND"] == "memory"
+routes.health.engines = [] if memory else [models.db.engine] + models.shards.engines
+routes.health.ttl = app.config["HEALTH_CHECK_TTL"]
+routes.health.max_saturation = app.config["HEALTH_MAX_POOL_SATURATION"]
+routes.health.timeout = app.config["HEALTH_CHECK_TIMEOUT"]
+
+routes.last_known.size = app.config["STALE_CACHE_SIZE"]
+routes.last_known.max_age = app.config["STALE_MAX_AGE"]
+
+routes.limiter.store = rate_limit.store_for(app.config["RATE_LIMIT_STORAGE"])
+routes.limiter.overrides = rate_limit.parse_limits(app.config["RATE_LIMITS"])
+
+if app.config["WRITE_BEHIND"] and not routes.repository.supports("write_behind"):
+    app.logger.warning("WRITE_BEHIND needs STORAGE_BACKEND=sql, count increments are written directly")
+elif app.config["WRITE_BEHIND"]:
+    routes.increments.interval = app.config["WRITE_BEHIND_INTERVAL"]
+    routes.increments.max_pending = app.config["WRITE_BEHIND_MAX_PENDING"]
+    routes.increments.start(app)
+    # write whatever is still buffered when the worker shuts down
+    atexit.register(routes.increments.stop)
+
 app.logger.info("Service initialized!")
@@ -0,0 +1,123 @@
+"""
+Circuit Breaker
+
+Stops sending work to a database that keeps failing. After
+failure_threshold consecutive connection failures the breaker opens and
+every checkout fails at once with CircuitOpenError instead of waiting for a
+connect timeout. Once reset_timeout seconds have passed it lets a single
+probe through (half-open): a statement that succeeds closes it again, a
+failure opens it for another reset_timeout.
+
+The breaker watches engines rather than wrapping model methods: checkouts
+are guarded by wrapping engine.raw_connection, and statement outcomes come
+from the engine's cursor and error events. Only errors that mean the
+database cannot be reached count as failures, not a bad statement.
+"""
+import threading
+import time
+from sqlalchemy import event, exc
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of using a database while its circuit breaker is open"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The database is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def is_outage(error) -> bool:
+    """True for errors that mean the database cannot be reached"""
+    if isinstance(error, exc.DBAPIError):
+        return error.connection_invalidated or isinstance(error, (exc.OperationalError, exc.InterfaceError))
+    return isinstance(error, (exc.TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    """Fails database work fast after repeated outages and probes for recovery"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError unless this call may use the database"""
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            now = self.clock()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probe_at = now
+                return
+            if self.state == HALF_OPEN and now - self._probe_at >= self.reset_timeout:
+                # the last probe never reported back, send another one
+                self._probe_at = now
+                return
+            if self.state == CLOSED:
+                return
+            raise CircuitOpenError(max(1.0, self.reset_timeout - (now - self._opened_at)))
+
+    def success(self):
+        """Records a call that reached the database"""
+        if self.state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+
+    def failure(self):
+        """Records a call that could not reach the database"""
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = self.clock()
+
+    def reset(self):
+        """Closes the breaker"""
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+
+    def stats(self) -> dict:
+        """Returns the state of the breaker"""
+        return {"state": self.state, "failures": self._failures}
+
+    def watch(self, engine):
+        """Guards the checkouts of an engine and follows the outcome of its statements"""
+        if event.contains(engine, "handle_error", self._handle_error):
+            return
+        raw_connection = engine.raw_connection
+
+        def guarded_raw_connection():
+            self.before_call()
+            try:
+                return raw_connection()
+            except Exception as error:
+                # a failed connect raises the bare DBAPI error, which _handle_error
+                # counts, so this only sees the pool's own timeouts
+                if is_outage(error):
+                    self.failure()
+                raise
+        engine.raw_connection = guarded_raw_connection
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    # pylint: disable-next=too-many-arguments
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.success()
+
+    def _handle_error(self, context):
+        if context.is_disconnect or is_outage(context.sqlalchemy_exception):
+            self.failure()
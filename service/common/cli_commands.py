@@ -1,8 +1,10 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime, timedelta
 from service import app
-from service.models import db
+from service import storage
+from service.models import db, IdempotencyKey, CartChange, ItemTombstone
 
 
 ######################################################################
@@ -19,3 +21,69 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to purge expired idempotency keys
+# Usage:
+#   flask idempotency-cleanup
+######################################################################
+@app.cli.command("idempotency-cleanup")
+def idempotency_cleanup():
+    """
+    Deletes the stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL
+    """
+    IdempotencyKey.remove_expired(app.config["IDEMPOTENCY_KEY_TTL"])
+
+
+######################################################################
+# Command to purge old cart changes from the outbox
+# Usage:
+#   flask changes-cleanup
+######################################################################
+@app.cli.command("changes-cleanup")
+def changes_cleanup():
+    """
+    Deletes the cart changes older than CHANGES_RETENTION
+    """
+    CartChange.remove_older_than(app.config["CHANGES_RETENTION"])
+
+
+######################################################################
+# Command to purge old item tombstones
+# Usage:
+#   flask tombstones-cleanup
+######################################################################
+@app.cli.command("tombstones-cleanup")
+def tombstones_cleanup():
+    """
+    Deletes the item tombstones older than TOMBSTONE_RETENTION
+    """
+    ItemTombstone.remove_older_than(app.config["TOMBSTONE_RETENTION"])
+
+
+######################################################################
+# Command to archive inactive shopcarts
+# Usage:
+#   flask carts-archive
+######################################################################
+@app.cli.command("carts-archive")
+def carts_archive():
+    """
+    Moves the shopcarts unchanged for ARCHIVE_AFTER_DAYS to the archive tables
+    """
+    cutoff = datetime.utcnow() - timedelta(days=app.config["ARCHIVE_AFTER_DAYS"])
+    storage.archive_inactive(cutoff, app.config["ARCHIVE_CHUNK_SIZE"])
+
+
+######################################################################
+# Command to write the documents of shopcarts that have none
+# Usage:
+#   flask carts-documents
+######################################################################
+@app.cli.command("carts-documents")
+def carts_documents():
+    """
+    Writes the CART_DOCUMENTS documents of the shopcarts stored before it was on
+    """
+    storage.build_documents()
@@ -0,0 +1,97 @@
+"""
+Response Compression
+
+Compresses response bodies with brotli (when the brotli package is
+installed) or gzip, picked from the request's Accept-Encoding header. Bodies
+smaller than COMPRESSION_MIN_SIZE bytes are sent as they are, because
+compressing them costs more CPU than the bytes it saves, and so are
+responses without a body (204 and 304).
+
+Streamed responses (the change feed's event stream) are compressed chunk by
+chunk and flushed after every chunk, so an event still reaches the client
+as soon as it is sent.
+"""
+import zlib
+from flask import request
+
+try:
+    import brotli  # pylint: disable=import-error
+except ImportError:  # brotli is optional
+    brotli = None
+
+NO_BODY_STATUSES = (204, 304)
+
+
+def choose_encoding(accept_encodings, brotli_available: bool = brotli is not None):
+    """Returns the best encoding the client accepts, or None"""
+    candidates = ["br", "gzip"] if brotli_available else ["gzip"]
+    best, best_quality = None, 0
+    for encoding in candidates:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _Compressor:
+    """Compresses one body, in one piece or chunk by chunk"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._stream = brotli.Compressor(quality=brotli_quality)
+            self._compress, self._flush, self._finish = self._stream.process, self._stream.flush, self._stream.finish
+        else:
+            self._stream = zlib.compressobj(gzip_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            self._compress = self._stream.compress
+            self._flush = lambda: self._stream.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._stream.flush
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a whole body"""
+        return self._compress(data) + self._finish()
+
+    def stream(self, chunks):
+        """Compresses an iterable of chunks, flushing after each one"""
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield self._compress(chunk) + self._flush()
+        yield self._finish()
+
+
+def init_compression(app):
+    """Registers the compression hook when COMPRESSION is turned on"""
+    if not app.config.get("COMPRESSION", True):
+        return
+    min_size = app.config.get("COMPRESSION_MIN_SIZE", 1024)
+    gzip_level = app.config.get("COMPRESSION_LEVEL", 6)
+    brotli_quality = app.config.get("COMPRESSION_BROTLI_QUALITY", 4)
+    app.logger.info("Compressing responses of %d bytes and more", min_size)
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code < 200
+            or response.status_code in NO_BODY_STATUSES
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+            or request.method == "HEAD"
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        compressor = _Compressor(encoding, gzip_level, brotli_quality)
+        if response.is_streamed:
+            response.response = compressor.stream(response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(compressor.compress(data))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    return compress_response
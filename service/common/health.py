@@ -0,0 +1,110 @@
+"""
+Health Checks
+
+Liveness only says the worker answers. Readiness also says whether it can
+do useful work: every database engine must answer a SELECT 1 and no
+connection pool may be saturated. Pool saturation is read from the pools
+first on every probe since it costs nothing and is the number that changes
+fastest under load; a saturated worker answers at once, without queueing
+for a connection of its own. The SELECT 1 result is cached for
+HEALTH_CHECK_TTL seconds. One probe at a time runs it, on a thread and
+outside the lock, and waits at most HEALTH_CHECK_TIMEOUT seconds for it;
+the other probes get the cached result meanwhile, so a fleet of probes adds
+at most one query per interval to the database and never piles up behind a
+database that does not answer.
+"""
+import threading
+import time
+from sqlalchemy import text
+
+
+def pool_status(pool) -> dict:
+    """Returns the checked out connections of a pool and how saturated it is"""
+    if not hasattr(pool, "checkedout"):
+        # SingletonThreadPool, StaticPool and NullPool have no fixed size
+        return {"pool": type(pool).__name__, "checked_out": None, "capacity": None, "saturation": 0.0}
+    checked_out = pool.checkedout()
+    capacity = pool.size() + max(pool._max_overflow, 0)  # pylint: disable=protected-access
+    return {
+        "pool": type(pool).__name__,
+        "checked_out": checked_out,
+        "capacity": capacity,
+        "saturation": round(checked_out / capacity, 3) if capacity else 0.0,
+    }
+
+
+class HealthCheck:
+    """Checks the database engines for the readiness probe"""
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, engines=(), ttl: float = 2.0, max_saturation: float = 0.9, timeout: float = 1.0,
+                 clock=time.monotonic):
+        self.engines = list(engines)
+        self.ttl = ttl
+        self.max_saturation = max_saturation
+        self.timeout = timeout
+        self.clock = clock
+        self._result = None
+        self._checked_at = None
+        self._pinging = None
+        self._lock = threading.Lock()
+
+    def database(self) -> dict:
+        """Returns the cached result of SELECT 1 on every engine, running it when stale"""
+        with self._lock:
+            now = self.clock()
+            stale = self._checked_at is None or now - self._checked_at >= self.ttl
+            if stale and self._pinging is None:
+                self._pinging = threading.Thread(target=self._refresh, name="health-check", daemon=True)
+                self._pinging.start()
+                waiting = self._pinging
+            else:
+                # a check is running already: answer from the cache when there is one
+                waiting = self._pinging if self._result is None else None
+        if waiting is not None:
+            waiting.join(self.timeout)
+        with self._lock:
+            if waiting is not None and waiting.is_alive():
+                # report the hung database to every probe until the ping returns
+                self._result = {"ok": False, "error": f"no answer within {self.timeout}s", "latency": None}
+                self._checked_at = self.clock()
+            return dict(self._result, age=round(self.clock() - self._checked_at, 3))
+
+    def ready(self):
+        """Returns whether the worker should get traffic and the report that says why"""
+        pools = [pool_status(engine.pool) for engine in self.engines]
+        if any(pool["saturation"] >= self.max_saturation for pool in pools):
+            # a SELECT 1 would only queue for a connection behind the requests
+            return False, {"status": "unavailable", "database": {"ok": None, "skipped": "pool saturated"}, "pools": pools}
+        database = self.database()
+        ready = database["ok"]
+        return ready, {
+            "status": "ready" if ready else "unavailable",
+            "database": database,
+            "pools": pools,
+        }
+
+    def reset(self):
+        """Forgets the cached result"""
+        with self._lock:
+            self._result = self._checked_at = None
+
+    def _refresh(self):
+        result = self._ping()
+        with self._lock:
+            self._result = result
+            self._checked_at = self.clock()
+            self._pinging = None
+
+    def _ping(self):
+        started = self.clock()
+        try:
+            for engine in self.engines:
+                with engine.connect() as conn, conn.begin():
+                    if conn.dialect.name == "postgresql":
+                        # so the server gives up on the ping too, not only the probe
+                        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(self.timeout * 1000), 1)}")
+                    conn.execute(text("SELECT 1"))
+        except Exception as error:  # pylint: disable=broad-except
+            return {"ok": False, "error": str(error).splitlines()[0], "latency": round(self.clock() - started, 4)}
+        return {"ok": True, "latency": round(self.clock() - started, 4)}
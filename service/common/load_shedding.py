@@ -0,0 +1,134 @@
+"""
+Load Shedding
+
+Turns requests away with 503 and a Retry-After header before they start,
+instead of letting them queue for a database connection until they time
+out. A request is shed when MAX_CONCURRENT_REQUESTS are already running in
+this process, or when getting a connection from the pool has recently
+taken longer than POOL_WAIT_THRESHOLD seconds (or a checkout is waiting
+that long right now).
+
+Pool wait is measured by timing every connection checkout of the engines passed
+to init_load_shedding(). Samples older than POOL_WAIT_WINDOW seconds are
+forgotten, so shedding stops on its own once the pool recovers.
+
+Health probes are never shed: a shed liveness probe would get the worker
+restarted, and readiness reports the saturation itself.
+
+When LOAD_SHEDDING is off nothing is registered at all.
+"""
+import collections
+import itertools
+import math
+import threading
+import time
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class PoolWaitMonitor:
+    """Times how long pool checkouts wait for a connection"""
+
+    def __init__(self, window: float = 1.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._samples = collections.deque()
+        self._waiting = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def watch(self, engine):
+        """Times every connection checkout of an engine"""
+        # wraps the engine rather than its pool, dispose() replaces the pool
+        raw_connection = engine.raw_connection
+
+        def timed_raw_connection():
+            started = self.clock()
+            ticket = next(self._ids)
+            with self._lock:
+                self._waiting[ticket] = started
+            try:
+                return raw_connection()
+            finally:
+                finished = self.clock()
+                with self._lock:
+                    del self._waiting[ticket]
+                    self._samples.append((finished, finished - started))
+        engine.raw_connection = timed_raw_connection
+
+    def wait_time(self) -> float:
+        """Returns the longest pool wait seen recently or still going on"""
+        now = self.clock()
+        with self._lock:
+            while self._samples and self._samples[0][0] < now - self.window:
+                self._samples.popleft()
+            waited = max((wait for _, wait in self._samples), default=0.0)
+            waiting = now - min(self._waiting.values(), default=now)
+        return max(waited, waiting)
+
+
+class LoadShedder:
+    """Counts the requests in flight and decides which ones to turn away"""
+
+    def __init__(self, max_concurrent: int = 0, pool_wait_threshold: float = 0.5, monitor=None, retry_after: int = 1):
+        self.max_concurrent = max_concurrent
+        self.pool_wait_threshold = pool_wait_threshold
+        self.monitor = monitor or PoolWaitMonitor()
+        self.retry_after = retry_after
+        self._in_flight = 0
+        self._counts = {"admitted": 0, "shed_concurrency": 0, "shed_pool_wait": 0}
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """Admits a request or raises ServiceUnavailable"""
+        waited = self.monitor.wait_time()
+        with self._lock:
+            if self.max_concurrent and self._in_flight >= self.max_concurrent:
+                reason = "concurrency"
+                message = f"{self._in_flight} requests already in flight"
+            elif self.pool_wait_threshold and waited > self.pool_wait_threshold:
+                reason = "pool_wait"
+                message = f"Database connections are taking {waited:.2f}s"
+            else:
+                self._in_flight += 1
+                self._counts["admitted"] += 1
+                return
+            self._counts[f"shed_{reason}"] += 1
+        raise ServiceUnavailable(f"{message}, try again later", retry_after=max(1, math.ceil(self.retry_after)))
+
+    def release(self):
+        """Ends an admitted request"""
+        with self._lock:
+            self._in_flight -= 1
+
+    def stats(self) -> dict:
+        """Returns the requests in flight and how many were admitted and shed"""
+        with self._lock:
+            return dict(self._counts, in_flight=self._in_flight, pool_wait=self.monitor.wait_time())
+
+
+def init_load_shedding(app, engines, shedder=None):
+    """Registers the load shedding hooks of shedder when LOAD_SHEDDING is turned on"""
+    shedder = shedder or LoadShedder()
+    if not app.config.get("LOAD_SHEDDING"):
+        return shedder
+    shedder.max_concurrent = app.config["MAX_CONCURRENT_REQUESTS"]
+    shedder.pool_wait_threshold = app.config["POOL_WAIT_THRESHOLD"]
+    shedder.monitor.window = app.config["POOL_WAIT_WINDOW"]
+    for engine in engines:
+        shedder.monitor.watch(engine)
+    app.logger.info("Shedding load over %s requests in flight", shedder.max_concurrent or "unlimited")
+
+    @app.before_request
+    def admit_request():
+        if request.path.startswith("/health/"):
+            return
+        shedder.admit()
+        g.load_shedding_admitted = True
+
+    @app.teardown_request
+    def release_request(exc=None):  # pylint: disable=unused-argument
+        if g.pop("load_shedding_admitted", False):
+            shedder.release()
+
+    return shedder
@@ -0,0 +1,42 @@
+"""
+Media Types
+
+Encodes and decodes request and response bodies as JSON or MessagePack.
+Both carry the same dictionaries that Shopcart.serialize() and
+Item.serialize() produce and deserialize() reads, so the models do not
+know which one went over the wire. JSON stays the default: MessagePack is
+only used for bodies sent as application/msgpack and for clients that
+prefer it in their Accept header.
+"""
+import json
+import msgpack
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MEDIA_TYPES = (JSON, MSGPACK)
+
+
+class BodyDecodeError(ValueError):
+    """Raised for a body that cannot be decoded as its media type"""
+
+
+def negotiate(accept_mimetypes) -> str:
+    """Returns the media type to answer with, JSON unless the client prefers MessagePack"""
+    return accept_mimetypes.best_match(MEDIA_TYPES, default=JSON) or JSON
+
+
+def dumps(body, media_type: str) -> bytes:
+    """Encodes a body as media_type"""
+    if media_type == MSGPACK:
+        return msgpack.packb(body, use_bin_type=True)
+    return json.dumps(body).encode("utf-8")
+
+
+def loads(data: bytes, media_type: str):
+    """Decodes a body sent as media_type"""
+    try:
+        if media_type == MSGPACK:
+            return msgpack.unpackb(data, raw=False)
+        return json.loads(data)
+    except (ValueError, msgpack.UnpackException) as error:
+        raise BodyDecodeError(f"Body is not valid {media_type}: {error}") from error
@@ -0,0 +1,91 @@
+"""
+Memory Store
+
+Keeps records in process memory instead of a database when STORAGE_BACKEND
+is "memory". Records are plain dicts with an "id", held per kind ("shopcart",
+"item", ...) in a dict keyed by id, and every index registered for a kind is
+a dict from a key (a customer id, a (shopcart id, product id) pair, ...) to
+the ids of the records holding it, so lookups never scan. Nothing is written
+to disk and nothing survives a restart, which is the point: it is meant for
+local load tests and for unit tests that do not need the database.
+
+The store hands out copies and never the dicts it keeps, so callers cannot
+change a record without add(). Callers that read a record and write it back
+hold lock around both, like a transaction.
+"""
+import itertools
+import threading
+
+
+class MemoryStore:
+    """Stores records by id with secondary indexes, all in memory"""
+
+    def __init__(self):
+        self._indexes = {}
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Drops every record and id counter, keeping the registered indexes"""
+        with self.lock:
+            self._records = {}
+            self._keys = {}
+            self._ids = {}
+            self._lookups = {kind: {name: {} for name in indexes} for kind, indexes in self._indexes.items()}
+
+    def index(self, kind, name, key_function):
+        """Registers an index of kind on the key key_function returns for a record"""
+        with self.lock:
+            self._indexes.setdefault(kind, {})[name] = key_function
+            self._lookups.setdefault(kind, {})[name] = {}
+
+    def next_id(self, kind) -> int:
+        """Returns the next free id of kind"""
+        with self.lock:
+            counter = self._ids.setdefault(kind, itertools.count(1))
+            return next(counter)
+
+    def add(self, kind, record):
+        """Stores a copy of a record, replacing and re-indexing the one with its id"""
+        record = dict(record)
+        with self.lock:
+            self._unindex(kind, record["id"])
+            self._records.setdefault(kind, {})[record["id"]] = record
+            keys = {}
+            for name, key_function in self._indexes.get(kind, {}).items():
+                keys[name] = key_function(record)
+                self._lookups[kind][name].setdefault(keys[name], set()).add(record["id"])
+            self._keys[(kind, record["id"])] = keys
+
+    def remove(self, kind, by_id):
+        """Removes a record and its index entries"""
+        with self.lock:
+            self._unindex(kind, by_id)
+            self._records.get(kind, {}).pop(by_id, None)
+
+    def get(self, kind, by_id):
+        """Returns a copy of the record of kind with an id, or None"""
+        with self.lock:
+            record = self._records.get(kind, {}).get(by_id)
+            return dict(record) if record is not None else None
+
+    def all(self, kind) -> list:
+        """Returns copies of every record of kind ordered by id"""
+        with self.lock:
+            records = self._records.get(kind, {})
+            return [dict(records[by_id]) for by_id in sorted(records)]
+
+    def lookup(self, kind, name, key) -> list:
+        """Returns copies of the records of kind whose index name holds key, ordered by id"""
+        with self.lock:
+            ids = sorted(self._lookups.get(kind, {}).get(name, {}).get(key, ()))
+            return [dict(self._records[kind][by_id]) for by_id in ids]
+
+    def _unindex(self, kind, by_id):
+        keys = self._keys.pop((kind, by_id), {})
+        for name, key in keys.items():
+            ids = self._lookups[kind][name].get(key)
+            if ids is not None:
+                ids.discard(by_id)
+                if not ids:
+                    del self._lookups[kind][name][key]
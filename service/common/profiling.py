@@ -0,0 +1,161 @@
+"""
+Request Profiling
+
+This module profiles single requests when PROFILING is turned on. A profiled
+request runs under cProfile and records every SQL statement it sends with
+its duration. The report is written to a ring of JSON files on disk and its
+name is returned in the X-Profile-Id response header.
+
+In "header" mode only requests whose X-Profile header holds PROFILE_SECRET
+are profiled, and without a secret nothing is.
+
+When PROFILING is "off" no hooks or engine listeners are registered at all.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+
+class ProfileRing:
+    """Keeps the last size profile reports in a directory on disk"""
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = max(1, size)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, report: dict) -> str:
+        """Writes a report, drops the oldest ones beyond size and returns its id"""
+        with self._lock:
+            report_id = f"profile-{os.getpid()}-{next(self._counter):06d}"
+        path = os.path.join(self.directory, report_id + ".json")
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+        self.prune()
+        return report_id
+
+    def prune(self):
+        """Removes all but the size newest reports, whichever process wrote them"""
+        # every worker, including the ones max_requests recycled, writes here
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith("profile-") and name.endswith(".json")
+        ]
+        if len(paths) <= self.size:
+            return
+        for path in sorted(paths, key=_mtime)[:-self.size]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker pruned it first
+
+    def read(self, report_id: str) -> dict:
+        """Reads a report back by id"""
+        path = os.path.join(self.directory, os.path.basename(report_id) + ".json")
+        with open(path, encoding="utf-8") as report_file:
+            return json.load(report_file)
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def _profiling_request() -> bool:
+    """True when the current request is being profiled"""
+    return has_request_context() and "profile" in g
+
+
+def _before_cursor_execute(conn, *_args):
+    if _profiling_request():
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, _cursor, statement, *_args):
+    started = conn.info.get("profile_started")
+    if started and _profiling_request():
+        duration = time.perf_counter() - started.pop()
+        g.profile["sql"].append({"statement": statement, "duration_ms": round(duration * 1000, 3)})
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    started = context.connection.info.get("profile_started") if context.connection is not None else None
+    if started and _profiling_request():
+        started.pop()
+
+
+def init_profiling(app, engines):
+    """Registers the profiling hooks when PROFILING is turned on"""
+    mode = app.config.get("PROFILING", "off")
+    if mode not in ("header", "all"):
+        return None
+    secret = app.config.get("PROFILE_SECRET", "")
+    if mode == "header" and not secret:
+        app.logger.warning("PROFILING=header needs a PROFILE_SECRET, request profiling stays off")
+        return None
+
+    ring = ProfileRing(app.config["PROFILE_DIR"], app.config.get("PROFILE_RING_SIZE", 50))
+    top = app.config.get("PROFILE_TOP_FUNCTIONS", 30)
+    app.logger.info("Request profiling turned on for %s requests", mode)
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+    @app.before_request
+    def start_profile():
+        if mode == "header" and not hmac.compare_digest(request.headers.get(PROFILE_HEADER, ""), secret):
+            return
+        profiler = cProfile.Profile()
+        g.profile = {"profiler": profiler, "sql": [], "started": time.perf_counter()}
+        profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        profile["profiler"].disable()
+        elapsed = time.perf_counter() - profile["started"]
+        stats_text = io.StringIO()
+        stats = pstats.Stats(profile["profiler"], stream=stats_text)
+        stats.sort_stats("cumulative").print_stats(top)
+        report = {
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 3),
+            "sql_count": len(profile["sql"]),
+            "sql_ms": round(sum(s["duration_ms"] for s in profile["sql"]), 3),
+            "sql": profile["sql"],
+            "python": stats_text.getvalue(),
+        }
+        response.headers[PROFILE_ID_HEADER] = ring.write(report)
+        return response
+
+    @app.teardown_request
+    def stop_profile(exc=None):  # pylint: disable=unused-argument
+        # a request that raised never reached after_request
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile["profiler"].disable()
+
+    return ring
@@ -0,0 +1,168 @@
+"""
+Rate Limiting
+
+Token buckets per client and route, kept with the generic cell rate
+algorithm (GCRA): a bucket is a single "theoretical arrival time" per key,
+so it costs one number of state and one compare per request. A route
+allows rate requests per second on average and bursts of up to burst.
+
+Buckets live in a store. MemoryBucketStore keeps them in this process,
+which is enough for a single worker. RedisBucketStore keeps them in Redis
+so that every worker and host shares the same buckets; anything with the
+same take() method can stand in for it, which is how tests fake a shared
+store without a server.
+
+Clients are told apart by their address. Behind TRUSTED_PROXIES proxies
+the app reads it from X-Forwarded-For (see service/__init__.py), and only
+then is RATE_LIMIT_KEY_HEADER used instead: a client talking to the app
+directly could send a new id with every request and never run out.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+
+class MemoryBucketStore:
+    """Keeps up to max_keys token buckets in process memory, least recently used first"""
+
+    def __init__(self, clock=time.monotonic, max_keys=10000):
+        self.clock = clock
+        self.max_keys = max_keys
+        self._arrivals = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate: float, burst: int) -> float:
+        """Takes a token from a bucket; returns 0 or the seconds until one is available"""
+        interval = 1.0 / rate
+        with self._lock:
+            now = self.clock()
+            arrival = max(self._arrivals.get(key, now), now) + interval
+            allowed_at = arrival - burst * interval
+            if now < allowed_at:
+                return allowed_at - now
+            self._arrivals[key] = arrival
+            self._arrivals.move_to_end(key)
+            self._forget(now)
+            return 0.0
+
+    def _forget(self, now):
+        # drop the least recently used buckets while they are full again (their
+        # arrival time has passed), and beyond max_keys even when they are not
+        while self._arrivals:
+            key, arrival = next(iter(self._arrivals.items()))
+            if arrival > now and len(self._arrivals) <= self.max_keys:
+                return
+            del self._arrivals[key]
+
+
+class RedisBucketStore:
+    """Keeps token buckets in Redis, shared by every worker"""
+
+    # GCRA in one atomic step: KEYS[1] bucket, ARGV rate, burst
+    SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval = 1 / tonumber(ARGV[1])
+local arrival = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now) + interval
+local allowed_at = arrival - tonumber(ARGV[2]) * interval
+if now < allowed_at then
+  return tostring(allowed_at - now)
+end
+redis.call('SET', KEYS[1], tostring(arrival), 'PX', math.ceil((arrival - now) * 1000))
+return '0'
+"""
+
+    def __init__(self, client, prefix="shopcarts:rate:"):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url):
+        """Connects to the Redis server at url"""
+        import redis  # pylint: disable=import-outside-toplevel, import-error
+        return cls(redis.Redis.from_url(url))
+
+    def take(self, key, rate: float, burst: int) -> float:
+        """Takes a token from a bucket; returns 0 or the seconds until one is available"""
+        return float(self._script(keys=[self.prefix + key], args=[rate, burst]))
+
+
+def store_for(setting):
+    """Returns the bucket store named by RATE_LIMIT_STORAGE"""
+    if setting.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBucketStore.from_url(setting)
+    return MemoryBucketStore()
+
+
+def parse_limits(setting: str) -> dict:
+    """Parses "endpoint=rate:burst,..." into {endpoint: (rate, burst)}"""
+    limits = {}
+    for entry in setting.split(","):
+        if entry.strip():
+            endpoint, value = entry.split("=")
+            rate, burst = value.split(":")
+            limits[endpoint.strip()] = (float(rate), int(burst))
+    return limits
+
+
+class RateLimiter:
+    """Applies a token bucket per client to the routes it decorates"""
+
+    def __init__(self, store=None):
+        self.store = store or MemoryBucketStore()
+        self.defaults = {}
+        self.overrides = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def limit(self, rate: float, burst: int):
+        """Limits a route to rate requests per second per client, in bursts of up to burst"""
+        def decorator(function):
+            self.defaults[function.__name__] = (rate, burst)
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if current_app.config.get("RATE_LIMITING"):
+                    self.check(function.__name__)
+                return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def check(self, endpoint):
+        """Raises TooManyRequests when the client has used up its bucket for endpoint"""
+        rate, burst = self.overrides.get(endpoint, self.defaults[endpoint])
+        wait = self.store.take(f"{endpoint}:{self.client()}", rate, burst)
+        self._count(endpoint, "limited" if wait else "allowed")
+        if wait:
+            raise TooManyRequests(
+                f"Rate limit of {rate:g}/s exceeded for {endpoint}", retry_after=max(1, math.ceil(wait))
+            )
+
+    @staticmethod
+    def client() -> str:
+        """Returns the key of the client of the request"""
+        client = None
+        if current_app.config.get("TRUSTED_PROXIES"):
+            # the proxy sets the header, clients cannot pick their own id
+            client = request.headers.get(current_app.config.get("RATE_LIMIT_KEY_HEADER", "X-Client-Id"))
+        return client or request.remote_addr or "unknown"
+
+    def stats(self) -> dict:
+        """Returns how many requests each route allowed and limited"""
+        with self._lock:
+            return {endpoint: dict(counts) for endpoint, counts in self._counts.items()}
+
+    def reset(self):
+        """Clears the counters"""
+        with self._lock:
+            self._counts = {}
+
+    def _count(self, endpoint, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(endpoint, {"allowed": 0, "limited": 0})
+            counts[outcome] += 1
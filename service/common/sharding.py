@@ -0,0 +1,145 @@
+"""
+Shard Router
+
+This module routes shopcart rows to one of N database binds. A shopcart is
+placed on the shard chosen by a stable hash of its customer id, and every
+shard hands out primary keys from its own id range so that a shopcart or
+item id alone is enough to find the shard that holds it.
+"""
+import zlib
+from flask.globals import app_ctx
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Largest value of a 32 bit INTEGER primary key
+MAX_ID = 2**31 - 1
+
+
+def _app_ctx_id():
+    """Scopes shard sessions to the current Flask application context"""
+    return id(app_ctx._get_current_object())  # pylint: disable=protected-access
+
+
+def _make_engine(uri: str):
+    """Creates the engine of one shard"""
+    url = make_url(uri)
+    if url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:"):
+        # an in-memory SQLite shard only lives as long as its one connection
+        return create_engine(url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+    return create_engine(url)
+
+
+class ShardRouter:
+    """Maps customer ids and primary keys onto shard sessions"""
+
+    def __init__(self):
+        self._sessions = []
+
+    @property
+    def enabled(self) -> bool:
+        """True when more than the default database is configured"""
+        return bool(self._sessions)
+
+    @property
+    def count(self) -> int:
+        """Number of configured shards"""
+        return len(self._sessions)
+
+    @property
+    def id_span(self) -> int:
+        """Size of the primary key range owned by each shard"""
+        return MAX_ID // self.count
+
+    @property
+    def engines(self):
+        """Returns the engines of every shard"""
+        return [session.bind for session in self._sessions]
+
+    def init_uris(self, uris):
+        """Creates an engine and a scoped session for each shard uri"""
+        self.reset()
+        self._sessions = [
+            scoped_session(sessionmaker(bind=_make_engine(uri)), scopefunc=_app_ctx_id)
+            for uri in uris
+        ]
+
+    def reset(self):
+        """Turns sharding off"""
+        self.remove()
+        for engine in self.engines:
+            engine.dispose()
+        self._sessions = []
+
+    def remove(self, exc=None):  # pylint: disable=unused-argument
+        """Closes the shard sessions of the current application context"""
+        for session in self._sessions:
+            session.remove()
+
+    def shard_for_customer(self, customer_id) -> int:
+        """Returns the shard that owns a customer's shopcarts"""
+        return zlib.crc32(str(customer_id).encode("utf-8")) % self.count
+
+    def shard_for_id(self, by_id) -> int:
+        """Returns the shard whose id range contains by_id"""
+        return min(int(by_id) // self.id_span, self.count - 1)
+
+    def id_base(self, shard: int) -> int:
+        """Returns the last id below the range owned by a shard"""
+        return shard * self.id_span
+
+    def id_range(self, shard: int):
+        """Returns the first and the last id owned by a shard"""
+        last = MAX_ID if shard == self.count - 1 else self.id_base(shard + 1)
+        return self.id_base(shard) + 1, last
+
+    def session(self, shard: int):
+        """Returns the session for a shard"""
+        return self._sessions[shard]
+
+    def sessions(self):
+        """Returns the sessions of every shard"""
+        return list(self._sessions)
+
+
+def restrict_ids(connection, table, first: int, last: int, *archives):
+    """
+    Makes the database hand out the ids of table from first to last
+
+    The table's own id counter (its PostgreSQL sequence, or its row of
+    sqlite_sequence) is moved past the highest id table or its archives
+    already use in that range, so every insert path gets a shard id from the
+    database and concurrent inserts never get the same one.
+    """
+    used = [
+        connection.execute(select(func.max(source.c.id)).where(source.c.id.between(first, last))).scalar() or 0
+        for source in (table, *archives)
+    ]
+    start = max([first] + [used_id + 1 for used_id in used])
+    if connection.dialect.name == "postgresql":
+        sequence = connection.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table.name}
+        ).scalar()
+        if sequence is None:
+            return
+        row = connection.execute(text(f"SELECT last_value, is_called FROM {sequence}")).one()
+        if (row.last_value + 1 if row.is_called else row.last_value) < start:
+            connection.execute(text("SELECT setval(:sequence, :start, false)"), {"sequence": sequence, "start": start})
+        # running out of ids fails instead of stepping into the next shard's range
+        connection.execute(text(f"ALTER SEQUENCE {sequence} MAXVALUE {last}"))
+    elif connection.dialect.name == "sqlite":
+        # AUTOINCREMENT continues after the larger of this and the highest rowid
+        current = connection.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = :table"), {"table": table.name}
+        ).scalar()
+        if current is None:
+            connection.execute(
+                text("INSERT INTO sqlite_sequence (name, seq) VALUES (:table, :seq)"),
+                {"table": table.name, "seq": start - 1},
+            )
+        elif current < start - 1:
+            connection.execute(
+                text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :table"),
+                {"table": table.name, "seq": start - 1},
+            )
@@ -0,0 +1,79 @@
+"""
+Single Flight
+
+Coalesces concurrent identical reads within one process. The first caller of
+a key runs the read; callers that ask for the same key while it is still
+running wait for it and share its result instead of running the same query
+again. Nothing is cached: once the read finishes the next caller runs a new
+one, so a result is never older than a read already in flight.
+"""
+import threading
+
+
+class _Call:
+    """A read in flight and the callers waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one read per key at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key, function):
+        """Runs function for key, or waits for the run already in flight"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executed += 1
+            else:
+                call.waiters += 1
+                self._coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def waiting(self, key) -> int:
+        """Returns how many callers are waiting on the read of key"""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call else 0
+
+    def stats(self) -> dict:
+        """Returns how many reads ran and how many callers shared one"""
+        with self._lock:
+            return {
+                "executed": self._executed,
+                "coalesced": self._coalesced,
+                "in_flight": len(self._calls),
+            }
+
+    def reset(self):
+        """Clears the counters"""
+        with self._lock:
+            self._executed = 0
+            self._coalesced = 0
@@ -0,0 +1,145 @@
+"""
+Slow Query Log
+
+Times every SQL statement of the engines passed to init_slow_query_log()
+and logs the ones that take SLOW_QUERY_THRESHOLD_MS or longer, with their
+bound parameters, duration and the route that sent them. The last
+SLOW_QUERY_RING_SIZE of them are also kept in memory for GET
+/admin/slow-queries. It is off unless SLOW_QUERY_LOG is turned on.
+
+A SLOW_QUERY_EXPLAIN_RATE share of the slow SELECTs is run again under
+EXPLAIN (ANALYZE, BUFFERS) on PostgreSQL, or EXPLAIN QUERY PLAN elsewhere,
+and the plan is kept with the entry. Only SELECTs are explained since
+ANALYZE executes the statement, and the plan runs on the same connection
+inside a savepoint so a failing EXPLAIN cannot abort the request's
+transaction.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+from flask import has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger("flask.app")
+
+PARAMETERS_MAX_LENGTH = 500
+
+
+def _origin() -> str:
+    """Returns the route that sent the current statement"""
+    if has_request_context() and request.url_rule is not None:
+        return f"{request.method} {request.url_rule.rule}"
+    return "-"
+
+
+class SlowQueryLog:
+    """Logs and keeps the statements slower than a threshold"""
+
+    def __init__(self, threshold_ms: float = 200, explain_rate: float = 0.0, size: int = 100):
+        self.threshold = threshold_ms / 1000
+        self.explain_rate = explain_rate
+        self.entries = collections.deque(maxlen=max(1, size))
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def watch(self, engine):
+        """Times every statement of an engine"""
+        if event.contains(engine, "after_cursor_execute", self._after_cursor_execute):
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def recent(self) -> list:
+        """Returns the kept slow statements, newest first"""
+        with self._lock:
+            return list(reversed(self.entries))
+
+    def clear(self):
+        """Forgets the kept slow statements"""
+        with self._lock:
+            self.entries.clear()
+
+    def record(self, statement, parameters, duration, plan=None):
+        """Logs a slow statement and keeps it in the ring"""
+        entry = {
+            "statement": statement,
+            "parameters": repr(parameters)[:PARAMETERS_MAX_LENGTH],
+            "duration_ms": round(duration * 1000, 3),
+            "origin": _origin(),
+            "at": time.time(),
+        }
+        if plan is not None:
+            entry["plan"] = plan
+        logger.warning(
+            "Slow query (%.1f ms) from %s: %s %s",
+            entry["duration_ms"], entry["origin"], statement, entry["parameters"]
+        )
+        with self._lock:
+            self.entries.append(entry)
+        return entry
+
+    def _before_cursor_execute(self, conn, *_args):
+        conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, _context, executemany):
+        started = conn.info.get("slow_query_started")
+        if not started:
+            return
+        duration = time.perf_counter() - started.pop()
+        if duration < self.threshold:
+            return
+        plan = None
+        if not executemany and self._sampled() and statement.lstrip()[:6].upper() == "SELECT":
+            plan = self._explain(conn, cursor, statement, parameters)
+        self.record(statement, parameters, duration, plan)
+
+    def _handle_error(self, context):
+        # a failed statement never reaches after_cursor_execute
+        started = context.connection.info.get("slow_query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _sampled(self) -> bool:
+        return self.explain_rate > 0 and self._random.random() < self.explain_rate
+
+    @staticmethod
+    def _explain(conn, cursor, statement, parameters):
+        """Returns the plan of statement as lines of text, or the error that prevented it"""
+        postgres = conn.dialect.name == "postgresql"
+        explain = "EXPLAIN (ANALYZE, BUFFERS) " if postgres else "EXPLAIN QUERY PLAN "
+        # a raw cursor, so the EXPLAIN is not timed and logged itself
+        plan_cursor = cursor.connection.cursor()
+        try:
+            if postgres:
+                plan_cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                plan_cursor.execute(explain + statement, parameters)
+                rows = plan_cursor.fetchall()
+            except Exception as error:  # pylint: disable=broad-except
+                if postgres:
+                    plan_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                return [f"EXPLAIN failed: {error}"]
+            finally:
+                if postgres:
+                    plan_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            plan_cursor.close()
+        return [" ".join(str(column) for column in row) if len(row) > 1 else str(row[0]) for row in rows]
+
+
+def init_slow_query_log(app, engines, log=None):
+    """Watches the engines with log when SLOW_QUERY_LOG is turned on"""
+    log = log or SlowQueryLog()
+    if not app.config.get("SLOW_QUERY_LOG"):
+        return log
+    log.threshold = app.config["SLOW_QUERY_THRESHOLD_MS"] / 1000
+    log.explain_rate = app.config["SLOW_QUERY_EXPLAIN_RATE"]
+    log.entries = collections.deque(maxlen=max(1, app.config["SLOW_QUERY_RING_SIZE"]))
+    for engine in engines:
+        log.watch(engine)
+    app.logger.info("Logging SQL statements slower than %s ms", app.config["SLOW_QUERY_THRESHOLD_MS"])
+    return log
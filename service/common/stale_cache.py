@@ -0,0 +1,53 @@
+"""
+Stale Cache
+
+Remembers the last value read for each key so that a read route can still
+answer, marked stale, while the database cannot. It is a bounded LRU and
+values older than max_age are never served.
+"""
+import collections
+import threading
+import time
+
+
+class StaleCache:
+    """Keeps the last known value of the most recently read keys"""
+
+    def __init__(self, size: int = 10000, max_age: float = 300.0, clock=time.monotonic):
+        self.size = size
+        self.max_age = max_age
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        """Remembers value as the last known value of key"""
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns (value, age in seconds) of key, or None when unknown or too old"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        age = self.clock() - entry[0]
+        if age > self.max_age:
+            return None
+        return entry[1], age
+
+    def discard(self, *keys):
+        """Forgets keys whose value was changed"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Forgets every key"""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,265 @@
+"""
+Tracing
+
+Records a span for every traced request, a child span for every SQL
+statement it sends and one for serializing a large shopcart, so a slow
+request can be read next to the statements that made it slow. Trace ids
+follow W3C Trace Context: an incoming traceparent header makes the request
+span a child of the caller's span, and the response carries the traceparent
+of the request span so the caller can find it.
+
+Finished spans go to exporters. MemoryExporter keeps the last spans of this
+process for GET /admin/traces and FileExporter appends them as JSON lines
+to a file, so neither needs a collector.
+
+When TRACING is off no hooks or engine listeners are registered, and the
+only cost left is the check for a current span in Shopcart.serialize().
+"""
+import collections
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+
+TRACEPARENT_HEADER = "traceparent"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header):
+    """Returns (trace_id, parent_id, sampled) of a traceparent header, None when it is not valid"""
+    parts = (header or "").strip().lower().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff" or (parts[0] == "00" and len(parts) != 4):
+        return None
+    _, trace_id, parent_id, flags = parts[:4]
+    if len(trace_id) != 32 or len(parent_id) != 16 or len(flags) != 2:
+        return None
+    try:
+        int(trace_id, 16), int(parent_id, 16), int(flags, 16)  # pylint: disable=expression-not-assigned
+    except ValueError:
+        return None
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def format_traceparent(trace_id, span_id, sampled=True) -> str:
+    """Returns the traceparent header of a span"""
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+class Span:
+    """One timed operation of a trace"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start", "end", "_started")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self._started = time.perf_counter()
+
+    def finish(self):
+        """Ends the span"""
+        self.end = self.start + (time.perf_counter() - self._started)
+
+    @property
+    def traceparent(self) -> str:
+        """The traceparent header naming this span"""
+        return format_traceparent(self.trace_id, self.span_id)
+
+    def to_dict(self) -> dict:
+        """Converts a finished span into a dictionary"""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+class MemoryExporter:
+    """Keeps the last size finished spans of this process"""
+
+    def __init__(self, size: int = 1000):
+        self.spans = collections.deque(maxlen=max(1, size))
+        self._lock = threading.Lock()
+
+    def export(self, span: dict):
+        """Keeps a finished span"""
+        with self._lock:
+            self.spans.append(span)
+
+    def traces(self, trace_id=None) -> list:
+        """Returns the kept spans, oldest first, of one trace or of all of them"""
+        with self._lock:
+            return [span for span in self.spans if trace_id in (None, span["trace_id"])]
+
+    def clear(self):
+        """Forgets the kept spans"""
+        with self._lock:
+            self.spans.clear()
+
+
+class FileExporter:
+    """Appends finished spans to a file as JSON lines"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, span: dict):
+        """Appends a finished span"""
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as trace_file:
+                trace_file.write(line)
+
+
+class Tracer:
+    """Starts spans under the current one and hands finished spans to the exporters"""
+
+    def __init__(self, exporters=(), sample_rate: float = 1.0):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+
+    @staticmethod
+    def current_span():
+        """Returns the span of the current request or operation, None outside of a trace"""
+        return _current_span.get()
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        """Starts the root span of a request, or returns None when it is not sampled"""
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return None
+        span = Span(name, trace_id, parent_id, attributes)
+        return span, _current_span.set(span)
+
+    def end_trace(self, started, **attributes):
+        """Ends the root span returned by start_trace()"""
+        span, token = started
+        _current_span.reset(token)
+        span.attributes.update(attributes)
+        self.export(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Times a block as a child of the current span, does nothing outside of a trace"""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+            self.export(span)
+
+    def export(self, span: Span):
+        """Finishes a span and hands it to every exporter"""
+        span.finish()
+        record = span.to_dict()
+        for exporter in self.exporters:
+            exporter.export(record)
+
+
+# The tracer of the service, idle until init_tracing() gives it exporters
+tracer = Tracer()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    parent = _current_span.get()
+    if parent is not None:
+        span = Span("sql", parent.trace_id, parent.span_id, {"db.statement": statement, "db.system": conn.dialect.name})
+        conn.info.setdefault("trace_spans", []).append(span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=too-many-arguments
+    spans = conn.info.get("trace_spans")
+    if spans and _current_span.get() is not None:
+        span = spans.pop()
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            span.attributes["db.rowcount"] = cursor.rowcount
+        tracer.export(span)
+
+
+def _handle_error(context):
+    spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+    if spans and _current_span.get() is not None:
+        span = spans.pop()
+        span.attributes["error"] = repr(context.original_exception)
+        tracer.export(span)
+
+
+def _start_request_span():
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    started = tracer.start_trace(
+        f"{request.method} {rule}",
+        request.headers.get(TRACEPARENT_HEADER),
+        **{"http.method": request.method, "http.target": request.full_path.rstrip("?")},
+    )
+    if started is not None:
+        g.trace = started
+
+
+def _add_traceparent(response):
+    if "trace" in g:
+        span = g.trace[0]
+        span.attributes["http.status_code"] = response.status_code
+        response.headers[TRACEPARENT_HEADER] = span.traceparent
+    return response
+
+
+def _end_request_span(exc=None):
+    started = g.pop("trace", None)
+    if started is not None:
+        tracer.end_trace(started, **({"error": repr(exc)} if exc is not None else {}))
+
+
+def init_tracing(app, engines, traces=None):
+    """Registers the tracing hooks when TRACING is turned on, keeping the spans in traces"""
+    if not app.config.get("TRACING"):
+        return None
+
+    traces = traces or MemoryExporter()
+    traces.spans = collections.deque(traces.spans, maxlen=max(1, app.config.get("TRACING_RING_SIZE", 1000)))
+    tracer.sample_rate = app.config.get("TRACING_SAMPLE_RATE", 1.0)
+    tracer.exporters = [traces]
+    if app.config.get("TRACING_FILE"):
+        tracer.exporters.append(FileExporter(app.config["TRACING_FILE"]))
+    app.logger.info("Tracing %d%% of the requests", tracer.sample_rate * 100)
+
+    for engine in engines:
+        if event.contains(engine, "after_cursor_execute", _after_cursor_execute):
+            continue
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+    app.before_request(_start_request_span)
+    app.after_request(_add_traceparent)
+    app.teardown_request(_end_request_span)
+    return traces
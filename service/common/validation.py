@@ -0,0 +1,103 @@
+"""
+Request Validation
+
+Schemas are declared as a dict of field name to Field (or ListOf for a
+nested list) and compiled once into a validator function. The validator
+checks a decoded body with a flat list of small closures, one per field,
+and returns every error it finds instead of stopping at the first one, so
+a client learns about all of its mistakes from a single 400.
+"""
+
+INTEGER = "integer"
+NUMBER = "number"
+STRING = "string"
+
+
+class Field:
+    """Declares one field of a schema"""
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, kind, required=True, nullable=False, minimum=None, max_length=None):
+        self.kind = kind
+        self.required = required
+        self.nullable = nullable
+        self.minimum = minimum
+        self.max_length = max_length
+
+
+class ListOf:
+    """Declares a list field whose entries are checked by another validator"""
+
+    def __init__(self, validator, max_items=None, required=True):
+        self.validator = validator
+        self.max_items = max_items
+        self.required = required
+
+
+def _type_check(kind):
+    if kind == INTEGER:
+        return lambda value: isinstance(value, int) and not isinstance(value, bool)
+    if kind == NUMBER:
+        return lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+    return lambda value: isinstance(value, str)
+
+
+def _field_check(name, field):
+    """Compiles the checks of one Field into one function"""
+    is_kind = _type_check(field.kind)
+    minimum, max_length, nullable = field.minimum, field.max_length, field.nullable
+    wrong_type = f"{name}: must be a{'n' if field.kind == INTEGER else ''} {field.kind}"
+
+    def check(value, errors, prefix):
+        if value is None:
+            if not nullable:
+                errors.append(f"{prefix}{name}: must not be null")
+        elif not is_kind(value):
+            errors.append(prefix + wrong_type)
+        elif minimum is not None and value < minimum:
+            errors.append(f"{prefix}{name}: must be at least {minimum}")
+        elif max_length is not None and len(value) > max_length:
+            errors.append(f"{prefix}{name}: must be at most {max_length} characters")
+    return check
+
+
+def _list_check(name, field):
+    """Compiles the checks of one ListOf into one function"""
+    validator, max_items = field.validator, field.max_items
+
+    def check(value, errors, prefix):
+        if not isinstance(value, list):
+            errors.append(f"{prefix}{name}: must be a list")
+            return
+        if max_items is not None and len(value) > max_items:
+            errors.append(f"{prefix}{name}: must hold at most {max_items} entries")
+            return
+        for index, entry in enumerate(value):
+            errors.extend(validator(entry, f"{prefix}{name}[{index}]."))
+    return check
+
+
+def compile_schema(fields: dict):
+    """
+    Compiles a schema into a validator
+
+    The validator takes a decoded body (and a prefix for the error messages
+    of nested entries) and returns the list of errors, empty when it is valid.
+    """
+    checks = []
+    for name, field in fields.items():
+        check = _list_check(name, field) if isinstance(field, ListOf) else _field_check(name, field)
+        checks.append((name, field.required, check))
+    checks = tuple(checks)
+
+    def validate(data, prefix=""):
+        if not isinstance(data, dict):
+            return [f"{prefix.rstrip('.') or 'body'}: must be an object"]
+        errors = []
+        for name, required, check in checks:
+            if name in data:
+                check(data[name], errors, prefix)
+            elif required:
+                errors.append(f"{prefix}{name}: is required")
+        return errors
+    return validate
@@ -0,0 +1,140 @@
+"""
+Write-Behind Buffer
+
+Accumulates count increments in memory and hands them to a flush function in
+batches, either every interval seconds or as soon as max_pending keys are
+waiting. Increments that are being flushed stay visible through pending()
+until the flush function returns, so readers can add them to what they read
+from the database. outstanding() also says how many flushes are still to
+come, which is how many more versions a versioned record will go through.
+
+A flush function that writes in several transactions raises PartialFlushError
+with the increments it did not write, so only those are buffered again.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class PartialFlushError(Exception):
+    """Raised by a flush function that wrote some of the increments before failing"""
+
+    def __init__(self, message, remaining):
+        super().__init__(message)
+        self.remaining = remaining
+
+
+class WriteBehindBuffer:
+    """Buffers increments per key until a background thread flushes them"""
+
+    def __init__(self, flush_function, interval: float = 0.5, max_pending: int = 500):
+        self.flush_function = flush_function
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = None
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        """True while the flush thread is accepting increments"""
+        return self._thread is not None
+
+    def start(self, app):
+        """Starts the background flush thread"""
+        if self.running:
+            return
+        self.app = app
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        logger.info("Write-behind buffer flushing every %ss", self.interval)
+
+    def stop(self):
+        """Stops the flush thread and writes everything still buffered"""
+        if not self.running:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def after_fork(self):
+        """Restarts the flush thread in a forked child, which inherits no threads"""
+        # the parent still owns whatever it had buffered
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.start(self.app)
+
+    def add(self, key, delta: int) -> int:
+        """Buffers an increment and returns the total not yet in the database"""
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + delta
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+            return self._pending[key] + self._flushing.get(key, 0)
+
+    def pending(self, key) -> int:
+        """Returns the increments of key that are not yet in the database"""
+        with self._lock:
+            return self._pending.get(key, 0) + self._flushing.get(key, 0)
+
+    def outstanding(self, key) -> tuple:
+        """
+        Returns the increments of key that are not yet in the database and how many flushes will write them
+
+        A flush writes all the increments of a key at once, so that is one
+        while they wait and two while more arrive during a flush of earlier ones.
+        """
+        with self._lock:
+            flushes = (key in self._pending) + (key in self._flushing)
+            return self._pending.get(key, 0) + self._flushing.get(key, 0), flushes
+
+    def flush(self) -> int:
+        """Writes the buffered increments and returns how many keys were written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+            try:
+                with self.app.app_context():
+                    self.flush_function(dict(self._flushing))
+            except PartialFlushError as error:
+                # what was committed stays committed, only buffer the rest again
+                logger.exception("Write-behind flush failed, keeping %d keys", len(error.remaining))
+                return len(self._flushing) - self._requeue(error.remaining)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Write-behind flush failed, keeping %d keys", len(self._flushing))
+                self._requeue(self._flushing)
+                return 0
+            with self._lock:
+                flushed = len(self._flushing)
+                self._flushing = {}
+            return flushed
+
+    def _requeue(self, deltas) -> int:
+        """Buffers increments that were not written again, returns how many keys"""
+        with self._lock:
+            for key, delta in deltas.items():
+                self._pending[key] = self._pending.get(key, 0) + delta
+            self._flushing = {}
+        return len(deltas)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
@@ -2,6 +2,7 @@
 Global Configuration for Application
 """
 import os
+import tempfile
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -12,5 +13,151 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Where shopcarts and items are kept: "sql" (the database) or "memory" (dicts
+# in this process, for local load tests). Idempotency keys, the change feed,
+# delta sync, shopcart documents and write-behind need the database, and
+# their requests get 501 Not Implemented with "memory".
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sql")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Comma separated database URIs of the shopcart shards. Leave empty to keep
+# every shopcart in the default database.
+SHARD_DATABASE_URIS = [
+    uri for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri
+]
+
+# Seconds a stored Idempotency-Key response is replayed before it expires
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+# Request profiling: "off", "header" (only requests whose X-Profile header
+# holds PROFILE_SECRET, needs one) or "all". Reports go to a ring of the
+# PROFILE_RING_SIZE newest files, shared by the workers.
+PROFILING = os.getenv("PROFILING", "off")
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "shopcart-profiles"))
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+
+# Log SQL statements slower than SLOW_QUERY_THRESHOLD_MS and keep the last
+# SLOW_QUERY_RING_SIZE for GET /admin/slow-queries. A SLOW_QUERY_EXPLAIN_RATE
+# share (0 to 1) of the slow SELECTs also gets its EXPLAIN (ANALYZE, BUFFERS).
+# Off by default since the entries hold bound parameters; like every /admin
+# endpoint, /admin/slow-queries needs PROFILE_SECRET in X-Admin-Secret.
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "false").lower() == "true"
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0"))
+SLOW_QUERY_RING_SIZE = int(os.getenv("SLOW_QUERY_RING_SIZE", "100"))
+
+# Trace TRACING_SAMPLE_RATE (0 to 1) of the requests that do not carry a
+# sampled W3C traceparent: a span per request, SQL statement and serialize()
+# of shopcarts with TRACING_SERIALIZE_MIN_ITEMS items or more. The last
+# TRACING_RING_SIZE spans are kept for GET /admin/traces and, when
+# TRACING_FILE is set, appended to it as JSON lines
+TRACING = os.getenv("TRACING", "false").lower() == "true"
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1"))
+TRACING_RING_SIZE = int(os.getenv("TRACING_RING_SIZE", "1000"))
+TRACING_FILE = os.getenv("TRACING_FILE", "")
+TRACING_SERIALIZE_MIN_ITEMS = int(os.getenv("TRACING_SERIALIZE_MIN_ITEMS", "100"))
+
+# Fail database work at once for CIRCUIT_BREAKER_RESET_TIMEOUT seconds after
+# CIRCUIT_BREAKER_FAILURES consecutive connection failures. Meanwhile the read
+# routes answer from the last STALE_CACHE_SIZE shopcarts and items they read,
+# if read at most STALE_MAX_AGE seconds ago, with an X-Stale header
+CIRCUIT_BREAKER = os.getenv("CIRCUIT_BREAKER", "true").lower() == "true"
+CIRCUIT_BREAKER_FAILURES = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "5"))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", "10"))
+STALE_CACHE_SIZE = int(os.getenv("STALE_CACHE_SIZE", "10000"))
+STALE_MAX_AGE = float(os.getenv("STALE_MAX_AGE", "300"))
+
+# Largest number of ids accepted by GET /shopcarts?ids=
+MULTI_GET_MAX_IDS = int(os.getenv("MULTI_GET_MAX_IDS", "100"))
+
+# Let concurrent GETs of the same shopcart or item share one database read
+SINGLE_FLIGHT_READS = os.getenv("SINGLE_FLIGHT_READS", "true").lower() == "true"
+
+# Buffer count increments of existing items in memory and write them in
+# batches every WRITE_BEHIND_INTERVAL seconds or once WRITE_BEHIND_MAX_PENDING
+# items are waiting
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.5"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "500"))
+
+# Change feed: most changes per response, longest long-poll or event stream
+# in seconds, and how long outbox rows are kept
+CHANGES_MAX_LIMIT = int(os.getenv("CHANGES_MAX_LIMIT", "1000"))
+# A long-poll or stream holds a worker thread, and a sync gunicorn worker is
+# killed once a request outlives GUNICORN_TIMEOUT, so the wait stays 5 seconds
+# under it (see gunicorn.conf.py)
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", "25"))
+_worker_timeout = float(os.getenv("GUNICORN_TIMEOUT", "30"))
+if _worker_timeout > 0:
+    CHANGES_MAX_WAIT = min(CHANGES_MAX_WAIT, max(0.0, _worker_timeout - 5))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+CHANGES_RETENTION = int(os.getenv("CHANGES_RETENTION", str(7 * 86400)))
+
+# How long in seconds the tombstones of deleted items are kept for delta sync.
+# Clients that last synced before then have to sync again from ?since=0
+TOMBSTONE_RETENTION = int(os.getenv("TOMBSTONE_RETENTION", str(7 * 86400)))
+
+# Create the item table hash partitioned by shopcart_id into ITEM_PARTITIONS
+# tables on PostgreSQL (0 for one plain table). Only applies when the table
+# does not exist yet
+ITEM_PARTITIONS = int(os.getenv("ITEM_PARTITIONS", "0"))
+
+# flask carts-archive moves shopcarts unchanged for ARCHIVE_AFTER_DAYS days to
+# the archive tables, ARCHIVE_CHUNK_SIZE shopcarts per transaction
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_CHUNK_SIZE = int(os.getenv("ARCHIVE_CHUNK_SIZE", "500"))
+
+# Also keep every shopcart with its items as one JSON document (JSONB on
+# PostgreSQL), rewritten by each commit that changes the cart, so that GET
+# /shopcarts/{id} is a single primary key fetch sending the stored bytes.
+# Makes writes rebuild the whole document; carts written before it was on
+# are read from their rows until flask carts-documents fills them in
+CART_DOCUMENTS = os.getenv("CART_DOCUMENTS", "false").lower() == "true"
+
+# Items updated per transaction by PUT /products/{product_id}/price
+REPRICE_CHUNK_SIZE = int(os.getenv("REPRICE_CHUNK_SIZE", "1000"))
+
+# Compress responses of at least COMPRESSION_MIN_SIZE bytes with brotli (when
+# installed) or gzip, as the client's Accept-Encoding allows
+COMPRESSION = os.getenv("COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# Largest request body in bytes, rejected from its Content-Length before it is
+# read, and most items a shopcart may hold
+MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", str(1024 * 1024)))
+MAX_ITEMS_PER_CART = int(os.getenv("MAX_ITEMS_PER_CART", "1000"))
+
+# Number of proxies in front of the app that append to X-Forwarded-For. The
+# client address is then read from it, and the rate limits key on the
+# RATE_LIMIT_KEY_HEADER header the proxy sets (0 trusts no header)
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+
+# Token bucket rate limits per client (the client address, or the
+# RATE_LIMIT_KEY_HEADER header behind TRUSTED_PROXIES) on the routes that
+# declare one. RATE_LIMITS overrides them as "endpoint=rate:burst,...".
+# RATE_LIMIT_STORAGE is "memory" or a redis:// URL to share the buckets
+# between workers
+RATE_LIMITING = os.getenv("RATE_LIMITING", "false").lower() == "true"
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+RATE_LIMIT_STORAGE = os.getenv("RATE_LIMIT_STORAGE", "memory")
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-Client-Id")
+
+# Answer 503 instead of queueing once MAX_CONCURRENT_REQUESTS (0 for no limit)
+# are in flight, or a database connection took over POOL_WAIT_THRESHOLD
+# seconds to get in the last POOL_WAIT_WINDOW seconds
+LOAD_SHEDDING = os.getenv("LOAD_SHEDDING", "false").lower() == "true"
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "0"))
+POOL_WAIT_THRESHOLD = float(os.getenv("POOL_WAIT_THRESHOLD", "0.5"))
+POOL_WAIT_WINDOW = float(os.getenv("POOL_WAIT_WINDOW", "1"))
+
+# Seconds the readiness probe reuses its SELECT 1 result, the share of a
+# connection pool in use at which the worker reports itself not ready, and
+# the seconds a probe waits for the SELECT 1 before reporting no answer
+HEALTH_CHECK_TTL = float(os.getenv("HEALTH_CHECK_TTL", "2"))
+HEALTH_MAX_POOL_SATURATION = float(os.getenv("HEALTH_MAX_POOL_SATURATION", "0.9"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "1"))
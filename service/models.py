@@ -3,17 +3,34 @@ Models for Shopcart
 
 All of the models are stored in this module
 """
+import json
 import logging
-from datetime import date
+import threading
+from datetime import date, datetime, timedelta
 from abc import abstractmethod
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, event, insert, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Session, deferred, object_session, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from service.common.circuit_breaker import CircuitBreaker
+from service.common.sharding import ShardRouter, restrict_ids
+from service.common.tracing import tracer
+from service.common.write_behind import PartialFlushError
+from service.common.validation import INTEGER, NUMBER, STRING, Field, ListOf, compile_schema
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Routes shopcarts to their shard when SHARD_DATABASE_URIS is configured
+shards = ShardRouter()
+
+# Fails database work fast while the database keeps being unreachable
+breaker = CircuitBreaker()
+
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Shopcart.init_db(app)
@@ -21,6 +38,21 @@ def init_db(app):
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or [message]
+
+class VersionConflictError(Exception):
+    """Used when a record was changed by another request since the version a client read"""
+
+    def __init__(self, message, version=None):
+        super().__init__(message)
+        self.version = version
+
+
+class VersionRequiredError(Exception):
+    """Used when an update does not say which version of a record it was read at"""
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
@@ -53,8 +85,48 @@ class PersistentBase:
     def delete(self):
         """Removes an object from the data store"""
         logger.info("Deleting %s", self.__class__.__name__)
-        db.session.delete(self)
-        db.session.commit()
+        session = self.session()
+        session.delete(self)
+        self.commit_versioned(session)
+
+    @classmethod
+    def validate(cls, data):
+        """Raises a DataValidationError listing every field error of a dictionary"""
+        errors = cls.validator(data)
+        if errors:
+            raise DataValidationError(f"Invalid {cls.__name__}: " + "; ".join(errors), errors)
+
+    def session(self):
+        """Returns the session that owns this object"""
+        return object_session(self) or db.session
+
+    def check_version(self, data):
+        """Raises VersionConflictError when data holds a version other than the stored one, VersionRequiredError when none"""
+        version = data.get("version")
+        if version is None:
+            raise VersionRequiredError(f"Updating {self.__class__.__name__} {self.id} needs the version it was read at")
+        if version != self.version:
+            raise VersionConflictError(
+                f"{self.__class__.__name__} {self.id} is at version {self.version}, not {version}", self.version
+            )
+
+    @staticmethod
+    def commit(session):
+        """Commits the session, or only flushes it while a caller holds its transaction open"""
+        if session.info.get("hold_commit"):
+            session.flush()
+        else:
+            session.commit()
+
+    def commit_versioned(self, session=None):
+        """Commits the session, raising VersionConflictError when another request changed this record first"""
+        session = session or self.session()
+        try:
+            self.commit(session)
+        except StaleDataError as error:
+            # the UPDATE or DELETE matched no row at the version this record was read at
+            session.rollback()
+            raise VersionConflictError(f"{self.__class__.__name__} {self.id} was changed by another request") from error
 
     @classmethod
     def init_db(cls, app: Flask):
@@ -66,21 +138,65 @@ class PersistentBase:
         """
         logger.info("Initializing database")
         cls.app = app
+        Shopcart.compile_validator(app.config.get("MAX_ITEMS_PER_CART", Shopcart.MAX_ITEMS))
+        Shopcart.TRACE_MIN_ITEMS = app.config.get("TRACING_SERIALIZE_MIN_ITEMS", Shopcart.TRACE_MIN_ITEMS)
+        Shopcart.DOCUMENTS = app.config.get("CART_DOCUMENTS", False)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
+        if app.config.get("STORAGE_BACKEND", "sql") == "memory":
+            # the routes keep shopcarts and items in a MemoryRepository
+            shards.reset()
+            return
+        partitions = app.config.get("ITEM_PARTITIONS", 0)
+        storage.create_partitioned_items(db.engine, partitions)
         db.create_all()  # make our sqlalchemy tables
+        shard_uris = app.config.get("SHARD_DATABASE_URIS", [])
+        if shard_uris:
+            logger.info("Initializing %d shards", len(shard_uris))
+            shards.init_uris(shard_uris)
+            for shard, engine in enumerate(shards.engines):
+                storage.create_partitioned_items(engine, partitions)
+                db.metadata.create_all(engine)
+                with engine.begin() as conn:
+                    first, last = shards.id_range(shard)
+                    restrict_ids(conn, Shopcart.__table__, first, last, storage.shopcart_archive)
+                    restrict_ids(conn, Item.__table__, first, last, storage.item_archive)
+            if shards.remove not in app.teardown_appcontext_funcs:
+                app.teardown_appcontext(shards.remove)
+        else:
+            shards.reset()
+        if app.config.get("CIRCUIT_BREAKER", True):
+            breaker.failure_threshold = app.config.get("CIRCUIT_BREAKER_FAILURES", breaker.failure_threshold)
+            breaker.reset_timeout = app.config.get("CIRCUIT_BREAKER_RESET_TIMEOUT", breaker.reset_timeout)
+            breaker.reset()
+            # one breaker for every engine: the shards share the database servers
+            for engine in [db.engine] + shards.engines:
+                breaker.watch(engine)
 
     @classmethod
     def all(cls):
         """Returns all of the records in the database"""
         logger.info("Processing all records")
-        return cls.query.all()
+        if shards.enabled:
+            # scatter the query to every shard and gather the rows by id
+            records = []
+            for session in shards.sessions():
+                records.extend(session.query(cls).options(*cls.load_options()).all())
+            return sorted(records, key=lambda record: record.id)
+        return cls.query.options(*cls.load_options()).all()
+
+    @classmethod
+    def load_options(cls):
+        """Returns the loader options applied when listing all records"""
+        return []
 
     @classmethod
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
+        if shards.enabled:
+            return shards.session(shards.shard_for_id(by_id)).get(cls, by_id)
         return cls.query.get(by_id)
 
 
@@ -98,6 +214,17 @@ class Item(db.Model,PersistentBase):
 
     app = None
 
+    # Request Schema
+    validator = staticmethod(compile_schema({
+        "id": Field(INTEGER, required=False, nullable=True),
+        "shopcart_id": Field(INTEGER, nullable=True),
+        "product_id": Field(INTEGER, minimum=0),
+        "name": Field(STRING, nullable=True, max_length=64),
+        "price": Field(NUMBER, minimum=0),
+        "count": Field(INTEGER, minimum=1),
+        "version": Field(INTEGER, required=False, nullable=True),
+    }))
+
     # Table Schema
     id = db.Column(db.Integer, primary_key =  True)
     shopcart_id = db.Column(db.Integer, db.ForeignKey("shopcart.id"))
@@ -105,6 +232,20 @@ class Item(db.Model,PersistentBase):
     name = db.Column(db.String(64)) # only for better test,a redundant column
     price = db.Column(db.Float, nullable = False)
     count = db.Column(db.Integer, nullable = False)
+    # sync_stamp() of the item's last change, used by delta sync
+    sync_version = db.Column(db.BigInteger, nullable = False, default = 0)
+    updated_at = db.Column(db.DateTime, default = datetime.utcnow, onupdate = datetime.utcnow)
+    # bumped by every update, which only applies to the version it was read at
+    version = db.Column(db.Integer, nullable = False)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    __table_args__ = (
+        db.Index("ix_item_shopcart_sync_version", "shopcart_id", "sync_version"),
+        db.Index("ix_item_product_id", "product_id", "id"),
+        # never reuse the id of an archived item
+        {"sqlite_autoincrement": True},
+    )
     
     def __repr__(self):
         return f"<Item [{self.id}]: shopcart=[{self.shopcart_id}] product=[{self.product_id}]>"
@@ -113,14 +254,30 @@ class Item(db.Model,PersistentBase):
         """Create an item to the database"""
         self.id = None
         logger.info("Creating item for shopcart %s, product %s", self.shopcart_id, self.product_id)
-        db.session.add(self)
-        db.session.commit()
+        session = db.session
+        if shards.enabled:
+            # items live on the shard of the shopcart they belong to, which
+            # hands out their ids from its own range
+            session = shards.session(shards.shard_for_id(self.shopcart_id or self.shopcart.id))
+        session.add(self)
+        self.commit(session)
     
     def update(self):
         """Update an item to the database"""
         logger.info("Updating item for shopcart %s, product %s", self.shopcart_id, self.product_id)
-        db.session.commit()
-    
+        self.commit_versioned()
+
+    @classmethod
+    def find(cls, by_id):
+        """Finds an item by id, bringing its shopcart back from the archive when it was archived"""
+        item = super().find(by_id)
+        if item is None:
+            shopcart_id = storage.archived_shopcart_of_item(by_id)
+            if shopcart_id is not None and storage.restore([shopcart_id]):
+                item = super().find(by_id)
+        return item
+
+
     def serialize(self):
         """Converts an Product into a dictionary"""
         item = {
@@ -129,7 +286,8 @@ class Item(db.Model,PersistentBase):
             "product_id":self.product_id,
             "name": self.name,
             "price": self.price,
-            "count":self.count
+            "count":self.count,
+            "version": self.version,
         }
         return item
 
@@ -140,27 +298,159 @@ class Item(db.Model,PersistentBase):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            self.id = data["id"]
-            self.name = data["name"]
-            self.shopcart_id = data["shopcart_id"]
-            self.product_id = data["product_id"]
-            self.price = data["price"]
-            self.count = data["count"]
-        except KeyError as error:
-            raise DataValidationError("Invalid Item: missing " + error.args[0]) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Item: body of request contained "
-                "bad or no data - " + error.args[0]
-            ) from error
+        self.validate(data)
+        return self.populate(data)
+
+    def populate(self, data):
+        """Populates an Item from a dictionary that was already validated"""
+        self.id = data.get("id")
+        self.name = data["name"]
+        self.shopcart_id = data["shopcart_id"]
+        self.product_id = data["product_id"]
+        self.price = data["price"]
+        self.count = data["count"]
         return self
     
     @classmethod
     def find_by_shopcart_and_product(cls, shopcart, product):
         """Return item with given shopcart id and product id"""
         logger.info("Processing item id query for %s and %s ...", shopcart, product)
-        return cls.query.filter(cls.shopcart_id == shopcart, cls.product_id == product).first()
+        return cls.query_for_shopcart(shopcart).filter(
+            cls.shopcart_id == shopcart, cls.product_id == product
+        ).first()
+
+    @classmethod
+    def add_counts(cls, deltas):
+        """
+        Adds count increments to many items with one batched UPDATE per database
+
+        Each database commits on its own. When one fails after others were
+        committed, PartialFlushError carries the increments that were not.
+
+        Args:
+            deltas (dict): increments keyed by (shopcart id, product id)
+        """
+        logger.info("Adding buffered counts to %d items ...", len(deltas))
+        table = cls.__table__
+        statement = (
+            update(table)
+            .where(table.c.shopcart_id == bindparam("s_id"), table.c.product_id == bindparam("p_id"))
+            .values(count=table.c.count + bindparam("delta"), version=table.c.version + 1)
+        )
+        batches = {}
+        for (shopcart, product), delta in deltas.items():
+            session = cls.query_for_shopcart(shopcart).session
+            batches.setdefault(session, []).append({"s_id": shopcart, "p_id": product, "delta": delta})
+        remaining = dict(deltas)
+        for session, params in batches.items():
+            try:
+                cls._add_counts(session, statement, params)
+            except Exception as error:
+                session.rollback()
+                if len(remaining) == len(deltas):
+                    raise  # nothing was committed
+                raise PartialFlushError(f"Adding counts failed: {error}", remaining) from error
+            for param in params:
+                del remaining[(param["s_id"], param["p_id"])]
+
+    @classmethod
+    def _add_counts(cls, session, statement, params):
+        session.execute(statement.values(sync_version=sync_stamp(session)), params)
+        pairs = [(param["s_id"], param["p_id"]) for param in params]
+        updated = (
+            session.query(cls)
+            .filter(tuple_(cls.shopcart_id, cls.product_id).in_(pairs))
+            .populate_existing()
+            .all()
+        )
+        CartChange.record(session, "update", updated)
+        touch_shopcarts(session, [param["s_id"] for param in params])
+        session.commit()
+
+    @classmethod
+    def find_by_product(cls, product, after=0, limit=100):
+        """Return up to limit items holding a product, ordered by id and starting after an id"""
+        logger.info("Processing item query for product %s after %s ...", product, after)
+        sessions = shards.sessions() if shards.enabled else [db.session]
+        items = []
+        for session in sessions:
+            items.extend(
+                session.query(cls)
+                .filter(cls.product_id == product, cls.id > after)
+                .order_by(cls.id)
+                .limit(limit)
+                .all()
+            )
+        return sorted(items, key=lambda item: item.id)[:limit]
+
+    @classmethod
+    def reprice(cls, product, price, chunk_size=1000):
+        """
+        Sets the price of every item holding a product
+
+        Rows are updated with set-based UPDATEs of at most chunk_size items,
+        each chunk in its own transaction, and only rows whose price differs
+        are touched. Returns the number of items changed.
+        """
+        logger.info("Repricing product %s to %s ...", product, price)
+        table = cls.__table__
+        sessions = shards.sessions() if shards.enabled else [db.session]
+        changed = 0
+        for session in sessions:
+            last_id = 0
+            while True:
+                rows = session.execute(
+                    select(table.c.id)
+                    .where(table.c.product_id == product, table.c.price != price, table.c.id > last_id)
+                    .order_by(table.c.id)
+                    .limit(chunk_size)
+                ).all()
+                if not rows:
+                    break
+                ids = [row.id for row in rows]
+                last_id = ids[-1]
+                result = session.execute(
+                    update(table)
+                    .where(table.c.id.in_(ids))
+                    .values(price=price, sync_version=sync_stamp(session), version=table.c.version + 1)
+                )
+                changed += result.rowcount
+                updated = session.query(cls).filter(cls.id.in_(ids)).populate_existing().all()
+                CartChange.record(session, "update", updated)
+                touch_shopcarts(session, [item.shopcart_id for item in updated])
+                session.commit()
+        logger.info("Repriced %d items of product %s", changed, product)
+        return changed
+
+    @classmethod
+    def changed_since(cls, shopcart, version, until):
+        """Return the items of a shopcart created or updated after a sync version, up to until"""
+        logger.info("Processing item changes of shopcart %s since version %s ...", shopcart, version)
+        return cls.query_for_shopcart(shopcart).filter(
+            cls.shopcart_id == shopcart, cls.sync_version > version, cls.sync_version <= until
+        ).order_by(cls.sync_version, cls.id).all()
+
+    @classmethod
+    def sync_watermark(cls, shopcart):
+        """
+        Returns the sync version up to which the changes of a shopcart's database can be read
+
+        Every change stamped at or below it is committed or rolled back, so a
+        client that synced up to it never misses one that commits later.
+        """
+        session = cls.query_for_shopcart(shopcart).session
+        if session.get_bind().dialect.name == "postgresql":
+            # transactions from the oldest one still running on may yet commit
+            xmin = db.func.txid_snapshot_xmin(db.func.txid_current_snapshot())
+            return session.execute(select(xmin - 1)).scalar()
+        return session.execute(select(sync_clock.c.version)).scalar() or 0
+
+    @classmethod
+    def query_for_shopcart(cls, shopcart):
+        """Return a query on the database that holds the given shopcart id"""
+        if shards.enabled:
+            return shards.session(shards.shard_for_id(shopcart)).query(cls)
+        return cls.query
 
     '''
     @classmethod
@@ -173,10 +463,17 @@ class Item(db.Model,PersistentBase):
     @classmethod
     def delete_all_by_shopcart(cls, shopcart):
         """Delete all items with given shopcart id"""
-        q = cls.query.filter(cls.shopcart_id == shopcart).all()
-        logger.info("Deleting %d item for shopcart %s ...", len(q), shopcart)
-        cls.query.filter(cls.shopcart_id == shopcart).delete()
-        db.session.commit()
+        query = cls.query_for_shopcart(shopcart).filter(cls.shopcart_id == shopcart)
+        items = query.all()
+        logger.info("Deleting %d item for shopcart %s ...", len(items), shopcart)
+        CartChange.record(query.session, "delete", items)
+        if items:
+            version = sync_stamp(query.session)
+            query.session.add_all(
+                ItemTombstone(shopcart_id=shopcart, item_id=item.id, sync_version=version) for item in items
+            )
+        query.delete()
+        query.session.commit()
 
 ######################################################################
 #  S H O P C A R T  M O D E L
@@ -187,30 +484,79 @@ class Shopcart(db.Model,PersistentBase):
     """
     app = None
 
+    # Request Schema, compiled with its items by compile_validator()
+    MAX_ITEMS = 1000
+    FIELDS = {
+        "id": Field(INTEGER, required=False, nullable=True),
+        "customer_id": Field(INTEGER, minimum=0),
+        "version": Field(INTEGER, required=False, nullable=True),
+    }
+
+    # Shopcarts with at least this many items get a span for serialize()
+    TRACE_MIN_ITEMS = 100
+
+    # Keep the document column in sync on commit, set from CART_DOCUMENTS
+    DOCUMENTS = False
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, nullable=False)
+    # last change to the shopcart or its items, carts idle for long get archived
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # the shopcart and its items as serialize() returns them, rewritten by every
+    # commit that changes them while DOCUMENTS is on. Deferred, only
+    # storage.find_document() reads it
+    document = deferred(db.Column(db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql")))
+    # bumped by every update, which only applies to the version it was read at
+    version = db.Column(db.Integer, nullable=False)
     items = db.relationship("Item", backref = "shopcart", passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # never reuse the id of an archived shopcart
+    __table_args__ = {"sqlite_autoincrement": True}
+
     def __repr__(self):
         return f"<Shopcart {self.id} customer=[{self.customer_id}]>"
 
+    @classmethod
+    def load_options(cls):
+        """Loads the items of every listed shopcart in one extra query instead of one per shopcart"""
+        return [selectinload(cls.items)]
+
     def create(self):
         """Create an shopcart to the database"""
         self.id = None
+        for item in self.items:
+            # new rows, the database hands out their ids
+            item.id = None
         logger.info("Creating shopcart %s", self.id)
-        db.session.add(self)
-        db.session.commit()
+        session = db.session
+        if shards.enabled:
+            session = shards.session(shards.shard_for_customer(self.customer_id))
+        session.add(self)
+        self.commit(session)
     
     def update(self):
         """Update an shopcart to the database"""
         logger.info("Updating shopcart %s",self.id)
-        db.session.commit()
+        # an update that only appends items leaves the row clean, which would
+        # skip the UPDATE and with it the version check and bump
+        self.updated_at = datetime.utcnow()
+        self.commit_versioned()
 
     def serialize(self):
         """Converts an Shopcart into a dictionary"""
+        if tracer.current_span() is not None and len(self.items) >= self.TRACE_MIN_ITEMS:
+            with tracer.span("Shopcart.serialize", shopcart_id=self.id, items=len(self.items)):
+                return self._serialize()
+        return self._serialize()
+
+    def _serialize(self):
         shopcart = {
             "id": self.id,
             "customer_id": self.customer_id,
+            "version": self.version,
             "items": []
         }
         for item in self.items:
@@ -224,28 +570,443 @@ class Shopcart(db.Model,PersistentBase):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            self.id = data["id"]
-            self.customer_id = data["customer_id"]
-            items_list = data.get("items")
-            for json_item in items_list:
-                item = Item()
-                item.deserialize(json_item)
-                self.items.append(item)
-        except KeyError as error:
-            raise DataValidationError("Invalid Shopcart: missing " + error.args[0]) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Item: body of request contained "
-                "bad or no data - " + error.args[0]
-            ) from error
+        self.validate(data)
+        self.id = data.get("id")
+        self.customer_id = data["customer_id"]
+        for json_item in data["items"]:
+            item = Item().populate(json_item)
+            item.id = None  # appended as a new row, which gets its id from the database
+            self.items.append(item)
         return self
+
+    @classmethod
+    def compile_validator(cls, max_items):
+        """Compiles the request schema of a shopcart holding at most max_items items"""
+        cls.validator = staticmethod(compile_schema(dict(cls.FIELDS, items=ListOf(Item.validator, max_items))))
     
+    @classmethod
+    def find(cls, by_id):
+        """Finds a shopcart by id, bringing it back from the archive when it was archived"""
+        shopcart = super().find(by_id)
+        if shopcart is None and storage.restore([by_id]):
+            shopcart = super().find(by_id)
+        return shopcart
+
+    @classmethod
+    def count_items(cls, by_id):
+        """Returns how many items a shopcart holds with one query, None when it is not in the hot table"""
+        logger.info("Processing item count for shopcart %s ...", by_id)
+        carts = cls.__table__
+        items = Item.__table__
+        return Item.query_for_shopcart(by_id).session.execute(
+            select(db.func.count(items.c.id))
+            .select_from(carts.outerjoin(items))
+            .where(carts.c.id == by_id)
+            .group_by(carts.c.id)
+        ).scalar()
+
+    @classmethod
+    def find_many(cls, ids):
+        """
+        Finds many shopcarts and their items with one IN-list query per table
+
+        Returns a list in the order of ids holding None for every id that was not found
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        shopcarts = cls._find_many(ids)
+        missing = [by_id for by_id, shopcart in zip(ids, shopcarts) if shopcart is None]
+        if missing and storage.restore(missing):
+            shopcarts = cls._find_many(ids)
+        return shopcarts
+
+    @classmethod
+    def _find_many(cls, ids):
+        if shards.enabled:
+            queries = {}
+            for by_id in ids:
+                queries.setdefault(shards.shard_for_id(by_id), set()).add(by_id)
+            queries = [
+                shards.session(shard).query(cls).filter(cls.id.in_(shard_ids))
+                for shard, shard_ids in queries.items()
+            ]
+        else:
+            queries = [cls.query.filter(cls.id.in_(set(ids)))] if ids else []
+        found = {}
+        for query in queries:
+            for shopcart in query.options(*cls.load_options()).all():
+                found[shopcart.id] = shopcart
+        return [found.get(by_id) for by_id in ids]
+
     @classmethod
     def find_by_customer_id(cls, c_id):
         """Return shopcart with given customer id"""
         logger.info("Processing shopcart id query for customer %s ...", c_id)
+        if shards.enabled:
+            return shards.session(shards.shard_for_customer(c_id)).query(cls).filter(cls.customer_id == c_id)
         return cls.query.filter(cls.customer_id == c_id)
 
+Shopcart.compile_validator(Shopcart.MAX_ITEMS)
+
+######################################################################
+#  I T E M   T O M B S T O N E   M O D E L
+######################################################################
+class ItemTombstone(db.Model):
+    """
+    Class that remembers a deleted Item so that delta sync can report it
+    """
+
+    __tablename__ = "item_tombstone"
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    shopcart_id = db.Column(db.Integer, nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    sync_version = db.Column(db.BigInteger, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_item_tombstone_shopcart_sync_version", "shopcart_id", "sync_version"),)
+
+    def __repr__(self):
+        return f"<ItemTombstone item=[{self.item_id}] shopcart=[{self.shopcart_id}] version=[{self.sync_version}]>"
+
+    @classmethod
+    def deleted_since(cls, shopcart, version, until):
+        """Return the ids of the items of a shopcart deleted after a sync version, up to until"""
+        query = shards.session(shards.shard_for_id(shopcart)).query(cls) if shards.enabled else cls.query
+        tombstones = query.filter(cls.shopcart_id == shopcart, cls.sync_version > version, cls.sync_version <= until)
+        return [tombstone.item_id for tombstone in tombstones.order_by(cls.sync_version, cls.id)]
+
+    @classmethod
+    def remove_older_than(cls, seconds: int) -> int:
+        """Deletes the tombstones older than seconds and returns how many were removed"""
+        cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+        sessions = shards.sessions() if shards.enabled else [db.session]
+        removed = 0
+        for session in sessions:
+            removed += session.query(cls).filter(cls.deleted_at < cutoff).delete()
+            session.commit()
+        logger.info("Removed %d item tombstones", removed)
+        return removed
+
+
+# The SQLite sync stamp, bumped once per write transaction (see sync_stamp)
+sync_clock = db.Table(
+    "sync_clock",
+    db.Column("id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("version", db.BigInteger, nullable=False),
+)
+
+
+def sync_stamp(session):
+    """
+    Returns the sync version the item writes of the session's transaction are stamped with
+
+    On PostgreSQL it is the transaction id, so writers to the same shopcart
+    never wait for each other; Item.sync_watermark() holds back the stamps
+    of transactions still running. SQLite lets one writer in at a time, so
+    a counter row bumped once per transaction is as cheap and never reused.
+    """
+    connection = session.connection()
+    if connection.dialect.name == "postgresql":
+        return db.func.txid_current()
+    stamp = session.info.get("sync_stamp")
+    if stamp is None:
+        stamp = connection.execute(
+            update(sync_clock).values(version=sync_clock.c.version + 1).returning(sync_clock.c.version)
+        ).scalar()
+        if stamp is None:
+            stamp = 1
+            connection.execute(insert(sync_clock).values(id=1, version=stamp))
+        session.info["sync_stamp"] = stamp
+    return stamp
+
+
+@event.listens_for(Session, "after_transaction_end")
+def forget_sync_stamp(session, transaction):
+    """Drops the cached sync stamp when the session's transaction ends"""
+    if transaction.parent is None:
+        session.info.pop("sync_stamp", None)
+
+
+def touch_shopcarts(session, ids):
+    """Sets updated_at of the shopcarts whose items changed, so archive_inactive() leaves them alone"""
+    ids = {by_id for by_id in ids if by_id is not None}
+    if ids:
+        table = Shopcart.__table__
+        session.connection().execute(update(table).where(table.c.id.in_(ids)).values(updated_at=datetime.utcnow()))
+
+
+@event.listens_for(Session, "before_flush")
+def stamp_sync_versions(session, flush_context, instances):  # pylint: disable=unused-argument
+    """
+    Stamps the Items a flush changes, and tombstones of the ones it deletes, for delta sync
+
+    Their shopcarts are touched too: an item write is activity of its shopcart.
+    """
+    changed = [r for r in session.new if isinstance(r, Item)]
+    changed += [r for r in session.dirty if isinstance(r, Item) and session.is_modified(r, include_collections=False)]
+    deleted = [r for r in session.deleted if isinstance(r, Item)]
+    if not changed and not deleted:
+        return
+    stamp = sync_stamp(session)
+    for item in changed:
+        item.sync_version = stamp
+    for item in deleted:
+        session.add(ItemTombstone(shopcart_id=item.shopcart_id, item_id=item.id, sync_version=stamp))
+    # a shopcart this flush inserts or updates gets its updated_at already
+    flushed = {r.id for r in session.new | session.dirty if isinstance(r, Shopcart)}
+    touch_shopcarts(session, [item.shopcart_id for item in changed + deleted if item.shopcart_id not in flushed])
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """
+    Class that remembers the response of a POST sent with an Idempotency-Key
+    header so that a retry of the same request can be answered without
+    running the write again
+
+    Keys are scoped by the client that sent them, so two clients picking the
+    same key never see each other's responses. A table created before the
+    client column existed needs migrating:
+
+        DELETE FROM idempotency_key;
+        ALTER TABLE idempotency_key ADD COLUMN client VARCHAR(255) NOT NULL;
+        ALTER TABLE idempotency_key DROP CONSTRAINT idempotency_key_pkey;
+        ALTER TABLE idempotency_key ADD PRIMARY KEY (client, key);
+    """
+
+    # Table Schema
+    client = db.Column(db.String(255), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    location = db.Column(db.String(2048))
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} client=[{self.client}] status=[{self.status_code}]>"
 
-   
\ No newline at end of file
+    def expired(self, ttl: int) -> bool:
+        """True when the key is older than ttl seconds"""
+        return self.created_at < datetime.utcnow() - timedelta(seconds=ttl)
+
+    def delete(self):
+        """Releases the key so that the request can be run again"""
+        logger.info("Releasing idempotency key %s", self.key)
+        session = object_session(self) or db.session
+        session.delete(self)
+        session.commit()
+
+    @classmethod
+    def find(cls, client, key, session=None):
+        """Finds the idempotency key a client stored, on the database of session"""
+        return (session or db.session).get(cls, (client, key))
+
+    @classmethod
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def add(cls, client, key, request_hash, status_code, body, location=None, session=None):
+        """
+        Stores the response of a request in the current transaction of session
+
+        Committed together with the request's write, so the key exists exactly
+        when the write does; session must be the one holding the write, which
+        with SHARDS is the session of the shard written to. A concurrent
+        request holding the same key fails on the primary key when it commits.
+        """
+        logger.info("Storing response %s for idempotency key %s", status_code, key)
+        record = cls(
+            client=client, key=key, request_hash=request_hash, status_code=status_code, body=body, location=location
+        )
+        (session or db.session).add(record)
+        return record
+
+    @classmethod
+    def remove_expired(cls, ttl: int) -> int:
+        """Deletes the keys older than ttl seconds and returns how many were removed"""
+        cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+        removed = 0
+        # keys are stored next to the writes they answer for, on every shard
+        for session in shards.sessions() if shards.enabled else [db.session]:
+            removed += session.query(cls).filter(cls.created_at < cutoff).delete()
+            session.commit()
+        logger.info("Removed %d expired idempotency keys", removed)
+        return removed
+
+
+######################################################################
+#  C A R T   C H A N G E   O U T B O X
+######################################################################
+# Notified after every commit that may have written cart changes
+changes_published = threading.Condition()
+
+
+class CartChange(db.Model):
+    """
+    Class that represents one create, update or delete of a Shopcart or Item
+
+    Rows are written in the same transaction as the change itself, so the
+    feed never shows a change that was rolled back. Transactions commit out
+    of seq order, so readers page by (txid, seq) and only see the changes of
+    transactions older than the oldest one still running (see since()).
+    """
+
+    __tablename__ = "cart_change"
+
+    # Table Schema
+    seq = db.Column(db.Integer, primary_key=True)
+    # PostgreSQL transaction id of the writer; 0 on SQLite, which commits one
+    # writer at a time in seq order
+    txid = db.Column(db.BigInteger, nullable=False, default=0)
+    op = db.Column(db.String(8), nullable=False)
+    type = db.Column(db.String(8), nullable=False)
+    record_id = db.Column(db.Integer)
+    shopcart_id = db.Column(db.Integer)
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (db.Index("ix_cart_change_txid_seq", "txid", "seq"),)
+
+    def __repr__(self):
+        return f"<CartChange {self.seq} {self.op} {self.type}=[{self.record_id}]>"
+
+    def serialize(self):
+        """Converts a CartChange into a dictionary"""
+        return {
+            "seq": self.seq,
+            "op": self.op,
+            "type": self.type,
+            "id": self.record_id,
+            "shopcart_id": self.shopcart_id,
+            "data": json.loads(self.data) if self.data else None,
+        }
+
+    @staticmethod
+    def row_for(op, record):
+        """Returns the outbox row describing a change of a Shopcart or Item"""
+        if isinstance(record, Shopcart):
+            data = {"id": record.id, "customer_id": record.customer_id}
+            row = {"type": "shopcart", "record_id": record.id, "shopcart_id": record.id}
+        else:
+            data = record.serialize()
+            row = {"type": "item", "record_id": record.id, "shopcart_id": record.shopcart_id}
+        row["op"] = op
+        row["data"] = None if op == "delete" else json.dumps(data)
+        return row
+
+    @classmethod
+    def record(cls, session, op, records):
+        """Writes outbox rows for records in the session's current transaction"""
+        rows = [cls.row_for(op, record) for record in records]
+        if rows:
+            connection = session.connection()
+            statement = insert(cls.__table__)
+            if connection.dialect.name == "postgresql":
+                statement = statement.values(txid=db.func.txid_current())
+            connection.execute(statement, rows)
+            if Shopcart.DOCUMENTS:
+                # every write of a cart goes through the outbox, so it also
+                # knows which documents refresh_cart_documents() must rewrite
+                session.info.setdefault("changed_documents", set()).update(row["shopcart_id"] for row in rows)
+
+    @classmethod
+    def since(cls, position, limit, session=None):
+        """
+        Returns up to limit changes after a position in the order they were committed
+
+        A position is the (txid, seq) of the last change read, or a bare seq.
+        On PostgreSQL only the changes of transactions older than the oldest
+        one still running are returned: those can no longer be joined by a
+        change that commits later with a lower position, so a reader that
+        moves past a change never skips one committed after it.
+        """
+        session = session if session is not None else db.session
+        return session.scalars(cls.since_statement(position, limit, session.get_bind().dialect.name)).all()
+
+    @classmethod
+    def since_statement(cls, position, limit, dialect):
+        """Returns the SELECT of since() for a database dialect"""
+        txid, seq = position if isinstance(position, tuple) else (None, position)
+        statement = select(cls)
+        if txid is None:
+            statement = statement.where(cls.seq > seq)
+        else:
+            statement = statement.where(or_(cls.txid > txid, and_(cls.txid == txid, cls.seq > seq)))
+        if dialect == "postgresql":
+            statement = statement.where(cls.txid < db.func.txid_snapshot_xmin(db.func.txid_current_snapshot()))
+        return statement.order_by(cls.txid, cls.seq).limit(limit)
+
+    @classmethod
+    def after(cls, cursor, limit):
+        """
+        Returns the changes made after a cursor
+
+        The cursor holds the position of the last change read from each
+        database (one per shard). Returns a list of (cursor after the change,
+        serialized change).
+        """
+        sessions = shards.sessions() if shards.enabled else [db.session]
+        positions = list(cursor)
+        changes = []
+        for index, session in enumerate(sessions):
+            for change in cls.since(positions[index], limit, session):
+                positions[index] = (change.txid, change.seq)
+                changes.append((list(positions), change.serialize()))
+            # end the read so that the next poll sees newly committed changes
+            session.rollback()
+        return changes
+
+    @classmethod
+    def remove_older_than(cls, seconds: int) -> int:
+        """Deletes the changes older than seconds and returns how many were removed"""
+        cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+        sessions = shards.sessions() if shards.enabled else [db.session]
+        removed = 0
+        for session in sessions:
+            removed += session.query(cls).filter(cls.created_at < cutoff).delete()
+            session.commit()
+        logger.info("Removed %d cart changes", removed)
+        return removed
+
+
+@event.listens_for(Session, "after_flush")
+def record_cart_changes(session, flush_context):  # pylint: disable=unused-argument
+    """Writes the outbox rows of the Shopcarts and Items a flush changed"""
+    changes = [
+        ("create", session.new),
+        ("update", [r for r in session.dirty if session.is_modified(r, include_collections=False)]),
+        ("delete", session.deleted),
+    ]
+    for op, records in changes:
+        CartChange.record(session, op, [r for r in records if isinstance(r, (Shopcart, Item))])
+
+
+@event.listens_for(Session, "before_commit")
+def refresh_cart_documents(session):
+    """Rewrites the documents of the shopcarts changed by the transaction being committed"""
+    if not Shopcart.DOCUMENTS:
+        return
+    session.flush()
+    changed = session.info.pop("changed_documents", None)
+    if changed:
+        storage.refresh_documents(session, changed - {None})
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_documents(session):
+    """Drops the shopcarts a rolled back transaction changed, their documents stay as they are"""
+    session.info.pop("changed_documents", None)
+
+
+@event.listens_for(Session, "after_commit")
+def publish_cart_changes(session):  # pylint: disable=unused-argument
+    """Wakes the requests waiting for new changes"""
+    with changes_published:
+        changes_published.notify_all()
+
+
+# The archive, partition and document helpers use the models above
+# pylint: disable=wrong-import-position, cyclic-import
+from service import storage  # noqa: E402
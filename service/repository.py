@@ -0,0 +1,345 @@
+"""
+Shopcart Repositories
+
+The routes keep and find shopcarts and items through a repository, so that
+where they are stored is decided in one place. SqlRepository keeps them in
+the database with the models. MemoryRepository keeps them in a MemoryStore
+in this process when STORAGE_BACKEND is "memory"; it hands out model objects
+that are built from its records and not stored anywhere, and does every read,
+version check and write of one call under the store's lock.
+
+Features that only the database has (the change feed, delta sync, stored
+documents, Idempotency-Key and write-behind) are named in features, and the
+routes refuse them when supports() says the repository lacks them.
+"""
+import logging
+from abc import abstractmethod
+from service.common.memory_store import MemoryStore
+from service.models import DataValidationError, Item, Shopcart
+from service.storage import restore
+
+logger = logging.getLogger("flask.app")
+
+
+def repository_for(backend):
+    """Returns the repository of the STORAGE_BACKEND setting"""
+    if backend == "memory":
+        logger.info("Keeping shopcarts and items in memory")
+        return MemoryRepository()
+    return SqlRepository()
+
+
+def check_room(shopcart_id, held, added, max_items):
+    """Raises DataValidationError when a shopcart holding held items has no room for added more"""
+    if held + added > max_items:
+        raise DataValidationError(f"Shopcart '{shopcart_id}' can hold at most {max_items} items, it holds {held}")
+
+
+######################################################################
+#  R E P O S I T O R Y   I N T E R F A C E
+######################################################################
+class Repository:
+    """Keeps and finds shopcarts and their items"""
+
+    # names of the features beyond keeping shopcarts and items
+    features = frozenset()
+
+    def supports(self, feature) -> bool:
+        """Returns True when the repository has a feature"""
+        return feature in self.features
+
+    @abstractmethod
+    def all_shopcarts(self) -> list:
+        """Returns every shopcart ordered by id"""
+
+    @abstractmethod
+    def find_shopcart(self, shopcart_id):
+        """Returns a shopcart with its items, or None"""
+
+    @abstractmethod
+    def find_shopcarts(self, ids) -> list:
+        """Returns the shopcarts in the order of ids, holding None for every id not found"""
+
+    @abstractmethod
+    def find_by_customer_id(self, customer_id) -> list:
+        """Returns the shopcarts of a customer ordered by id"""
+
+    @abstractmethod
+    def create_shopcart(self, data):
+        """Creates a shopcart and its items from a dictionary and returns it"""
+
+    @abstractmethod
+    def update_shopcart(self, shopcart_id, data, max_items):
+        """
+        Updates a shopcart from a dictionary, adding the items it holds, and returns it
+
+        Returns None when there is no such shopcart, raises VersionConflictError
+        when data holds another version than the stored one, VersionRequiredError
+        when it holds none and DataValidationError when the shopcart would hold
+        more than max_items.
+        """
+
+    @abstractmethod
+    def delete_shopcart(self, shopcart_id) -> None:
+        """Deletes a shopcart and its items, when there is one"""
+
+    @abstractmethod
+    def find_item(self, item_id):
+        """Returns an item, or None"""
+
+    @abstractmethod
+    def find_item_by_product(self, shopcart_id, product_id):
+        """Returns the item of a shopcart holding a product, or None"""
+
+    @abstractmethod
+    def add_item(self, shopcart_id, data, max_items):
+        """
+        Adds an item to a shopcart from a dictionary and returns it
+
+        The count is added to the item already holding the product when there
+        is one. Returns None when there is no such shopcart and raises
+        DataValidationError when a new item would make more than max_items.
+        """
+
+    @abstractmethod
+    def update_item(self, shopcart_id, item_id, data):
+        """
+        Updates an item of a shopcart from a dictionary and returns it
+
+        Returns None when the shopcart holds no such item, raises
+        VersionConflictError when data holds another version than the stored
+        one and VersionRequiredError when it holds none.
+        """
+
+    @abstractmethod
+    def delete_item(self, shopcart_id, item_id) -> None:
+        """Deletes an item of a shopcart, when it holds one"""
+
+    @abstractmethod
+    def find_items_by_product(self, product_id, after, limit) -> list:
+        """Returns up to limit items holding a product, ordered by id and starting after an id"""
+
+    @abstractmethod
+    def reprice(self, product_id, price, chunk_size) -> int:
+        """Sets the price of every item holding a product, returns how many were changed"""
+
+
+######################################################################
+#  S Q L   R E P O S I T O R Y
+######################################################################
+class SqlRepository(Repository):
+    """Keeps shopcarts and items in the database"""
+
+    features = frozenset(["changes", "sync", "documents", "idempotency", "write_behind"])
+
+    def all_shopcarts(self):
+        return Shopcart.all()
+
+    def find_shopcart(self, shopcart_id):
+        return Shopcart.find(shopcart_id)
+
+    def find_shopcarts(self, ids):
+        return Shopcart.find_many(ids)
+
+    def find_by_customer_id(self, customer_id):
+        return Shopcart.find_by_customer_id(customer_id).order_by(Shopcart.id).all()
+
+    def create_shopcart(self, data):
+        shopcart = Shopcart()
+        shopcart.deserialize(data)
+        shopcart.create()
+        return shopcart
+
+    def update_shopcart(self, shopcart_id, data, max_items):
+        shopcart = Shopcart.find(shopcart_id)
+        if not shopcart:
+            return None
+        # update from the dictionary, unless it was read from an older version
+        shopcart.check_version(data)
+        check_room(shopcart_id, len(shopcart.items), len(data["items"]), max_items)
+        shopcart.deserialize(data)
+        shopcart.id = shopcart_id
+        shopcart.update()
+        return shopcart
+
+    def delete_shopcart(self, shopcart_id):
+        shopcart = Shopcart.find(shopcart_id)
+        if shopcart:
+            shopcart.delete()
+
+    def find_item(self, item_id):
+        return Item.find(item_id)
+
+    def find_item_by_product(self, shopcart_id, product_id):
+        return Item.find_by_shopcart_and_product(shopcart_id, product_id)
+
+    def add_item(self, shopcart_id, data, max_items):
+        # without loading the shopcart or its items: an indexed lookup of the
+        # product, and a count of the items only when it is a new one
+        item = Item.find_by_shopcart_and_product(shopcart_id, data["product_id"])
+        if item:
+            logger.info("Item [%s] existed: product id %s, count %s.", item.id, item.product_id, item.count)
+            item.count = item.count + data["count"]
+            item.update()
+            return item
+        held = Shopcart.count_items(shopcart_id)
+        if held is None:
+            # the shopcart and the product may both be in the archive
+            return self.add_item(shopcart_id, data, max_items) if restore([shopcart_id]) else None
+        check_room(shopcart_id, held, 1, max_items)
+        item = Item().deserialize(data)
+        item.shopcart_id = shopcart_id
+        item.create()
+        return item
+
+    def update_item(self, shopcart_id, item_id, data):
+        item = Item.find(item_id)
+        if not item or item.shopcart_id != shopcart_id:
+            return None
+        # update from the dictionary, unless it was read from an older version
+        item.check_version(data)
+        item.deserialize(data)
+        item.id = item_id
+        item.update()
+        return item
+
+    def delete_item(self, shopcart_id, item_id):
+        item = Item.find(item_id)
+        if item and item.shopcart_id == shopcart_id:
+            item.delete()
+
+    def find_items_by_product(self, product_id, after, limit):
+        return Item.find_by_product(product_id, after, limit)
+
+    def reprice(self, product_id, price, chunk_size):
+        return Item.reprice(product_id, price, chunk_size)
+
+
+######################################################################
+#  M E M O R Y   R E P O S I T O R Y
+######################################################################
+class MemoryRepository(Repository):
+    """
+    Keeps shopcarts and items as records in a MemoryStore
+
+    The records are the dictionaries serialize() returns, without the items
+    of a shopcart. The model objects returned are new ones built from them,
+    so a caller changing one changes nothing stored.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or MemoryStore()
+        self.store.index("shopcart", "customer_id", lambda record: record["customer_id"])
+        self.store.index("item", "shopcart_id", lambda record: record["shopcart_id"])
+        self.store.index("item", "shopcart_product", lambda record: (record["shopcart_id"], record["product_id"]))
+        self.store.index("item", "product_id", lambda record: record["product_id"])
+
+    def all_shopcarts(self):
+        with self.store.lock:
+            return [self._shopcart(record) for record in self.store.all("shopcart")]
+
+    def find_shopcart(self, shopcart_id):
+        with self.store.lock:
+            record = self.store.get("shopcart", shopcart_id)
+            return self._shopcart(record) if record else None
+
+    def find_shopcarts(self, ids):
+        with self.store.lock:
+            return [self.find_shopcart(shopcart_id) for shopcart_id in ids]
+
+    def find_by_customer_id(self, customer_id):
+        with self.store.lock:
+            return [self._shopcart(record) for record in self.store.lookup("shopcart", "customer_id", customer_id)]
+
+    def create_shopcart(self, data):
+        shopcart = Shopcart().deserialize(data)
+        with self.store.lock:
+            record = {"id": self.store.next_id("shopcart"), "customer_id": shopcart.customer_id, "version": 1}
+            self.store.add("shopcart", record)
+            self._add_items(record["id"], shopcart.items)
+            return self._shopcart(record)
+
+    def update_shopcart(self, shopcart_id, data, max_items):
+        shopcart = Shopcart().deserialize(data)
+        with self.store.lock:
+            record = self.store.get("shopcart", shopcart_id)
+            if not record:
+                return None
+            Shopcart(**record).check_version(data)
+            held = len(self.store.lookup("item", "shopcart_id", shopcart_id))
+            check_room(shopcart_id, held, len(shopcart.items), max_items)
+            record.update(customer_id=shopcart.customer_id, version=record["version"] + 1)
+            self.store.add("shopcart", record)
+            self._add_items(shopcart_id, shopcart.items)
+            return self._shopcart(record)
+
+    def delete_shopcart(self, shopcart_id):
+        with self.store.lock:
+            for item in self.store.lookup("item", "shopcart_id", shopcart_id):
+                self.store.remove("item", item["id"])
+            self.store.remove("shopcart", shopcart_id)
+
+    def find_item(self, item_id):
+        record = self.store.get("item", item_id)
+        return Item(**record) if record else None
+
+    def find_item_by_product(self, shopcart_id, product_id):
+        found = self.store.lookup("item", "shopcart_product", (shopcart_id, product_id))
+        return Item(**found[0]) if found else None
+
+    def add_item(self, shopcart_id, data, max_items):
+        item = Item().deserialize(data)
+        with self.store.lock:
+            if not self.store.get("shopcart", shopcart_id):
+                return None
+            found = self.store.lookup("item", "shopcart_product", (shopcart_id, item.product_id))
+            if found:
+                record = found[0]
+                record.update(count=record["count"] + item.count, version=record["version"] + 1)
+                self.store.add("item", record)
+                return Item(**record)
+            check_room(shopcart_id, len(self.store.lookup("item", "shopcart_id", shopcart_id)), 1, max_items)
+            return Item(**self._add_items(shopcart_id, [item])[0])
+
+    def update_item(self, shopcart_id, item_id, data):
+        item = Item().deserialize(data)
+        with self.store.lock:
+            record = self.store.get("item", item_id)
+            if not record or record["shopcart_id"] != shopcart_id:
+                return None
+            Item(**record).check_version(data)
+            record.update(dict(item.serialize(), id=item_id, version=record["version"] + 1))
+            self.store.add("item", record)
+            return Item(**record)
+
+    def delete_item(self, shopcart_id, item_id):
+        with self.store.lock:
+            record = self.store.get("item", item_id)
+            if record and record["shopcart_id"] == shopcart_id:
+                self.store.remove("item", item_id)
+
+    def find_items_by_product(self, product_id, after, limit):
+        records = self.store.lookup("item", "product_id", product_id)
+        return [Item(**record) for record in records if record["id"] > after][:limit]
+
+    def reprice(self, product_id, price, chunk_size):
+        changed = 0
+        with self.store.lock:
+            for record in self.store.lookup("item", "product_id", product_id):
+                if record["price"] != price:
+                    record.update(price=price, version=record["version"] + 1)
+                    self.store.add("item", record)
+                    changed += 1
+        return changed
+
+    def _add_items(self, shopcart_id, items):
+        records = []
+        for item in items:
+            record = dict(item.serialize(), id=self.store.next_id("item"), shopcart_id=shopcart_id, version=1)
+            self.store.add("item", record)
+            records.append(record)
+        return records
+
+    def _shopcart(self, record):
+        items = [Item(**item) for item in self.store.lookup("item", "shopcart_id", record["id"])]
+        return Shopcart(**record, items=items)
@@ -4,8 +4,11 @@ My Service
 Paths:
 ------
 GET /shopcarts - Return a list of all shopcarts
+GET /shopcarts?ids=1,2,3 - Return the shopcarts with the given ids
+GET /shopcarts/changes?since={cursor} - Return the shopcart and item changes after the cursor
 GET /shopcarts/{shopcart_id} - Return the shopcart with a given id
 GET /shopcarts/{shopcart_id}/items - Return all items of a shopcart
+GET /shopcarts/{shopcart_id}/items?since={version} - Return the items changed and deleted after version
 GET /shopcarts/{shopcart_id}/items/{item_id} - Return a item of a shopcart
 POST /shopcarts - create a new shopcart in the database
 POST /shopcarts/{shopcart_id}/items - create a new item of a shopcart in the database
@@ -13,11 +16,55 @@ DELETE /shopcarts/{shopcart_id} - Delete the shopcart with a given id
 DELETE /shopcarts/{shopcart_id}/items/{item_id} - Delete a item of a shopcart
 PUT /shopcarts/{shopcart_id} - Update the shopcart with a given id
 PUT /shopcarts/{shopcart_id}/items/{item_id} - Update a item of a shopcart
+GET /items?product_id={product_id} - Return the items of every shopcart holding a product
+PUT /products/{product_id}/price - Set the price of every item holding a product
+GET /health/live - Return 200 while the worker answers
+GET /health/ready - Return 200 while the database answers and the pools have room, else 503
+GET /admin/singleflight - Return how many reads were shared between requests
+GET /admin/limits - Return how many requests were rate limited and shed
+GET /admin/slow-queries - Return the last slow SQL statements and their plans
+GET /admin/traces?trace_id={trace_id} - Return the last finished spans, of one trace or of all
+GET /admin/breaker - Return the state of the database circuit breaker
+
+The /admin paths answer 403 Forbidden unless the X-Admin-Secret header holds
+PROFILE_SECRET, and always when no secret is set.
+
+While the database is unreachable the GETs of a shopcart, its items or an item
+answer with the last value this worker read, marked with an X-Stale header.
+
+POST requests may carry an Idempotency-Key header: a retry with the same key
+and body replays the stored response instead of writing again.
+
+The PUTs of a shopcart or an item only apply to the version they were read
+at, given as the version field of the body or as an If-Match: "<version>"
+header. Without either they are refused with 428 Precondition Required.
 """
 
-from flask import Flask, jsonify, request, url_for, make_response, abort
-from service.common import status  # HTTP Status Codes
-from service.models import Shopcart, Item 
+import hashlib
+import hmac
+import json
+import time
+from functools import wraps
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+from service.common import media, status  # HTTP Status Codes
+from service.common.circuit_breaker import CircuitOpenError, is_outage
+from service.common.health import HealthCheck
+from service.common.load_shedding import LoadShedder
+from service.common.rate_limit import RateLimiter
+from service.common.singleflight import SingleFlight
+from service.common.slow_queries import SlowQueryLog
+from service.common.stale_cache import StaleCache
+from service.common.tracing import MemoryExporter
+from service.common.validation import NUMBER, Field, compile_schema
+from service.common.write_behind import WriteBehindBuffer
+from service.models import (
+    Shopcart, Item, IdempotencyKey, CartChange, ItemTombstone, DataValidationError, VersionConflictError, breaker,
+    changes_published, db, shards
+)
+from service.repository import SqlRepository
+from service.storage import find_document
 import logging
 
 # Import Flask application
@@ -25,6 +72,37 @@ from . import app
 
 
 logger = logging.getLogger("flask.app")
+
+# Keeps the shopcarts and items, a MemoryRepository when STORAGE_BACKEND is "memory"
+repository = SqlRepository()
+
+# Shares one in-flight database read between concurrent identical GETs
+reads = SingleFlight()
+
+# Buffers "add one more" count increments when WRITE_BEHIND is turned on
+increments = WriteBehindBuffer(Item.add_counts)
+
+# Token buckets per client of the routes decorated with limiter.limit()
+limiter = RateLimiter()
+
+# Turns requests away while the database pool is saturated
+shedder = LoadShedder()
+
+# Database checks of the readiness probe, the engines are set by init
+health = HealthCheck()
+
+# The last SQL statements slower than SLOW_QUERY_THRESHOLD_MS
+slow_queries = SlowQueryLog()
+
+# The last finished spans of this process when TRACING is turned on
+traces = MemoryExporter()
+
+# The last shopcarts and items read, served marked stale while the database is unreachable
+last_known = StaleCache()
+
+# Body of PUT /products/{product_id}/price
+validate_price = compile_schema({"price": Field(NUMBER, minimum=0)})
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -36,6 +114,286 @@ def index():
         status.HTTP_200_OK,
     )
 
+######################################################################
+#  H E A L T H   C H E C K S
+######################################################################
+@app.route("/health/live", methods=["GET"])
+def liveness():
+    """Returns 200 as long as the worker can answer at all"""
+    return jsonify(status="alive"), status.HTTP_200_OK
+
+
+@app.route("/health/ready", methods=["GET"])
+def readiness():
+    """Returns 200 when the worker can serve traffic, 503 with the reason when not"""
+    ready, report = health.ready()
+    code = status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(report), code, {"Cache-Control": "no-store"}
+
+######################################################################
+#  A D M I N   E N D P O I N T S
+######################################################################
+ADMIN_HEADER = "X-Admin-Secret"
+
+
+def admin_only(function):
+    """Refuses requests that do not hold PROFILE_SECRET in their X-Admin-Secret header"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        secret = app.config.get("PROFILE_SECRET", "")
+        given = request.headers.get(ADMIN_HEADER, "")
+        if not secret or not hmac.compare_digest(given.encode(), secret.encode()):
+            abort(status.HTTP_403_FORBIDDEN, f"The admin endpoints need the PROFILE_SECRET in the {ADMIN_HEADER} header")
+        return function(*args, **kwargs)
+    return wrapper
+
+######################################################################
+#  I D E M P O T E N T   P O S T S
+######################################################################
+def idempotent(function):
+    """Replays the stored response of a POST retried with the same Idempotency-Key"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return function(*args, **kwargs)
+        require("idempotency", "Idempotency-Key")
+
+        digest = hashlib.sha256()
+        # the negotiated media type is hashed too, so a replay has the type the client asked for
+        media_type = media.negotiate(request.accept_mimetypes)
+        for part in (request.method.encode(), request.path.encode(), media_type.encode(), request.get_data()):
+            digest.update(part)
+            digest.update(b"\0")
+        request_hash = digest.hexdigest()
+
+        # keys are scoped by client, so clients picking the same key never share a response
+        client = RateLimiter.client()
+        session = idempotency_session()
+        record = IdempotencyKey.find(client, key, session)
+        if record and record.expired(app.config["IDEMPOTENCY_KEY_TTL"]):
+            record.delete()
+            record = None
+        if record is None:
+            return _run_idempotent(session, client, key, request_hash, media_type, function, *args, **kwargs)
+        return _replay(record, request_hash, media_type)
+    return wrapper
+
+
+def idempotency_session():
+    """
+    Returns the session the POST writes to, which keeps its Idempotency-Key too
+
+    With SHARDS the write goes to the shard of its shopcart, or of its
+    customer for a new shopcart. Storing the key there commits both in one
+    transaction. A body without a usable customer_id is refused before
+    anything is written.
+    """
+    if not shards.enabled:
+        return db.session
+    if "shopcart_id" in request.view_args:
+        return shards.session(shards.shard_for_id(request.view_args["shopcart_id"]))
+    try:
+        body = read_body()
+    except HTTPException:
+        return db.session
+    customer_id = body.get("customer_id") if isinstance(body, dict) else None
+    if not isinstance(customer_id, int) or isinstance(customer_id, bool):
+        return db.session
+    return shards.session(shards.shard_for_customer(customer_id))
+
+
+# pylint: disable-next=too-many-arguments,too-many-positional-arguments
+def _run_idempotent(session, client, key, request_hash, media_type, function, *args, **kwargs):
+    """
+    Runs the request and stores its response under key in the write's transaction
+
+    The models only flush while the request runs, so the write and its key
+    are committed together: a worker that dies before the commit leaves
+    neither behind. When a concurrent request with the same key commits
+    first, this one's write is rolled back and the stored response replayed.
+    """
+    session.info["hold_commit"] = True
+    try:
+        response = make_response(function(*args, **kwargs))
+        # failed requests are not remembered so the client may retry them
+        if response.status_code < 400:
+            IdempotencyKey.add(
+                client, key, request_hash, response.status_code, response.get_data(), response.headers.get("Location"),
+                session=session,
+            )
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return _replay_or_retry(session, client, key, request_hash, media_type)
+    except VersionConflictError:
+        # a duplicate updating the same item first makes this one's UPDATE stale
+        session.rollback()
+        return _replay_or_retry(session, client, key, request_hash, media_type)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop("hold_commit", None)
+    return response
+
+
+def _replay_or_retry(session, client, key, request_hash, media_type):
+    """Replays the response a concurrent request stored under key, or asks the client to retry"""
+    record = IdempotencyKey.find(client, key, session)
+    if record is not None:
+        return _replay(record, request_hash, media_type)
+    # the other request has not committed its key yet, or failed
+    message = f"Idempotency-Key '{key}' is held by a request still in flight, retry it"
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+        {"Retry-After": "1"},
+    )
+
+
+def _replay(record, request_hash, media_type):
+    """Returns the stored response of a key, if it was stored for the same request"""
+    if record.request_hash != request_hash:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"Idempotency-Key '{record.key}' was already used for a different request",
+        )
+    logger.info("Replaying response for Idempotency-Key %s", record.key)
+    headers = {"Idempotent-Replayed": "true"}
+    if record.location:
+        headers["Location"] = record.location
+    return app.response_class(record.body, status=record.status_code, headers=headers, mimetype=media_type)
+
+######################################################################
+#  S I N G L E   F L I G H T   R E A D S
+######################################################################
+def read_once(key, function):
+    """Runs a read, or joins the identical read another request has in flight"""
+    if not app.config["SINGLE_FLIGHT_READS"]:
+        return function()
+    return reads.do(key, function)
+
+
+def serialize_or_none(record):
+    """Serializes a record found by a read, None when it was not found"""
+    return record.serialize() if record else None
+
+
+######################################################################
+#  S T A L E   R E A D S
+######################################################################
+def read_or_stale(key, function):
+    """
+    Runs a read through read_once and remembers its result
+
+    While the database is unreachable it returns the last known result
+    instead, with the headers that mark it stale. Returns the result and the
+    extra response headers.
+    """
+    try:
+        value = read_once(key, function)
+    except (CircuitOpenError, SQLAlchemyError) as error:
+        stale = last_known.get(key) if isinstance(error, CircuitOpenError) or is_outage(error) else None
+        if stale is None:
+            raise
+        value, age = stale
+        logger.warning("Serving %s read %.1fs ago: %s", key, age, error)
+        return value, {"X-Stale": "true", "Age": str(int(age))}
+    if value is None:
+        last_known.discard(key)
+    else:
+        last_known.put(key, value)
+    return value, None
+
+
+@app.after_request
+def forget_changed_reads(response):
+    """Drops the last known shopcart and item a write changed"""
+    if request.method in ("GET", "HEAD") or not request.view_args:
+        return response
+    if "product_id" in request.view_args:
+        # a reprice touches items of any shopcart
+        last_known.clear()
+    last_known.discard(
+        ("shopcart", request.view_args.get("shopcart_id")),
+        ("document", request.view_args.get("shopcart_id")),
+        ("item", request.view_args.get("item_id")),
+    )
+    return response
+
+
+@app.route("/admin/breaker", methods=["GET"])
+@admin_only
+def breaker_stats():
+    """Returns the state of the database circuit breaker"""
+    return jsonify(breaker.stats()), status.HTTP_200_OK
+
+
+######################################################################
+#  W R I T E - B E H I N D   C O U N T S
+######################################################################
+def with_pending_count(item):
+    """
+    Adds the buffered count increments of a serialized item, with the version they will give it
+
+    Each flush of the increments bumps the version once, so a PUT naming the
+    version read here matches it after flush_pending_counts().
+    """
+    if not increments.running:
+        return item
+    pending, flushes = increments.outstanding((item["shopcart_id"], item["product_id"]))
+    if not flushes:
+        return item
+    return dict(item, count=item["count"] + pending, version=item["version"] + flushes)
+
+
+def with_pending_counts(shopcart):
+    """Adds the buffered count increments to the items of a serialized shopcart"""
+    if not increments.running:
+        return shopcart
+    return dict(shopcart, items=[with_pending_count(item) for item in shopcart["items"]])
+
+
+def flush_pending_counts():
+    """Writes the buffered increments before a write that replaces counts"""
+    if increments.running:
+        increments.flush()
+
+
+@app.route("/admin/singleflight", methods=["GET"])
+@admin_only
+def single_flight_stats():
+    """Returns how many reads ran and how many requests shared one"""
+    return jsonify(reads.stats()), status.HTTP_200_OK
+
+
+@app.route("/admin/limits", methods=["GET"])
+@admin_only
+def limit_stats():
+    """Returns the requests each rate limit allowed and limited, and the requests shed"""
+    return jsonify(rate_limits=limiter.stats(), load_shedding=shedder.stats()), status.HTTP_200_OK
+
+
+@app.route("/admin/slow-queries", methods=["GET"])
+@admin_only
+def slow_query_list():
+    """Returns the last slow SQL statements, newest first"""
+    return jsonify(
+        threshold_ms=slow_queries.threshold * 1000,
+        explain_rate=slow_queries.explain_rate,
+        queries=slow_queries.recent(),
+    ), status.HTTP_200_OK
+
+
+@app.route("/admin/traces", methods=["GET"])
+@admin_only
+def trace_list():
+    """Returns the last finished spans, oldest first"""
+    return jsonify(spans=traces.traces(request.args.get("trace_id"))), status.HTTP_200_OK
+
 # ---------------------------------------------------------------------
 #               S H O P C A R T   M E T H O D S
 # ---------------------------------------------------------------------
@@ -44,15 +402,137 @@ def index():
 #  LIST ALL SHOPCART
 ######################################################################
 @app.route("/shopcarts",methods = ['GET'])
+@limiter.limit(rate=5, burst=10)
 def list_all_shopcarts():
     """Returns all of the shopcarts"""
+    if "ids" in request.args:
+        return get_many_shopcarts(request.args["ids"])
     app.logger.info("Request for shopcart list")
-    shopcarts = []
-    shopcarts = Shopcart.all()
+    shopcarts = repository.all_shopcarts()
 
-    results = [s.serialize() for s in shopcarts]
+    results = [with_pending_counts(s.serialize()) for s in shopcarts]
     app.logger.info("Return %d shopcarts", len(results))
-    return jsonify(results), status.HTTP_200_OK
+    return respond(results, status.HTTP_200_OK)
+
+def get_many_shopcarts(ids_arg):
+    """Returns the shopcarts named in a comma separated list of ids"""
+    try:
+        ids = list(dict.fromkeys(int(by_id) for by_id in ids_arg.split(",") if by_id.strip()))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"ids must be a comma separated list of integers: '{ids_arg}'")
+    if any(not 0 < by_id < 2**31 for by_id in ids):
+        # the id column is a 32-bit integer, PostgreSQL refuses anything outside it
+        abort(status.HTTP_400_BAD_REQUEST, f"ids must be between 1 and {2**31 - 1}: '{ids_arg}'")
+    if len(ids) > app.config["MULTI_GET_MAX_IDS"]:
+        abort(status.HTTP_400_BAD_REQUEST, f"At most {app.config['MULTI_GET_MAX_IDS']} ids may be requested")
+    app.logger.info("Request for %d shopcarts by id", len(ids))
+
+    shopcarts = repository.find_shopcarts(ids)
+    results = {
+        "shopcarts": [with_pending_counts(s.serialize()) for s in shopcarts if s],
+        "missing_ids": [by_id for by_id, s in zip(ids, shopcarts) if not s],
+    }
+    app.logger.info("Return %d shopcarts, %d missing", len(results["shopcarts"]), len(results["missing_ids"]))
+    return respond(results, status.HTTP_200_OK)
+
+######################################################################
+#  C H A N G E   F E E D
+######################################################################
+@app.route("/shopcarts/changes", methods=["GET"])
+def list_changes():
+    """
+    Returns the shopcart and item changes made after the since cursor
+
+    wait=<seconds> holds the request open until a change arrives. Clients that
+    accept text/event-stream get the changes as Server-Sent Events instead.
+    """
+    require("changes", "The change feed")
+    cursor = parse_cursor(request.headers.get("Last-Event-ID") or request.args.get("since", ""))
+    limit = parse_number("limit", 100, 1, app.config["CHANGES_MAX_LIMIT"])
+    wait = parse_number("wait", 0, 0, app.config["CHANGES_MAX_WAIT"], float)
+    deadline = time.monotonic() + wait
+    app.logger.info("Request for changes since %s", cursor)
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        return Response(
+            stream_with_context(stream_changes(cursor, limit, deadline)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    changes = CartChange.after(cursor, limit)
+    while not changes and time.monotonic() < deadline:
+        wait_for_changes(deadline)
+        changes = CartChange.after(cursor, limit)
+    if changes:
+        cursor = changes[-1][0]
+    results = {"changes": [change for _, change in changes], "since": format_cursor(cursor)}
+    app.logger.info("Return %d changes", len(results["changes"]))
+    return respond(results, status.HTTP_200_OK)
+
+
+def stream_changes(cursor, limit, deadline):
+    """Yields changes as Server-Sent Events until the deadline passes"""
+    while True:
+        changes = CartChange.after(cursor, limit)
+        for position, change in changes:
+            cursor = position
+            yield f"id: {format_cursor(cursor)}\nevent: change\ndata: {json.dumps(change)}\n\n"
+        if time.monotonic() >= deadline:
+            return
+        if not changes:
+            yield ": waiting\n\n"
+            wait_for_changes(deadline)
+
+
+def wait_for_changes(deadline):
+    """Sleeps until a commit in this process or the next poll interval"""
+    timeout = min(app.config["CHANGES_POLL_INTERVAL"], max(0.0, deadline - time.monotonic()))
+    with changes_published:
+        changes_published.wait(timeout)
+
+
+def parse_cursor(value):
+    """Parses a since cursor: a position, or one position per shard separated by commas"""
+    databases = shards.count if shards.enabled else 1
+    try:
+        cursor = [parse_position(position) for position in str(value).split(",") if position.strip()]
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"since must be a change cursor: '{value}'")
+    if len(cursor) > databases:
+        abort(status.HTTP_400_BAD_REQUEST, f"since must hold at most {databases} positions: '{value}'")
+    return cursor + [0] * (databases - len(cursor))
+
+
+def parse_position(value):
+    """Parses the position in one database: txid.seq, or a bare seq"""
+    if "." not in value:
+        return int(value)
+    txid, seq = value.split(".")
+    return int(txid), int(seq)
+
+
+def format_cursor(cursor):
+    """Formats a cursor the way parse_cursor reads it"""
+    positions = [format_position(position) for position in cursor]
+    return positions[0] if len(positions) == 1 else ",".join(str(position) for position in positions)
+
+
+def format_position(position):
+    """Formats a position, as a bare seq when there is no transaction id (SQLite)"""
+    if not isinstance(position, tuple):
+        return position
+    txid, seq = position
+    return f"{txid}.{seq}" if txid else seq
+
+
+def parse_number(name, default, minimum, maximum, kind=int):
+    """Reads a numeric query parameter and clamps it between minimum and maximum"""
+    try:
+        value = kind(request.args.get(name, default))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"{name} must be a number")
+    return min(max(value, minimum), maximum)
 
 ######################################################################
 #  LIST A SHOPCART
@@ -61,34 +541,41 @@ def list_all_shopcarts():
 def get_shopcarts(shopcart_id):
     """Returns a shopcart by id"""
     app.logger.info("Request for a shopcart with id %s", shopcart_id)
-    shopcart = Shopcart.find(shopcart_id)
+    if Shopcart.DOCUMENTS and repository.supports("documents"):
+        document, headers = read_or_stale(("document", shopcart_id), lambda: find_document(shopcart_id))
+        if document is not None:
+            return respond_document(document, headers)
+        # archived, or written before CART_DOCUMENTS was turned on
+    shopcart, headers = read_or_stale(
+        ("shopcart", shopcart_id), lambda: serialize_or_none(repository.find_shopcart(shopcart_id))
+    )
 
     if not shopcart:
         abort(status.HTTP_404_NOT_FOUND, f"Shopcart with id '{shopcart_id}' was not found")
     
     logger.info("Returning shopcart: %s", shopcart_id)
-    return jsonify(shopcart.serialize()), status.HTTP_200_OK
+    return respond(with_pending_counts(shopcart), status.HTTP_200_OK, headers)
 
 ######################################################################
 #  CREATE A SHOPCART
 ######################################################################
 @app.route("/shopcarts", methods = ["POST"])
+@limiter.limit(rate=10, burst=20)
+@idempotent
 def create_shopcart():
     """ Creates a shopcart
     This endpoint will create a shopcart based the data in the body that is posted
     """
     logger.info("Request to create a shopcart")
-    check_content_type("application/json")
+    check_content_type(*media.MEDIA_TYPES)
 
-    shopcart = Shopcart()
-    shopcart.deserialize(request.get_json())
-    shopcart.create()
+    shopcart = repository.create_shopcart(read_body())
     message = shopcart.serialize()
     location_url = url_for("get_shopcarts", shopcart_id=shopcart.id, _external=True)
 
     logger.info("Shopcart with ID [%s] created.", shopcart.id)
     logger.info("Location: %s", location_url)
-    return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    return respond(message, status.HTTP_201_CREATED, {"Location": location_url})
 
 ######################################################################
 #  UPDATE A SHOPCART
@@ -101,19 +588,19 @@ def update_shopcarts(shopcart_id):
     """
 
     app.logger.info("Request to update shopcart with id %s", shopcart_id)
-    check_content_type("application/json")
+    check_content_type(*media.MEDIA_TYPES)
 
-    #see if the shopcart exists and abort if it doesn't
-    shopcart = Shopcart.find(shopcart_id)
+    body = read_body()
+    Shopcart.validate(body)
+    body = with_if_match(body)
+
+    #update the shopcart unless it was read from an older version, abort if it doesn't exist
+    flush_pending_counts()
+    shopcart = repository.update_shopcart(shopcart_id, body, app.config["MAX_ITEMS_PER_CART"])
     if not shopcart:
         abort(status.HTTP_404_NOT_FOUND, f"Shopcart with id '{shopcart_id}' was not found")
-    
-    #update from the json in the body of the request
-    shopcart.deserialize(request.get_json())
-    shopcart.id = shopcart_id
-    shopcart.update()
 
-    return make_response(jsonify(shopcart.serialize()), status.HTTP_200_OK)
+    return respond(shopcart.serialize(), status.HTTP_200_OK)
 
 @app.route("/shopcarts/<int:shopcart_id>", methods = ["DELETE"])
 def delete_shopcarts(shopcart_id):
@@ -124,9 +611,8 @@ def delete_shopcarts(shopcart_id):
     app.logger.info("Request to delete shopcart with id: %d", shopcart_id)
 
     # Retrieve the account to delete and delete it if it exists
-    shopcart = Shopcart.find(shopcart_id)
-    if shopcart:
-        shopcart.delete()
+    flush_pending_counts()
+    repository.delete_shopcart(shopcart_id)
     
     return make_response("", status.HTTP_204_NO_CONTENT)
 
@@ -140,13 +626,39 @@ def delete_shopcarts(shopcart_id):
 @app.route("/shopcarts/<int:shopcart_id>/items",methods = ['GET'])
 def list_all_items(shopcart_id):
     """Returns all of the items of a shopcart"""
+    if "since" in request.args:
+        return sync_items(shopcart_id, parse_number("since", 0, 0, 2**63 - 1))
     app.logger.info("Request for item list of shopcart: %s", shopcart_id)
+    shopcart, headers = read_or_stale(
+        ("shopcart", shopcart_id), lambda: serialize_or_none(repository.find_shopcart(shopcart_id))
+    )
+    if not shopcart:
+        abort(status.HTTP_404_NOT_FOUND, f"Shopcart with id '{shopcart_id}' was not found")
+
+    results = with_pending_counts(shopcart)["items"]
+    app.logger.info("Return %d items", len(results))
+    return respond(results, status.HTTP_200_OK, headers)
+
+def sync_items(shopcart_id, version):
+    """Returns the items of a shopcart upserted or deleted after a sync version"""
+    app.logger.info("Request for item changes of shopcart %s since version %s", shopcart_id, version)
+    require("sync", "Delta sync")
     shopcart = Shopcart.find(shopcart_id)
-    items = shopcart.items
+    if not shopcart:
+        abort(status.HTTP_404_NOT_FOUND, f"Shopcart with id '{shopcart_id}' was not found")
 
-    results = [s.serialize() for s in items]
-    app.logger.info("Return %d items", len(items))
-    return jsonify(results), status.HTTP_200_OK
+    # changes stamped above the watermark may still be joined by ones that
+    # commit later, so they are left for the next sync
+    watermark = max(version, Item.sync_watermark(shopcart_id))
+    results = {
+        "sync_version": watermark,
+        "upserted": [
+            with_pending_count(item.serialize()) for item in Item.changed_since(shopcart_id, version, watermark)
+        ],
+        "deleted": ItemTombstone.deleted_since(shopcart_id, version, watermark),
+    }
+    app.logger.info("Return %d upserted and %d deleted items", len(results["upserted"]), len(results["deleted"]))
+    return respond(results, status.HTTP_200_OK)
 
 ######################################################################
 #  LIST A ITEM
@@ -155,54 +667,54 @@ def list_all_items(shopcart_id):
 def get_items(shopcart_id, item_id):
     """Returns a item by id"""
     logger.info("Request for a item belong to shopchart %s with id %s", shopcart_id, item_id)
-    item = Item.find(item_id)
+    item, headers = read_or_stale(("item", item_id), lambda: serialize_or_none(repository.find_item(item_id)))
 
     if not item:
         logger.info("Item with id %s was not found", item_id)
         abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found")
-    if not item.shopcart_id or item.shopcart_id!=shopcart_id:
-        logger.info("Item with id %s was not belong to shopcart %s: shopcart %s", item_id,shopcart_id,item.shopcart_id)
+    if not item["shopcart_id"] or item["shopcart_id"]!=shopcart_id:
+        logger.info("Item with id %s was not belong to shopcart %s: shopcart %s", item_id,shopcart_id,item["shopcart_id"])
         abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not belong to shopcart '{shopcart_id}'")
     
     logger.info("Returning item: %s", item_id)
-    return jsonify(item.serialize()), status.HTTP_200_OK
+    return respond(with_pending_count(item), status.HTTP_200_OK, headers)
 
 ######################################################################
 #  CREATE A ITEM
 ######################################################################
 @app.route("/shopcarts/<int:shopcart_id>/items", methods = ["POST"])
+@limiter.limit(rate=50, burst=100)
+@idempotent
 def create_item(shopcart_id):
     """ 
     Creates a item
     This endpoint will create a item based the data in the body that is posted
     """
     logger.info("Request to create a item belong to shopcart %s", shopcart_id)
-    check_content_type("application/json")
-
-    shopcart = Shopcart.find(shopcart_id)
-    if not shopcart:
-        abort(status.HTTP_404_NOT_FOUND,f"Shopcart with id '{shopcart_id}' could not be found.")
+    check_content_type(*media.MEDIA_TYPES)
+    item_json = read_body()
+    Item.validate(item_json)
 
-    item_json = request.get_json()
     logger.info(item_json)
-    item = None
-    old_item = Item.find_by_shopcart_and_product(shopcart_id, item_json["product_id"])
+    old_item = None
+    if increments.running:
+        old_item = repository.find_item_by_product(shopcart_id, item_json["product_id"])
     if old_item:
-        logger.info("Item [%s] existed: product id %s, count %s.", old_item.id, old_item.product_id, old_item.count)
-        old_item.count = old_item.count+item_json["count"]
-        old_item.update()
+        # buffer the increment, the flush thread writes it with the others
+        pending = increments.add((shopcart_id, old_item.product_id), item_json["count"])
+        logger.info("Item [%s] existed: product id %s, buffered count %s.", old_item.id, old_item.product_id, pending)
         item = old_item
+        message = with_pending_count(item.serialize())
     else:
-        item = Item()
-        new_item = item.deserialize(request.get_json())
-        new_item.create()
-        logger.info("Item [%s] created.", new_item.id)
-        item = new_item
-    message = item.serialize()
+        item = repository.add_item(shopcart_id, item_json, app.config["MAX_ITEMS_PER_CART"])
+        if not item:
+            abort(status.HTTP_404_NOT_FOUND,f"Shopcart with id '{shopcart_id}' could not be found.")
+        logger.info("Item [%s] added.", item.id)
+        message = item.serialize()
     location_url = url_for("get_items", shopcart_id = shopcart_id, item_id=item.id, _external=True)
 
     logger.info("Location %s", location_url)
-    return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    return respond(message, status.HTTP_201_CREATED, {"Location": location_url})
 
 ######################################################################
 #  UPDATE A ITEM
@@ -215,28 +727,20 @@ def update_items(shopcart_id, item_id):
     """
 
     logger.info("Request to update item with id %s", item_id)
-    check_content_type("application/json")
+    check_content_type(*media.MEDIA_TYPES)
+
+    # see if the request is reliable before looking anything up
+    new_item = read_body()
+    Item.validate(new_item)
+    new_item = with_if_match(new_item)
 
-    #see if the shopcart exists and abort if it doesn't
-    item = Item.find(item_id)
+    #update the item unless it was read from an older version, abort if the shopcart doesn't hold it
+    flush_pending_counts()
+    item = repository.update_item(shopcart_id, item_id, new_item)
     if not item:
-        abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found")
-    if not item.shopcart_id or item.shopcart_id != shopcart_id:
         abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found in shopcart '{shopcart_id}'")
-    
-    new_item = request.get_json()
-    # see if the request is reliable
-    if new_item["count"] <= 0:
-        abort(status.HTTP_400_BAD_REQUEST, f"Item '{item_id}' count should larger than 0")
-    if new_item["price"] < 0.0:
-        abort(status.HTTP_400_BAD_REQUEST, f"Item '{item_id}' price should larger than 0")
-    
-    #update from the json in the body of the request
-    item.deserialize(new_item)
-    item.id = item_id
-    item.update()
 
-    return make_response(jsonify(item.serialize()), status.HTTP_200_OK)
+    return respond(item.serialize(), status.HTTP_200_OK)
 
 @app.route("/shopcarts/<int:shopcart_id>/items/<int:item_id>", methods = ["DELETE"])
 def delete_items(shopcart_id, item_id):
@@ -247,22 +751,122 @@ def delete_items(shopcart_id, item_id):
     app.logger.info("Request to delete item with id: %d", item_id)
 
     # Retrieve the account to delete and delete it if it exists
-    item = Item.find(item_id)
-    if item and item.shopcart_id == shopcart_id:
-        item.delete()
+    flush_pending_counts()
+    repository.delete_item(shopcart_id, item_id)
     
     return make_response("", status.HTTP_204_NO_CONTENT)
 
+# ---------------------------------------------------------------------
+#                P R O D U C T   M E T H O D S
+# ---------------------------------------------------------------------
+
+######################################################################
+#  LIST ITEMS BY PRODUCT
+######################################################################
+@app.route("/items", methods=["GET"])
+def list_items_by_product():
+    """
+    Returns the items holding a product, in pages ordered by item id
+    Pass the next_after of a page as after to read the next one
+    """
+    if "product_id" not in request.args:
+        abort(status.HTTP_400_BAD_REQUEST, "product_id is required")
+    product_id = parse_number("product_id", 0, 0, 2**31 - 1)
+    after = parse_number("after", 0, 0, 2**31 - 1)
+    limit = parse_number("limit", 100, 1, app.config["CHANGES_MAX_LIMIT"])
+    app.logger.info("Request for items of product %s after %s", product_id, after)
+
+    items = repository.find_items_by_product(product_id, after, limit)
+    results = {
+        "items": [with_pending_count(item.serialize()) for item in items],
+        "next_after": items[-1].id if len(items) == limit else None,
+    }
+    app.logger.info("Return %d items", len(items))
+    return respond(results, status.HTTP_200_OK)
+
+######################################################################
+#  REPRICE A PRODUCT
+######################################################################
+@app.route("/products/<int:product_id>/price", methods=["PUT"])
+@limiter.limit(rate=1, burst=5)
+def reprice_product(product_id):
+    """
+    Sets the price of every item holding a product
+    This endpoint reads the new price from the body: {"price": 9.99}
+    """
+    app.logger.info("Request to reprice product %s", product_id)
+    check_content_type(*media.MEDIA_TYPES)
+    body = read_body()
+    errors = validate_price(body)
+    if errors:
+        raise DataValidationError("Invalid price: " + "; ".join(errors), errors)
+    price = body["price"]
+
+    updated = repository.reprice(product_id, float(price), app.config["REPRICE_CHUNK_SIZE"])
+    return respond({"product_id": product_id, "price": float(price), "updated": updated}, status.HTTP_200_OK)
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-def check_content_type(media_type):
+def require(feature, name):
+    """Refuses a request the repository has no support for with 501_NOT_IMPLEMENTED"""
+    if not repository.supports(feature):
+        abort(status.HTTP_501_NOT_IMPLEMENTED, f"{name} needs STORAGE_BACKEND=sql")
+
+
+def check_content_type(*media_types):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
-    if content_type and content_type == media_type:
+    if content_type and content_type in media_types:
         return
     app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        f"Content-Type must be {media_type}",
-    )
\ No newline at end of file
+        f"Content-Type must be {' or '.join(media_types)}",
+    )
+
+
+def read_body():
+    """Returns the decoded body of a JSON or MessagePack request"""
+    if request.mimetype != media.MSGPACK:
+        return request.get_json()
+    try:
+        body = media.loads(request.get_data(), media.MSGPACK)
+    except media.BodyDecodeError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+    return body
+
+
+def with_if_match(body):
+    """Returns body holding the version of its If-Match header, when the request has one"""
+    tags = request.if_match.as_set()
+    if not tags:
+        return body
+    tag = tags.pop()
+    if tags or not tag.isdigit():
+        abort(status.HTTP_400_BAD_REQUEST, 'If-Match must hold the one version the record was read at, like "3"')
+    if body.get("version") not in (None, int(tag)):
+        abort(status.HTTP_400_BAD_REQUEST, "If-Match and the version field hold different versions")
+    return dict(body, version=int(tag))
+
+
+def respond(body, code, headers=None):
+    """Returns body as JSON, or as MessagePack to clients that prefer it"""
+    if media.negotiate(request.accept_mimetypes) == media.MSGPACK:
+        return app.response_class(media.dumps(body, media.MSGPACK), status=code, headers=headers, mimetype=media.MSGPACK)
+    return jsonify(body), code, headers or {}
+
+
+def respond_document(document, headers=None):
+    """Returns a stored shopcart document, sending its bytes as they are to JSON clients"""
+    if increments.running or media.negotiate(request.accept_mimetypes) == media.MSGPACK:
+        return respond(with_pending_counts(json.loads(document)), status.HTTP_200_OK, headers)
+    return app.response_class(document, status=status.HTTP_200_OK, headers=headers, mimetype=media.JSON)
+
+
+@app.before_request
+def check_content_length():
+    """Rejects bodies larger than MAX_CONTENT_LENGTH before anything reads them"""
+    limit = app.config["MAX_CONTENT_LENGTH"]
+    if limit is not None and request.content_length is not None and request.content_length > limit:
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"Request bodies may be at most {limit} bytes")
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Storage of Shopcarts around their Tables
+
+Shopcarts left unchanged for ARCHIVE_AFTER_DAYS are moved with their items to
+archive tables, and moved back by the first lookup that asks for them. The
+item table can be hash partitioned by shopcart_id on PostgreSQL, and while
+CART_DOCUMENTS is on every shopcart keeps a JSON document of itself that
+GET /shopcarts/{id} returns with one primary key fetch.
+
+Archiving picks shopcarts by updated_at, which every write of the shopcart
+or one of its items sets. db.create_all() does not add it to a shopcart
+table created before it existed. Until that table is migrated and its rows
+backfilled, those shopcarts are never archived:
+
+    ALTER TABLE shopcart ADD COLUMN updated_at TIMESTAMP;
+    UPDATE shopcart SET updated_at = now() WHERE updated_at IS NULL;
+    CREATE INDEX ix_shopcart_updated_at ON shopcart (updated_at);
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import Table, bindparam, cast, insert, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from service.models import Item, Shopcart, db, shards
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  A R C H I V E
+######################################################################
+def archive_table(table, *indexes) -> Table:
+    """Declares the table that keeps the rows of table moved out by archive_inactive()"""
+    columns = [
+        db.Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+        for column in table.columns
+    ]
+    archived_at = db.Column("archived_at", db.DateTime, nullable=False, default=datetime.utcnow)
+    return db.Table(f"{table.name}_archive", *columns, archived_at, *indexes)
+
+
+shopcart_archive = archive_table(Shopcart.__table__)
+item_archive = archive_table(Item.__table__, db.Index("ix_item_archive_shopcart_id", "shopcart_id"))
+
+
+def move_rows(session, source, target, where) -> int:
+    """Copies the rows of source matching where into target and deletes them, returns how many"""
+    columns = [column.name for column in target.columns if column.name in source.c]
+    session.execute(insert(target).from_select(columns, select(*(source.c[name] for name in columns)).where(where)))
+    return session.execute(source.delete().where(where)).rowcount
+
+
+def archive_inactive(cutoff: datetime, chunk_size: int = 500) -> int:
+    """
+    Moves the shopcarts unchanged since cutoff and their items to the archive tables
+
+    Each chunk of chunk_size shopcarts is moved in its own transaction, so
+    the hot tables are never locked for long. Returns how many were moved.
+    """
+    archived = 0
+    for session in shards.sessions() if shards.enabled else [db.session]:
+        while True:
+            # item writes touch their shopcart, so the lock keeps them out until the move commits
+            ids = session.execute(
+                select(Shopcart.id)
+                .where(Shopcart.updated_at < cutoff)
+                .order_by(Shopcart.id)
+                .limit(chunk_size)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if not ids:
+                break
+            # the items first, the foreign key refuses to delete a shopcart that still has some
+            move_rows(session, Item.__table__, item_archive, Item.shopcart_id.in_(ids))
+            moved = move_rows(session, Shopcart.__table__, shopcart_archive, Shopcart.id.in_(ids))
+            session.commit()
+            archived += moved
+            logger.info("Archived %d shopcarts", moved)
+    return archived
+
+
+def restore(ids) -> int:
+    """
+    Moves archived shopcarts and their items back to the hot tables, returns how many were moved
+
+    The rows are moved on a session of their own, so a lookup that restores a
+    shopcart neither commits the transaction of its caller nor the changes the
+    caller has pending in it.
+    """
+    batches = {}
+    for by_id in ids:
+        batches.setdefault(Item.query_for_shopcart(by_id).session, []).append(by_id)
+    restored = 0
+    for session, batch in batches.items():
+        # one cheap lookup for ids that were simply never there
+        batch = session.execute(select(shopcart_archive.c.id).where(shopcart_archive.c.id.in_(batch))).scalars().all()
+        if not batch:
+            continue
+        try:
+            with Session(bind=session.get_bind(), join_transaction_mode="create_savepoint") as moving, moving.begin():
+                moved = move_rows(moving, shopcart_archive, Shopcart.__table__, shopcart_archive.c.id.in_(batch))
+                move_rows(moving, item_archive, Item.__table__, item_archive.c.shopcart_id.in_(batch))
+                # a shopcart asked for is active again
+                moving.execute(
+                    update(Shopcart.__table__).where(Shopcart.id.in_(batch)).values(updated_at=datetime.utcnow())
+                )
+        except IntegrityError:
+            # another request restored the same shopcart first
+            continue
+        restored += moved
+        logger.info("Restored %d archived shopcarts", moved)
+    return restored
+
+
+def archived_shopcart_of_item(item_id):
+    """Returns the shopcart id of an archived item, None when it is not archived"""
+    # item ids come from the id range of their shopcart's shard
+    session = Item.query_for_shopcart(item_id).session
+    return session.execute(select(item_archive.c.shopcart_id).where(item_archive.c.id == item_id)).scalar()
+
+
+######################################################################
+#  P A R T I T I O N S
+######################################################################
+def partitioned_item_table() -> Table:
+    """
+    Returns a copy of the item table hash partitioned by shopcart_id
+
+    PostgreSQL wants the partition key in the primary key, so the copy's
+    primary key is (id, shopcart_id); the model keeps mapping id alone.
+    """
+    metadata = db.MetaData()
+    Shopcart.__table__.to_metadata(metadata)  # the target of the foreign key
+    table = Item.__table__.to_metadata(metadata)
+    table.c.id.autoincrement = True
+    table.c.shopcart_id.primary_key = True
+    table.append_constraint(db.PrimaryKeyConstraint(table.c.id, table.c.shopcart_id, name="item_pkey"))
+    table.dialect_kwargs["postgresql_partition_by"] = "HASH (shopcart_id)"
+    return table
+
+
+def item_partition_statements(partitions: int) -> list:
+    """Returns the statements that create the partitions of the item table"""
+    return [
+        f"CREATE TABLE IF NOT EXISTS item_p{remainder} PARTITION OF item "
+        f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        for remainder in range(partitions)
+    ]
+
+
+def create_partitioned_items(engine, partitions: int):
+    """Creates item as a hash partitioned table on PostgreSQL when ITEM_PARTITIONS is set"""
+    if partitions <= 0 or engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        if inspect(conn).has_table(Item.__tablename__):
+            # partitioning an existing table needs a migration, leave it alone
+            return
+        logger.info("Creating item with %d hash partitions", partitions)
+        db.metadata.create_all(conn, tables=[Shopcart.__table__])
+        partitioned_item_table().create(conn)
+        for statement in item_partition_statements(partitions):
+            conn.execute(text(statement))
+
+
+######################################################################
+#  D O C U M E N T S
+######################################################################
+def find_document(by_id):
+    """
+    Returns the stored document of a shopcart as JSON bytes with one primary key fetch
+
+    Returns None when the shopcart is not in the hot table or has no
+    document yet, callers then read it from its rows.
+    """
+    logger.info("Processing document lookup for id %s ...", by_id)
+    carts = Shopcart.__table__
+    document = Item.query_for_shopcart(by_id).session.execute(
+        select(cast(carts.c.document, db.Text)).where(carts.c.id == by_id)
+    ).scalar()
+    return document.encode("utf-8") if document is not None else None
+
+
+def documents_for(connection, ids) -> dict:
+    """Returns the documents of shopcarts by id, built with one query per table"""
+    carts = Shopcart.__table__
+    items = Item.__table__
+    documents = {
+        row.id: {
+            "id": row.id,
+            "customer_id": row.customer_id,
+            "version": row.version,
+            "items": [],
+        }
+        for row in connection.execute(
+            select(carts.c.id, carts.c.customer_id, carts.c.version).where(carts.c.id.in_(ids))
+        )
+    }
+    if documents:
+        rows = connection.execute(
+            select(
+                items.c.id, items.c.shopcart_id, items.c.product_id,
+                items.c.name, items.c.price, items.c.count, items.c.version,
+            )
+            .where(items.c.shopcart_id.in_(documents))
+            .order_by(items.c.id)
+        )
+        for row in rows:
+            documents[row.shopcart_id]["items"].append(dict(row._mapping))  # pylint: disable=protected-access
+    return documents
+
+
+def refresh_documents(session, ids) -> int:
+    """Rewrites the documents of shopcarts in the session's transaction, returns how many were written"""
+    connection = session.connection()
+    documents = documents_for(connection, ids)
+    if documents:
+        table = Shopcart.__table__
+        connection.execute(
+            update(table).where(table.c.id == bindparam("b_id")).values(document=bindparam("b_document")),
+            [{"b_id": by_id, "b_document": document} for by_id, document in documents.items()],
+        )
+    return len(documents)
+
+
+def build_documents(chunk_size: int = 500) -> int:
+    """Writes the missing documents of the shopcarts, chunk_size per transaction, returns how many"""
+    built = 0
+    for session in shards.sessions() if shards.enabled else [db.session]:
+        last_id = 0
+        while True:
+            ids = session.execute(
+                select(Shopcart.id)
+                .where(Shopcart.id > last_id, Shopcart.document.is_(None))
+                .order_by(Shopcart.id)
+                .limit(chunk_size)
+            ).scalars().all()
+            if not ids:
+                break
+            last_id = ids[-1]
+            built += refresh_documents(session, ids)
+            session.commit()
+    logger.info("Built %d shopcart documents", built)
+    return built
@@ -0,0 +1,17 @@
+"""
+Test Package
+
+SQLAlchemy only checks that the UPDATE or DELETE of a versioned record
+matched its row on dialects claiming a sane rowcount for UPDATE .. RETURNING.
+PostgreSQL does, pysqlite does not although it has the rowcount once the row
+is fetched, which the ORM does before it checks. The SQLite test databases
+claim it so that the optimistic locking tests run on them too.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@event.listens_for(Engine, "engine_connect")
+def _check_sqlite_rowcounts(connection):
+    if connection.dialect.name == "sqlite":
+        connection.dialect.supports_sane_rowcount_returning = True
@@ -0,0 +1,16 @@
+"""
+Fake Clock
+
+A stand-in for time.monotonic that the tests of time based policies move
+forward by hand, so buckets refill and circuits reopen without sleeping.
+"""
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
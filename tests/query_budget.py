@@ -0,0 +1,82 @@
+"""
+SQL Query Budgets
+
+Counts the SQL statements an endpoint sends to the database so that tests
+fail when a change (an N+1 lazy load, a redundant lookup) makes an endpoint
+issue more statements than its budget allows.
+"""
+from contextlib import contextmanager
+from sqlalchemy import event
+from service.models import db, shards
+
+# Most SQL statements each endpoint may send for one request. Every write
+# includes one INSERT into the cart_change outbox. Every item write also sets
+# the updated_at of its shopcart, and on SQLite bumps the sync_clock (item
+# deletes also write a tombstone). Ids that are not found cost one more
+# lookup in the archive.
+QUERY_BUDGETS = {
+    "GET /": 0,
+    "GET /shopcarts": 2,
+    "GET /shopcarts?ids=": 3,
+    "GET /shopcarts/{id}": 2,
+    "POST /shopcarts": 4,
+    "PUT /shopcarts/{id}": 6,
+    "DELETE /shopcarts/{id}": 3,
+    "GET /shopcarts/{id}/items": 2,
+    "GET /shopcarts/{id}/items?since=": 4,
+    "GET /shopcarts/{id}/items/{item_id}": 1,
+    "POST /shopcarts/{id}/items": 7,
+    "PUT /shopcarts/{id}/items/{item_id}": 6,
+    "DELETE /shopcarts/{id}/items/{item_id}": 6,
+}
+
+
+# Transaction control sent by the per-test transactions of tests/rollback.py,
+# which the service does not send in production
+HARNESS_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+class QueryCounter:
+    """Records the SQL statements sent through the service's engines"""
+
+    def __init__(self, engines=None):
+        self.engines = engines
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        """Number of statements recorded"""
+        return len(self.statements)
+
+    def _record(self, _conn, _cursor, statement, *_args):
+        if not statement.startswith(HARNESS_STATEMENTS):
+            self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engines is None:
+            self.engines = [db.engine] + shards.engines
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc):
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self._record)
+
+
+class QueryBudgetMixin:
+    """Adds query budget assertions to a TestCase"""
+
+    @contextmanager
+    def assertQueryBudget(self, endpoint, budget=None):  # pylint: disable=invalid-name
+        """Fails when the block sends more statements than the endpoint's budget"""
+        if budget is None:
+            budget = QUERY_BUDGETS[endpoint]
+        with QueryCounter() as counter:
+            yield counter
+        self.assertLessEqual(
+            counter.count,
+            budget,
+            f"{endpoint} sent {counter.count} SQL statements, its budget is {budget}:\n"
+            + "\n".join(counter.statements),
+        )
@@ -0,0 +1,57 @@
+"""
+Per-Test Transactions
+
+Runs each test inside one database transaction that is rolled back when the
+test ends, so tables are created once per TestCase instead of being dropped
+and created again before every test. The service's own commits only release
+SAVEPOINTs inside that transaction: a test sees everything it wrote, and the
+next test starts from the same empty tables.
+"""
+from flask.globals import app_ctx
+from sqlalchemy import event
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from service.models import db
+
+
+def _app_context_id() -> int:
+    # one session per app context, like Flask-SQLAlchemy's own scoping: the
+    # app object is the same in every context, the context object is not
+    return id(app_ctx._get_current_object())  # pylint: disable=protected-access
+
+
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+class RollbackMixin:
+    """Adds a rolled back transaction around each test of a TestCase"""
+
+    def start_test_transaction(self):
+        """Binds db.session to a transaction that is rolled back after the test"""
+        db.session.remove()
+        connection = db.engine.connect()
+        driver_connection = connection.connection.driver_connection
+        isolation_level = None
+        if connection.dialect.name == "sqlite":
+            # pysqlite starts and ends transactions on its own, which breaks
+            # SAVEPOINTs, so hand transaction control to SQLAlchemy
+            isolation_level = driver_connection.isolation_level
+            driver_connection.isolation_level = None
+            event.listen(connection, "begin", _emit_begin)
+        transaction = connection.begin()
+        session = db.session
+        db.session = scoped_session(
+            sessionmaker(bind=connection, class_=Session, join_transaction_mode="create_savepoint"),
+            scopefunc=_app_context_id,
+        )
+
+        def rollback():
+            db.session.remove()
+            db.session = session
+            transaction.rollback()
+            if connection.dialect.name == "sqlite":
+                event.remove(connection, "begin", _emit_begin)
+                driver_connection.isolation_level = isolation_level
+            connection.close()
+
+        self.addCleanup(rollback)
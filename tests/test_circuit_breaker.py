@@ -0,0 +1,150 @@
+"""
+Test cases for the Circuit Breaker and the Stale Cache
+
+"""
+import sqlite3
+from unittest import TestCase
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from service.common.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from service.common.stale_cache import StaleCache
+from tests.clock import FakeClock
+
+
+class FlakyDatabase:
+    """Connects to an in-memory SQLite database unless it is down"""
+
+    def __init__(self):
+        self.down = False
+        self.connects = 0
+
+    def connect(self):
+        """Creates a DBAPI connection or fails like an unreachable server"""
+        self.connects += 1
+        if self.down:
+            raise sqlite3.OperationalError("could not connect to server")
+        return sqlite3.connect(":memory:")
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R   T E S T   C A S E S
+######################################################################
+class TestCircuitBreaker(TestCase):
+    """ Test Cases for the Circuit Breaker """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=self.clock)
+
+    def test_opens_after_failures(self):
+        """It should open after consecutive failures only"""
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.retry_after, 10)
+
+    def test_half_open_probe(self):
+        """It should let one probe through after the reset timeout"""
+        for _ in range(3):
+            self.breaker.failure()
+        self.clock.now += 10
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+        # a failed probe opens it again
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.clock.now += 10
+        self.breaker.before_call()
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+
+    def test_lost_probe(self):
+        """It should send another probe when the last one never reported back"""
+        for _ in range(3):
+            self.breaker.failure()
+        self.clock.now += 10
+        self.breaker.before_call()
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+        self.clock.now += 10
+        self.breaker.before_call()
+
+    def test_watch_engine(self):
+        """It should fail fast once the database cannot be reached, then recover"""
+        database = FlakyDatabase()
+        engine = create_engine("sqlite://", creator=database.connect)
+        engine.dispose()
+        self.breaker.watch(engine)
+        self.breaker.watch(engine)
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+        database.down = True
+        engine.dispose()
+        for _ in range(3):
+            self.assertRaises(OperationalError, engine.connect)
+        self.assertEqual(self.breaker.stats(), {"state": OPEN, "failures": 3})
+        connects = database.connects
+        self.assertRaises(CircuitOpenError, engine.connect)
+        self.assertEqual(database.connects, connects)
+
+        database.down = False
+        self.clock.now += 10
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_bad_statements_are_not_outages(self):
+        """It should not count errors of the statement itself"""
+        engine = create_engine("sqlite://")
+        self.breaker.watch(engine)
+        for _ in range(5):
+            with engine.connect() as conn:
+                self.assertRaises(ProgrammingError, conn.execute, text("SELECT 1; SELECT 2"))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+
+class TestStaleCache(TestCase):
+    """ Test Cases for the Stale Cache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = StaleCache(size=2, max_age=60, clock=self.clock)
+
+    def test_put_and_get(self):
+        """It should return the last value of a key and its age"""
+        self.cache.put("a", 1)
+        self.clock.now += 5
+        self.cache.put("b", 2)
+        self.assertEqual(self.cache.get("a"), (1, 5))
+        self.assertIsNone(self.cache.get("c"))
+
+    def test_evicts_least_recently_read(self):
+        """It should keep at most size keys"""
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.put("a", 3)
+        self.cache.put("c", 4)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a")[0], 3)
+
+    def test_max_age(self):
+        """It should not serve values older than max_age"""
+        self.cache.put("a", 1)
+        self.clock.now += 61
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_discard(self):
+        """It should forget discarded keys"""
+        self.cache.put("a", 1)
+        self.cache.discard("a", "missing")
+        self.assertIsNone(self.cache.get("a"))
@@ -5,7 +5,9 @@ import os
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service.common.cli_commands import (
+    db_create, idempotency_cleanup, changes_cleanup, tombstones_cleanup, carts_archive, carts_documents
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +23,43 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    def test_idempotency_cleanup(self, key_mock):
+        """It should call the idempotency-cleanup command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(idempotency_cleanup)
+            self.assertEqual(result.exit_code, 0)
+            key_mock.remove_expired.assert_called_once()
+
+    @patch('service.common.cli_commands.CartChange')
+    def test_changes_cleanup(self, change_mock):
+        """It should call the changes-cleanup command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(changes_cleanup)
+            self.assertEqual(result.exit_code, 0)
+            change_mock.remove_older_than.assert_called_once()
+
+    @patch('service.common.cli_commands.ItemTombstone')
+    def test_tombstones_cleanup(self, tombstone_mock):
+        """It should call the tombstones-cleanup command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(tombstones_cleanup)
+            self.assertEqual(result.exit_code, 0)
+            tombstone_mock.remove_older_than.assert_called_once_with(7 * 86400)
+
+    @patch('service.common.cli_commands.storage')
+    def test_carts_archive(self, storage_mock):
+        """It should call the carts-archive command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(carts_archive)
+            self.assertEqual(result.exit_code, 0)
+            storage_mock.archive_inactive.assert_called_once()
+
+    @patch('service.common.cli_commands.storage')
+    def test_carts_documents(self, storage_mock):
+        """It should call the carts-documents command"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(carts_documents)
+            self.assertEqual(result.exit_code, 0)
+            storage_mock.build_documents.assert_called_once()
@@ -0,0 +1,99 @@
+"""
+Test cases for Response Compression
+
+"""
+import gzip
+import zlib
+from unittest import TestCase
+from flask import Flask, Response
+from werkzeug.datastructures import Accept
+from service.common import compression, status
+
+BIG = "x" * 2000
+
+
+def make_app(**config):
+    """Creates a small Flask app with routes of every kind of response"""
+    app = Flask("compression-test")
+    app.config.update({"COMPRESSION_MIN_SIZE": 1024, **config})
+
+    @app.route("/big")
+    def big():
+        return {"data": BIG}, status.HTTP_200_OK
+
+    @app.route("/small")
+    def small():
+        return {"data": "x"}, status.HTTP_200_OK
+
+    @app.route("/empty")
+    def empty():
+        return "", status.HTTP_204_NO_CONTENT
+
+    @app.route("/stream")
+    def stream():
+        return Response((f"data: {n}\n\n" for n in range(3)), mimetype="text/event-stream")
+
+    compression.init_compression(app)
+    return app
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(TestCase):
+    """ Test Cases for Response Compression """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.client = make_app().test_client()
+
+    def test_gzip_large_response(self):
+        """It should gzip a response above the size threshold"""
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertLess(len(resp.data), len(BIG))
+        self.assertIn(BIG, gzip.decompress(resp.data).decode())
+
+    def test_skips_small_and_unaccepted(self):
+        """It should not compress small bodies or when the client does not accept gzip"""
+        resp = self.client.get("/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self.client.get("/big")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self.client.get("/big", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(BIG, resp.get_data(as_text=True))
+
+    def test_skips_no_content(self):
+        """It should leave 204 responses alone"""
+        resp = self.client.get("/empty", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.data, b"")
+
+    def test_streams_compressed_chunks(self):
+        """It should compress a streamed response chunk by chunk"""
+        resp = self.client.get("/stream", headers={"Accept-Encoding": "gzip"}, buffered=False)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        chunks = iter(resp.response)
+        # every event can be decompressed as soon as its chunk arrives
+        self.assertEqual(decompressor.decompress(next(chunks)), b"data: 0\n\n")
+        rest = b"".join(decompressor.decompress(chunk) for chunk in chunks)
+        self.assertEqual(rest, b"data: 1\n\ndata: 2\n\n")
+        resp.close()
+
+    def test_turned_off(self):
+        """It should register nothing when COMPRESSION is off"""
+        app = make_app(COMPRESSION=False)
+        self.assertEqual(app.after_request_funcs, {})
+
+    def test_choose_encoding(self):
+        """It should prefer brotli only when it is installed and accepted as much as gzip"""
+        accept = Accept([("gzip", 1), ("br", 1)])
+        self.assertEqual(compression.choose_encoding(accept, brotli_available=True), "br")
+        self.assertEqual(compression.choose_encoding(accept, brotli_available=False), "gzip")
+        accept = Accept([("gzip", 1), ("br", 0.5)])
+        self.assertEqual(compression.choose_encoding(accept, brotli_available=True), "gzip")
+        self.assertIsNone(compression.choose_encoding(Accept([("identity", 1)])))
@@ -0,0 +1,93 @@
+"""
+Test cases for the Health Checks
+
+"""
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from service.common.health import HealthCheck, pool_status
+from tests.clock import FakeClock
+
+
+######################################################################
+#  H E A L T H   C H E C K   T E S T   C A S E S
+######################################################################
+class TestHealthCheck(TestCase):
+    """ Test Cases for the readiness checks """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.engine = create_engine(
+            "sqlite://", poolclass=QueuePool, pool_size=2, max_overflow=0, connect_args={"check_same_thread": False}
+        )
+
+    def test_ready(self):
+        """It should be ready when the database answers and the pool has room"""
+        ready, report = HealthCheck([self.engine], clock=self.clock).ready()
+        self.assertTrue(ready)
+        self.assertEqual(report["status"], "ready")
+        self.assertTrue(report["database"]["ok"])
+        self.assertEqual(report["pools"][0]["capacity"], 2)
+
+    def test_caches_select(self):
+        """It should only run SELECT 1 again once the cached result is stale"""
+        engine = MagicMock(wraps=self.engine)
+        check = HealthCheck([engine], ttl=2, clock=self.clock)
+        check.database()
+        check.database()
+        self.assertEqual(engine.connect.call_count, 1)
+        self.clock.now += 1
+        self.assertEqual(check.database()["age"], 1)
+        self.clock.now += 1
+        check.database()
+        self.assertEqual(engine.connect.call_count, 2)
+
+    def test_database_down(self):
+        """It should not be ready while the database does not answer"""
+        engine = MagicMock(wraps=self.engine)
+        engine.pool = self.engine.pool
+        engine.connect.side_effect = OSError("connection refused")
+        ready, report = HealthCheck([engine], clock=self.clock).ready()
+        self.assertFalse(ready)
+        self.assertEqual(report["status"], "unavailable")
+        self.assertEqual(report["database"]["error"], "connection refused")
+
+    def test_pool_saturated(self):
+        """It should not be ready, nor run SELECT 1, while the pool is saturated"""
+        engine = MagicMock(wraps=self.engine)
+        engine.pool = self.engine.pool
+        check = HealthCheck([engine], max_saturation=0.5, clock=self.clock)
+        with self.engine.connect():
+            self.assertEqual(pool_status(self.engine.pool)["saturation"], 0.5)
+            ready, report = check.ready()
+            self.assertFalse(ready)
+            self.assertEqual(report["database"]["skipped"], "pool saturated")
+        self.assertEqual(engine.connect.call_count, 0)
+        self.assertTrue(check.ready()[0])
+
+    def test_database_hangs(self):
+        """It should stop waiting for a hung SELECT 1 and answer other probes from the cache"""
+        engine = MagicMock(wraps=self.engine)
+        check = HealthCheck([engine], ttl=2, timeout=0.05, clock=self.clock)
+        self.assertTrue(check.database()["ok"])
+        answered = threading.Event()
+        engine.connect.side_effect = lambda: answered.wait(5) and self.engine.connect()
+        self.clock.now += 2
+        report = check.database()
+        self.assertFalse(report["ok"])
+        self.assertEqual(report["error"], "no answer within 0.05s")
+        # the ping still runs: the next probe does not start another one
+        self.clock.now += 2
+        self.assertFalse(check.database()["ok"])
+        self.assertEqual(engine.connect.call_count, 2)
+        answered.set()
+        check._pinging.join(1)  # pylint: disable=protected-access
+        self.assertTrue(check.database()["ok"])
+
+    def test_unsized_pool(self):
+        """It should report pools without a fixed size as never saturated"""
+        status = pool_status(create_engine("sqlite://").pool)
+        self.assertEqual(status["saturation"], 0.0)
+        self.assertIsNone(status["capacity"])
@@ -0,0 +1,103 @@
+"""
+Test cases for Load Shedding
+
+"""
+import threading
+from unittest import TestCase
+from flask import Flask
+from sqlalchemy import create_engine, text
+from service.common import load_shedding, status
+
+
+def make_app(**config):
+    """Creates a small Flask app with one route that runs SQL"""
+    app = Flask("load-shedding-test")
+    app.config.update(
+        LOAD_SHEDDING=True, MAX_CONCURRENT_REQUESTS=0, POOL_WAIT_THRESHOLD=0.5, POOL_WAIT_WINDOW=1.0
+    )
+    app.config.update(config)
+    engine = create_engine("sqlite://")
+    app.config["entered"] = threading.Event()
+    app.config["leave"] = threading.Event()
+
+    @app.route("/query")
+    def query():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return {"ok": True}, status.HTTP_200_OK
+
+    @app.route("/hold")
+    def hold():
+        app.config["entered"].set()
+        app.config["leave"].wait(5)
+        return {"ok": True}, status.HTTP_200_OK
+
+    shedder = load_shedding.init_load_shedding(app, [engine])
+    return app, engine, shedder
+
+
+######################################################################
+#  L O A D   S H E D D I N G   T E S T   C A S E S
+######################################################################
+class TestLoadShedding(TestCase):
+    """ Test Cases for Load Shedding """
+
+    def test_off_registers_nothing(self):
+        """It should not register any hook when load shedding is off"""
+        app, _, _ = make_app(LOAD_SHEDDING=False)
+        self.assertEqual(app.before_request_funcs, {})
+        self.assertEqual(app.teardown_request_funcs, {})
+
+    def test_sheds_over_concurrency(self):
+        """It should answer 503 with Retry-After while too many requests are in flight"""
+        app, _, shedder = make_app(MAX_CONCURRENT_REQUESTS=1)
+        thread = threading.Thread(target=app.test_client().get, args=("/hold",))
+        thread.start()
+        try:
+            self.assertTrue(app.config["entered"].wait(5))
+            resp = app.test_client().get("/query")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+        finally:
+            app.config["leave"].set()
+            thread.join()
+        self.assertEqual(app.test_client().get("/query").status_code, status.HTTP_200_OK)
+        stats = shedder.stats()
+        self.assertEqual(stats["shed_concurrency"], 1)
+        self.assertEqual(stats["admitted"], 2)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_sheds_on_pool_wait(self):
+        """It should answer 503 after a slow connection checkout"""
+        app, engine, shedder = make_app()
+        clock = [100.0]
+        shedder.monitor.clock = lambda: clock[0]
+        self.assertEqual(app.test_client().get("/query").status_code, status.HTTP_200_OK)
+        self.assertEqual(shedder.stats()["pool_wait"], 0)
+
+        original = engine.pool.connect
+
+        def slow_connect():
+            clock[0] += 2
+            return original()
+        engine.pool.connect = slow_connect
+        self.assertEqual(app.test_client().get("/query").status_code, status.HTTP_200_OK)
+        resp = app.test_client().get("/query")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", resp.headers)
+        self.assertEqual(shedder.stats()["shed_pool_wait"], 1)
+
+        # the slow checkout ages out of the window
+        engine.pool.connect = original
+        clock[0] += 5
+        self.assertEqual(app.test_client().get("/query").status_code, status.HTTP_200_OK)
+
+    def test_watch_survives_dispose(self):
+        """It should keep timing checkouts after the engine replaced its pool"""
+        monitor = load_shedding.PoolWaitMonitor()
+        engine = create_engine("sqlite://")
+        monitor.watch(engine)
+        engine.dispose()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        self.assertEqual(len(monitor._samples), 1)  # pylint: disable=protected-access
@@ -2,12 +2,26 @@
 Test cases for Shopcart & Item Model
 
 """
+import json
 import os
 import logging
 import unittest
-from service.models import Shopcart,Item, DataValidationError, db
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable
+from service.models import Shopcart,Item, DataValidationError, VersionConflictError, db, shards, CartChange
+from service.models import ItemTombstone, VersionRequiredError
 from service import app
+from service.repository import SqlRepository
+from service.storage import archive_inactive, build_documents, find_document, item_archive, shopcart_archive
+from service.storage import item_partition_statements, partitioned_item_table
+from service.common.tracing import MemoryExporter, tracer
+from service.common.write_behind import PartialFlushError
 from tests.factories import ShopcartFactory, ItemFactory
+from tests.rollback import RollbackMixin
 
 logger = logging.getLogger("flask.app")
 
@@ -18,7 +32,7 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #  S H O P C A R T   M O D E L   T E S T   C A S E S
 ######################################################################
-class TestShopcartModel(unittest.TestCase):
+class TestShopcartModel(unittest.TestCase, RollbackMixin):
     """ Test Cases for Shopcart Model """
 
     @classmethod
@@ -29,6 +43,9 @@ class TestShopcartModel(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Shopcart.init_db(app)
+        # if the schema changed, we need to drop the whole table
+        db.drop_all()
+        db.create_all()
 
     @classmethod
     def tearDownClass(cls):
@@ -37,13 +54,7 @@ class TestShopcartModel(unittest.TestCase):
 
     def setUp(self):
         """ This runs before each test """
-        db.drop_all()
-        #db.drop(Shopcart)
-        db.create_all()
-        #db.session.query(Item).delete()
-        #db.session.query(Shopcart).delete()  # clean up the last tests
-        # delete() only clear the table, if the schema changed, we need to drop the whole table
-        #db.session.commit()
+        self.start_test_transaction()
 
     def tearDown(self):
         """ This runs after each test """
@@ -133,6 +144,19 @@ class TestShopcartModel(unittest.TestCase):
         self.assertEqual(same_shopcart.id, shopcart.id)
         self.assertEqual(same_shopcart.customer_id, shopcart.customer_id)
 
+    def test_find_many(self):
+        """It should Find many shopcarts in the order of their ids"""
+        shopcarts = ShopcartFactory.create_batch(3)
+        for shopcart in shopcarts:
+            shopcart.create()
+        ids = [shopcarts[2].id, 999, shopcarts[0].id]
+        found = Shopcart.find_many(ids)
+        self.assertEqual(len(found), 3)
+        self.assertEqual(found[0].id, shopcarts[2].id)
+        self.assertIsNone(found[1])
+        self.assertEqual(found[2].id, shopcarts[0].id)
+        self.assertEqual(Shopcart.find_many([]), [])
+
     def test_serialize_a_shopcart(self):
         """It should Serialize an shopcart"""
         shopcart = ShopcartFactory()
@@ -150,6 +174,207 @@ class TestShopcartModel(unittest.TestCase):
         self.assertEqual(items[0]["product_id"], item.product_id)
         self.assertEqual(items[0]["count"], item.count)
     
+    def _make_idle(self, *shopcarts):
+        """Dates the last change of shopcarts a year back"""
+        ids = [shopcart.id for shopcart in shopcarts]
+        db.session.execute(
+            update(Shopcart.__table__).where(Shopcart.id.in_(ids)).values(updated_at=datetime.utcnow() - timedelta(days=365))
+        )
+        db.session.commit()
+
+    def test_archive_inactive_shopcarts(self):
+        """It should move idle shopcarts and their items to the archive in chunks"""
+        shopcarts = [Shopcart(customer_id=customer_id) for customer_id in range(5)]
+        for shopcart in shopcarts:
+            shopcart.create()
+            for _ in range(2):
+                ItemFactory(shopcart=shopcart).create()
+        self._make_idle(*shopcarts[:3])
+        archived = archive_inactive(datetime.utcnow() - timedelta(days=90), chunk_size=2)
+        self.assertEqual(archived, 3)
+        self.assertEqual(len(db.session.query(Shopcart).all()), 2)
+        self.assertEqual(len(db.session.query(Item).all()), 4)
+        self.assertEqual(len(db.session.execute(select(shopcart_archive)).all()), 3)
+        self.assertEqual(len(db.session.execute(select(item_archive)).all()), 6)
+        self.assertEqual(archive_inactive(datetime.utcnow() - timedelta(days=90)), 0)
+
+    def test_archive_skips_carts_with_edited_items(self):
+        """It should not archive a shopcart whose items were just written"""
+        shopcarts = [Shopcart(customer_id=customer_id) for customer_id in range(4)]
+        items = []
+        for shopcart in shopcarts:
+            shopcart.create()
+            item = ItemFactory(shopcart=shopcart, product_id=shopcart.id, price=1.0)
+            item.create()
+            items.append(item)
+        ids = [shopcart.id for shopcart in shopcarts]
+        self._make_idle(*shopcarts)
+        items[0].count += 1
+        items[0].update()
+        Item.add_counts({(ids[1], items[1].product_id): 2})
+        Item.reprice(items[2].product_id, 2.0)
+        self.assertEqual(archive_inactive(datetime.utcnow() - timedelta(days=90)), 1)
+        self.assertEqual(
+            [row.id for row in db.session.execute(select(shopcart_archive.c.id)).all()], [ids[3]]
+        )
+        self.assertEqual(len(db.session.query(Item).all()), 3)
+
+    def test_find_restores_archived_shopcart(self):
+        """It should read archived shopcarts and items by id, moving them back"""
+        shopcart = Shopcart(customer_id=1)
+        shopcart.create()
+        item = ItemFactory(shopcart=shopcart)
+        item.create()
+        shopcart_id, item_id, customer_id = shopcart.id, item.id, shopcart.customer_id
+        self._make_idle(shopcart)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        self.assertEqual(db.session.query(Shopcart).filter(Shopcart.id == shopcart_id).count(), 0)
+
+        found = Shopcart.find(shopcart_id)
+        self.assertEqual(found.customer_id, customer_id)
+        self.assertEqual([i.id for i in found.items], [item_id])
+        self.assertGreater(found.updated_at, datetime.utcnow() - timedelta(days=1))
+        self.assertEqual(db.session.execute(select(shopcart_archive)).all(), [])
+        self.assertEqual(db.session.execute(select(item_archive)).all(), [])
+
+        self._make_idle(found)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        self.assertEqual(Item.find(item_id).shopcart_id, shopcart_id)
+        self.assertIsNotNone(db.session.get(Shopcart, shopcart_id))
+
+        self._make_idle(found)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        self.assertEqual([s.id if s else None for s in Shopcart.find_many([shopcart_id, 9999])], [shopcart_id, None])
+        self.assertIsNone(Shopcart.find(9999))
+        self.assertIsNone(Item.find(9999))
+
+    def test_restore_keeps_caller_transaction(self):
+        """It should restore an archived shopcart without committing the caller's pending changes"""
+        shopcart = Shopcart(customer_id=1)
+        shopcart.create()
+        shopcart_id = shopcart.id
+        self._make_idle(shopcart)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        pending = Shopcart(customer_id=2, version=1)
+        db.session.add(pending)
+        transaction = db.session().get_transaction()
+        self.assertEqual(Shopcart.find(shopcart_id).customer_id, 1)
+        self.assertIs(db.session().get_transaction(), transaction)
+        self.assertIn(pending, db.session)
+        db.session.rollback()
+        self.assertEqual(db.session.query(Shopcart).filter(Shopcart.customer_id == 2).count(), 0)
+
+    def test_add_item_to_archived_shopcart(self):
+        """It should bring a shopcart back from the archive to add to its items"""
+        shopcart = Shopcart(customer_id=1)
+        shopcart.create()
+        item = ItemFactory(shopcart=shopcart, count=1)
+        item.create()
+        shopcart_id, data = shopcart.id, item.serialize()
+        self._make_idle(shopcart)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        self.assertIsNone(Shopcart.count_items(shopcart_id))
+
+        added = SqlRepository().add_item(shopcart_id, dict(data, count=2), 10)
+        self.assertEqual((added.id, added.count), (data["id"], 3))
+        self.assertEqual(Shopcart.count_items(shopcart_id), 1)
+        self.assertIsNone(SqlRepository().add_item(9999, data, 10))
+
+    def test_archived_ids_are_not_reused(self):
+        """It should not give a new shopcart the id of an archived one"""
+        shopcart = Shopcart(customer_id=1)
+        shopcart.create()
+        shopcart_id = shopcart.id
+        self._make_idle(shopcart)
+        archive_inactive(datetime.utcnow() - timedelta(days=90))
+        new_shopcart = Shopcart(customer_id=2)
+        new_shopcart.create()
+        self.assertGreater(new_shopcart.id, shopcart_id)
+
+    def _assert_document(self, shopcart_id):
+        db.session.expire_all()
+        self.assertEqual(json.loads(find_document(shopcart_id)), Shopcart.find(shopcart_id).serialize())
+
+    def test_documents_follow_writes(self):
+        """It should rewrite the document of a shopcart on every write while documents are on"""
+        with patch.object(Shopcart, "DOCUMENTS", True):
+            shopcart = Shopcart(customer_id=1)
+            shopcart.items.append(ItemFactory(shopcart=None, product_id=1))
+            shopcart.create()
+            shopcart_id = shopcart.id
+            self._assert_document(shopcart_id)
+            item = ItemFactory(shopcart=shopcart, product_id=2)
+            item.create()
+            self._assert_document(shopcart_id)
+            item.count += 1
+            item.update()
+            self._assert_document(shopcart_id)
+            Item.add_counts({(shopcart_id, 2): 3})
+            self._assert_document(shopcart_id)
+            Item.reprice(2, 9.5)
+            self._assert_document(shopcart_id)
+            shopcart.customer_id = 7
+            shopcart.update()
+            self._assert_document(shopcart_id)
+            item.delete()
+            self._assert_document(shopcart_id)
+            Item.delete_all_by_shopcart(shopcart_id)
+            self._assert_document(shopcart_id)
+            self.assertEqual(json.loads(find_document(shopcart_id))["items"], [])
+        self.assertIsNone(find_document(9999))
+
+    def test_rollback_forgets_changed_documents(self):
+        """It should not rewrite the documents of shopcarts changed by a rolled back transaction"""
+        with patch.object(Shopcart, "DOCUMENTS", True):
+            shopcart = Shopcart(customer_id=1)
+            shopcart.create()
+            shopcart.customer_id = 2
+            db.session.flush()
+            self.assertEqual(db.session.info["changed_documents"], {shopcart.id})
+            db.session.rollback()
+            self.assertNotIn("changed_documents", db.session.info)
+
+    def test_build_documents(self):
+        """It should write the missing documents of shopcarts stored while documents were off"""
+        shopcarts = [Shopcart(customer_id=customer_id) for customer_id in range(3)]
+        for shopcart in shopcarts:
+            shopcart.create()
+            ItemFactory(shopcart=shopcart).create()
+        ids = [shopcart.id for shopcart in shopcarts]
+        self.assertEqual([find_document(by_id) for by_id in ids], [None] * 3)
+        self.assertEqual(build_documents(chunk_size=2), 3)
+        for by_id in ids:
+            self._assert_document(by_id)
+        self.assertEqual(build_documents(), 0)
+
+    def test_partitioned_item_table(self):
+        """It should declare item hash partitioned by shopcart_id on PostgreSQL"""
+        ddl = str(CreateTable(partitioned_item_table()).compile(dialect=postgresql.dialect()))
+        self.assertIn("id SERIAL NOT NULL", ddl)
+        self.assertIn("PRIMARY KEY (id, shopcart_id)", ddl)
+        self.assertIn("PARTITION BY HASH (shopcart_id)", ddl)
+        self.assertIn("REFERENCES shopcart (id)", ddl)
+        self.assertEqual(
+            item_partition_statements(2)[1],
+            "CREATE TABLE IF NOT EXISTS item_p1 PARTITION OF item FOR VALUES WITH (MODULUS 2, REMAINDER 1)",
+        )
+        # the model still maps the id alone
+        self.assertEqual([column.name for column in Item.__mapper__.primary_key], ["id"])
+
+    def test_serialize_span_for_large_shopcarts(self):
+        """It should trace serialize() of shopcarts with many items only"""
+        traces = MemoryExporter()
+        shopcart = ShopcartFactory()
+        shopcart.items.extend(ItemFactory.build_batch(3))
+        with patch.object(tracer, "exporters", [traces]), patch.object(Shopcart, "TRACE_MIN_ITEMS", 3):
+            started = tracer.start_trace("test")
+            shopcart.serialize()
+            shopcart.items.pop()
+            shopcart.serialize()
+            tracer.end_trace(started)
+        self.assertEqual([span["name"] for span in traces.traces()], ["Shopcart.serialize", "test"])
+        self.assertEqual(traces.traces()[0]["attributes"]["items"], 3)
+
     def test_deserialize_a_shopcart(self):
         """It should Deserialize an shopcart"""
         shopcart = ShopcartFactory()
@@ -175,7 +400,7 @@ class TestShopcartModel(unittest.TestCase):
 ######################################################################
 #  I T E M   M O D E L   T E S T   C A S E S
 ######################################################################
-class TestItemModel(unittest.TestCase):
+class TestItemModel(unittest.TestCase, RollbackMixin):
     """ Test Cases for Item Model """
 
     @classmethod
@@ -194,9 +419,7 @@ class TestItemModel(unittest.TestCase):
 
     def setUp(self):
         """ This runs before each test """
-        db.session.query(Item).delete() 
-        db.session.query(Shopcart).delete()# clean up the last tests
-        db.session.commit()
+        self.start_test_transaction()
 
     def tearDown(self):
         """ This runs after each test """
@@ -275,6 +498,58 @@ class TestItemModel(unittest.TestCase):
         self.assertEqual(item.price, 4.5)
         
     
+    def test_add_counts(self):
+        """It should add buffered counts to many items at once"""
+        item1 = ItemFactory(count=1, product_id=1)
+        item1.create()
+        item2 = ItemFactory(count=2, product_id=2)
+        item2.create()
+        Item.add_counts({(item1.shopcart_id, 1): 4, (item2.shopcart_id, 2): 1, (9999, 1): 7})
+        db.session.expire_all()
+        self.assertEqual(Item.find(item1.id).count, 5)
+        self.assertEqual(Item.find(item2.id).count, 3)
+        # a client holding the count read before must not overwrite the increment
+        self.assertEqual(Item.find(item1.id).version, 2)
+
+    def test_update_stale_version(self):
+        """It should refuse to update a record another request changed after it was read"""
+        item = ItemFactory()
+        item.create()
+        self.assertEqual((item.version, item.shopcart.version), (1, 1))
+        item.count += 1
+        item.update()
+        self.assertEqual(item.version, 2)
+        item.check_version({"version": 2})
+        self.assertRaises(VersionConflictError, item.check_version, {"version": 1})
+        self.assertRaises(VersionRequiredError, item.check_version, {"version": None})
+
+        # another request commits between this one's read and its write
+        self.commit_between_read_and_write(
+            item, update(Item.__table__).where(Item.id == item.id).values(version=Item.version + 1)
+        )
+        item.count += 1
+        with self.assertRaises(VersionConflictError):
+            item.update()
+        self.assertEqual(Item.find(item.id).version, 3)
+
+        shopcart = Shopcart.find(item.shopcart_id)
+        self.commit_between_read_and_write(
+            shopcart, update(Shopcart.__table__).where(Shopcart.id == shopcart.id).values(version=5)
+        )
+        shopcart.customer_id += 1
+        self.assertRaises(VersionConflictError, shopcart.update)
+
+    @staticmethod
+    def commit_between_read_and_write(record, statement):
+        """Commits statement as another request would, after record was read and before it is written"""
+        # the record keeps the state it was read with while it is detached
+        db.session.refresh(record)
+        db.session.expunge(record)
+        db.session.commit()
+        db.session.execute(statement)
+        db.session.commit()
+        db.session.add(record)
+
     def test_delete_item(self):
         """It should delete an item"""
         items = Item.all()
@@ -311,6 +586,40 @@ class TestItemModel(unittest.TestCase):
         self.assertEqual(len(items), 5)
         for t in items:
             self.assertEqual(t.shopcart_id, shopcart2.id)
+
+    def test_sync_stamp_per_transaction(self):
+        """It should stamp every item write of a transaction with one sync version"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        items = ItemFactory.create_batch(2, shopcart=shopcart)
+        for item in items:
+            item.id = None
+        db.session.add_all(items)
+        db.session.commit()
+        self.assertEqual(items[0].sync_version, items[1].sync_version)
+        watermark = Item.sync_watermark(shopcart.id)
+        self.assertEqual(watermark, items[0].sync_version)
+
+        items[0].count += 1
+        items[0].update()
+        self.assertGreater(items[0].sync_version, watermark)
+        self.assertEqual(Item.changed_since(shopcart.id, 0, watermark), [items[1]])
+
+    def test_remove_old_tombstones(self):
+        """It should delete only the tombstones older than the retention"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        for item in ItemFactory.create_batch(2, shopcart=shopcart):
+            item.create()
+        Item.delete_all_by_shopcart(shopcart.id)
+        tombstones = ItemTombstone.query.all()
+        self.assertEqual(len(tombstones), 2)
+        tombstones[0].deleted_at = datetime.utcnow() - timedelta(days=2)
+        db.session.commit()
+
+        self.assertEqual(ItemTombstone.remove_older_than(86400), 1)
+        self.assertEqual(ItemTombstone.deleted_since(shopcart.id, 0, Item.sync_watermark(shopcart.id)),
+                         [tombstones[1].item_id])
   
     def test_list_all_items(self):
         """It should List all items in the database"""
@@ -351,7 +660,213 @@ class TestItemModel(unittest.TestCase):
         item = Item()
         self.assertRaises(DataValidationError, item.deserialize, {})
 
+    def test_deserialize_item_lists_every_error(self):
+        """It should report every bad field of an Item at once"""
+        item = Item()
+        with self.assertRaises(DataValidationError) as context:
+            item.deserialize({"shopcart_id": 1, "product_id": "7", "name": None, "price": -1})
+        self.assertEqual(
+            context.exception.errors,
+            ["product_id: must be an integer", "price: must be at least 0", "count: is required"],
+        )
+
     def test_deserialize_address_type_error(self):
         """It should not Deserialize an address with a TypeError"""
         item = Item()
         self.assertRaises(DataValidationError, item.deserialize, [])
+
+
+######################################################################
+#  S H A R D E D   M O D E L   T E S T   C A S E S
+######################################################################
+class TestShardedModels(unittest.TestCase):
+    """ Test Cases for Shopcarts spread over several shards """
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["SHARD_DATABASE_URIS"] = ["sqlite://", "sqlite://", "sqlite://"]
+        app.logger.setLevel(logging.CRITICAL)
+        Shopcart.init_db(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """ This runs once after the entire test suite """
+        app.config["SHARD_DATABASE_URIS"] = []
+        Shopcart.init_db(app)
+
+    def setUp(self):
+        """ This runs before each test """
+        for session in shards.sessions():
+            session.query(Item).delete()
+            session.query(Shopcart).delete()
+            session.query(CartChange).delete()
+            session.execute(item_archive.delete())
+            session.execute(shopcart_archive.delete())
+            session.commit()
+
+    def tearDown(self):
+        """ This runs after each test """
+        shards.remove()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+    def test_shard_is_stable(self):
+        """It should always place a customer on the same shard"""
+        self.assertTrue(shards.enabled)
+        self.assertEqual(shards.count, 3)
+        for customer_id in range(50):
+            self.assertEqual(shards.shard_for_customer(customer_id), shards.shard_for_customer(customer_id))
+            self.assertIn(shards.shard_for_customer(customer_id), range(3))
+
+    def test_create_on_customer_shard(self):
+        """It should create a shopcart and its items on the customer's shard"""
+        shopcart = Shopcart(customer_id=42)
+        shopcart.items.append(ItemFactory(shopcart=None))
+        shopcart.create()
+        shard = shards.shard_for_customer(42)
+        self.assertEqual(shards.shard_for_id(shopcart.id), shard)
+        self.assertEqual(shards.shard_for_id(shopcart.items[0].id), shard)
+        for other, session in enumerate(shards.sessions()):
+            self.assertEqual(session.query(Shopcart).count(), 1 if other == shard else 0)
+
+    def test_ids_from_shard_range(self):
+        """It should give every shopcart and item, however it is written, an id of its shard's range"""
+        for customer_id in range(6):
+            shopcart = Shopcart(customer_id=customer_id)
+            shopcart.create()
+            shard = shards.shard_for_customer(customer_id)
+            self.assertEqual(shards.shard_for_id(shopcart.id), shard)
+            # items added by an update skip create() and get their id from the shard's database
+            shopcart.deserialize(
+                {"id": shopcart.id, "customer_id": customer_id, "items": [ItemFactory(shopcart=None).serialize()]}
+            )
+            shopcart.update()
+            self.assertEqual(shards.shard_for_id(shopcart.items[0].id), shard)
+            self.assertEqual(Item.find(shopcart.items[0].id).shopcart_id, shopcart.id)
+
+    def test_find_on_shard(self):
+        """It should find shopcarts and items by id and by customer id"""
+        shopcart = Shopcart(customer_id=7)
+        shopcart.create()
+        item = ItemFactory(shopcart=shopcart)
+        item.create()
+        self.assertEqual(Shopcart.find(shopcart.id).customer_id, 7)
+        self.assertEqual(Item.find(item.id).shopcart_id, shopcart.id)
+        self.assertEqual(Shopcart.find_by_customer_id(7)[0].id, shopcart.id)
+        found = Item.find_by_shopcart_and_product(shopcart.id, item.product_id)
+        self.assertEqual(found.id, item.id)
+
+    def test_all_gathers_every_shard(self):
+        """It should list the shopcarts of every shard"""
+        for customer_id in range(20):
+            Shopcart(customer_id=customer_id).create()
+        shopcarts = Shopcart.all()
+        self.assertEqual(len(shopcarts), 20)
+        self.assertEqual(len({shards.shard_for_id(s.id) for s in shopcarts}), 3)
+        self.assertEqual(len({s.id for s in shopcarts}), 20)
+
+    def test_find_many_on_shards(self):
+        """It should Find many shopcarts spread over several shards"""
+        ids = []
+        for customer_id in range(10):
+            shopcart = Shopcart(customer_id=customer_id)
+            shopcart.create()
+            ids.append(shopcart.id)
+        found = Shopcart.find_many(list(reversed(ids)))
+        self.assertEqual([s.id for s in found], list(reversed(ids)))
+
+    def test_changes_on_shards(self):
+        """It should record changes on the shard of the shopcart"""
+        for customer_id in range(6):
+            Shopcart(customer_id=customer_id).create()
+        changes = CartChange.after([0, 0, 0], 100)
+        self.assertEqual(len(changes), 6)
+        self.assertTrue(all(change["op"] == "create" for _, change in changes))
+        cursor = changes[-1][0]
+        self.assertEqual(CartChange.after(cursor, 100), [])
+
+    def test_add_counts_partial_failure(self):
+        """It should report the counts of the shards that failed after others were committed"""
+        items = []
+        for customer_id in range(6):
+            shopcart = Shopcart(customer_id=customer_id)
+            shopcart.create()
+            item = ItemFactory(shopcart=shopcart, product_id=1, count=1)
+            item.create()
+            items.append(item)
+        deltas = {(item.shopcart_id, 1): 2 for item in items}
+        add_counts = Item._add_counts  # pylint: disable=protected-access
+        calls = []
+
+        def fail_second_shard(session, statement, params):
+            calls.append(params)
+            if len(calls) == 2:
+                raise OperationalError("UPDATE", {}, None)
+            add_counts(session, statement, params)
+
+        with patch.object(Item, "_add_counts", side_effect=fail_second_shard):
+            with self.assertRaises(PartialFlushError) as raised:
+                Item.add_counts(deltas)
+        committed = {(param["s_id"], param["p_id"]) for param in calls[0]}
+        self.assertEqual(set(raised.exception.remaining), set(deltas) - committed)
+        for item in items:
+            expected = 3 if (item.shopcart_id, 1) in committed else 1
+            self.assertEqual(Item.find(item.id).count, expected)
+
+    def test_changes_in_commit_order(self):
+        """It should page changes by transaction and seq, not by seq alone"""
+        session = shards.session(0)
+        # the transaction with the lower id wrote its change last
+        session.add_all([
+            CartChange(seq=1, txid=20, op="create", type="shopcart", record_id=1, shopcart_id=1),
+            CartChange(seq=2, txid=10, op="create", type="shopcart", record_id=2, shopcart_id=2),
+        ])
+        session.commit()
+        changes = CartChange.after([0, 0, 0], 1)
+        self.assertEqual([change["seq"] for _, change in changes], [2])
+        self.assertEqual(changes[-1][0], [(10, 2), 0, 0])
+        changes = CartChange.after(changes[-1][0], 100)
+        self.assertEqual([change["seq"] for _, change in changes], [1])
+        self.assertEqual(CartChange.after(changes[-1][0], 100), [])
+
+    def test_changes_held_back_on_postgresql(self):
+        """It should only read the changes of transactions older than the oldest one running"""
+        statement = CartChange.since_statement((10, 2), 100, "postgresql")
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn("cart_change.txid < txid_snapshot_xmin(txid_current_snapshot())", sql)
+        self.assertIn("ORDER BY cart_change.txid, cart_change.seq", sql)
+        sql = str(CartChange.since_statement(5, 100, "sqlite").compile())
+        self.assertNotIn("txid_snapshot_xmin", sql)
+
+    def test_delete_on_shard(self):
+        """It should delete shopcarts and items from their shard"""
+        shopcart = Shopcart(customer_id=9)
+        shopcart.create()
+        for item in ItemFactory.create_batch(3, shopcart=shopcart):
+            item.create()
+        Item.delete_all_by_shopcart(shopcart.id)
+        self.assertEqual(Shopcart.find(shopcart.id).items, [])
+        Shopcart.find(shopcart.id).delete()
+        self.assertIsNone(Shopcart.find(shopcart.id))
+
+
+    def test_archive_on_shards(self):
+        """It should archive and restore shopcarts on their own shard"""
+        shopcarts = [Shopcart(customer_id=customer_id) for customer_id in range(6)]
+        for shopcart in shopcarts:
+            shopcart.create()
+            ItemFactory(shopcart=shopcart).create()
+        ids = [shopcart.id for shopcart in shopcarts]
+        self.assertEqual(archive_inactive(datetime.utcnow() + timedelta(seconds=1), chunk_size=4), 6)
+        self.assertEqual(Shopcart.all(), [])
+        replacement = Shopcart(customer_id=0)
+        replacement.create()
+        self.assertNotIn(replacement.id, ids)
+        found = Shopcart.find_many(ids)
+        self.assertEqual([shopcart.id for shopcart in found], ids)
+        self.assertTrue(all(len(shopcart.items) == 1 for shopcart in found))
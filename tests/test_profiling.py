@@ -0,0 +1,114 @@
+"""
+Test cases for the Request Profiling hooks
+
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from service.common import profiling, status
+
+
+def make_app(mode, directory, ring_size=2, secret="let-me-in"):
+    """Creates a small Flask app with one route that runs SQL"""
+    app = Flask("profiling-test")
+    app.config["PROFILING"] = mode
+    app.config["PROFILE_SECRET"] = secret
+    app.config["PROFILE_DIR"] = directory
+    app.config["PROFILE_RING_SIZE"] = ring_size
+    engine = create_engine("sqlite://")
+
+    @app.route("/query")
+    def query():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+        return {"ok": True}, status.HTTP_200_OK
+
+    @app.route("/broken")
+    def broken():
+        with engine.connect() as conn:
+            try:
+                conn.execute(text("SELECT * FROM missing"))
+            except OperationalError:
+                pass
+            conn.execute(text("SELECT 3"))
+            return {"pending": len(conn.info.get("profile_started", []))}, status.HTTP_200_OK
+
+    ring = profiling.init_profiling(app, [engine])
+    return app, ring
+
+
+######################################################################
+#  P R O F I L I N G   T E S T   C A S E S
+######################################################################
+class TestProfiling(TestCase):
+    """ Test Cases for Request Profiling """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.mkdtemp()
+
+    def test_off_registers_nothing(self):
+        """It should not register any hook when profiling is off"""
+        app, ring = make_app("off", self.directory)
+        self.assertIsNone(ring)
+        self.assertEqual(app.before_request_funcs, {})
+        self.assertEqual(app.after_request_funcs, {})
+        resp = app.test_client().get("/query", headers={profiling.PROFILE_HEADER: "1"})
+        self.assertNotIn(profiling.PROFILE_ID_HEADER, resp.headers)
+
+    def test_header_mode_profiles_marked_requests(self):
+        """It should only profile requests sent with the X-Profile header"""
+        app, ring = make_app("header", self.directory)
+        client = app.test_client()
+        resp = client.get("/query")
+        self.assertNotIn(profiling.PROFILE_ID_HEADER, resp.headers)
+        resp = client.get("/query", headers={profiling.PROFILE_HEADER: "1"})
+        self.assertNotIn(profiling.PROFILE_ID_HEADER, resp.headers)
+        resp = client.get("/query", headers={profiling.PROFILE_HEADER: "let-me-in"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        report = ring.read(resp.headers[profiling.PROFILE_ID_HEADER])
+        self.assertEqual(report["path"], "/query")
+        self.assertEqual(report["sql_count"], 2)
+        self.assertEqual(report["sql"][0]["statement"], "SELECT 1")
+        self.assertIn("cumulative", report["python"])
+
+    def test_failed_statement(self):
+        """It should drop the start time of a failed statement and keep timing the next ones"""
+        app, ring = make_app("all", self.directory)
+        resp = app.test_client().get("/broken")
+        self.assertEqual(resp.get_json()["pending"], 0)
+        report = ring.read(resp.headers[profiling.PROFILE_ID_HEADER])
+        self.assertEqual([sql["statement"] for sql in report["sql"]], ["SELECT 3"])
+
+    def test_header_mode_needs_secret(self):
+        """It should not profile anything in header mode without a secret"""
+        app, ring = make_app("header", self.directory, secret="")
+        self.assertIsNone(ring)
+        resp = app.test_client().get("/query", headers={profiling.PROFILE_HEADER: ""})
+        self.assertNotIn(profiling.PROFILE_ID_HEADER, resp.headers)
+
+    def test_ring_is_bounded(self):
+        """It should drop the oldest reports once the ring is full"""
+        app, ring = make_app("all", self.directory, ring_size=2)
+        client = app.test_client()
+        ids = [client.get("/query").headers[profiling.PROFILE_ID_HEADER] for _ in range(3)]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        with self.assertRaises(FileNotFoundError):
+            ring.read(ids[0])
+        self.assertEqual(ring.read(ids[2])["path"], "/query")
+
+    def test_ring_is_bounded_across_workers(self):
+        """It should keep the ring bounded when recycled workers write to the same directory"""
+        for _ in range(3):
+            # a worker started by max_requests gets a new ring and pid
+            ring = profiling.ProfileRing(self.directory, 2)
+            with patch("os.getpid", return_value=len(os.listdir(self.directory)) + 100):
+                ring.write({"path": "/query"})
+                ring.write({"path": "/query"})
+        self.assertEqual(len(os.listdir(self.directory)), 2)
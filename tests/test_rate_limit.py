@@ -0,0 +1,142 @@
+"""
+Test cases for the Rate Limiter
+
+"""
+from unittest import TestCase
+from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+from service.common import status
+from service.common.rate_limit import MemoryBucketStore, RateLimiter, parse_limits
+from tests.clock import FakeClock
+
+
+def make_app(limiter, enabled=True, trusted_proxies=0):
+    """Creates a small Flask app with one limited route"""
+    app = Flask("rate-limit-test")
+    app.config["RATE_LIMITING"] = enabled
+    app.config["TRUSTED_PROXIES"] = trusted_proxies
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+
+    @app.route("/ping")
+    @limiter.limit(rate=1, burst=2)
+    def ping():
+        return {"ok": True}, status.HTTP_200_OK
+
+    return app
+
+
+######################################################################
+#  R A T E   L I M I T   T E S T   C A S E S
+######################################################################
+class TestMemoryBucketStore(TestCase):
+    """ Test Cases for the in-process token buckets """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = MemoryBucketStore(clock=self.clock)
+
+    def test_burst_then_wait(self):
+        """It should allow a burst and then one request per interval"""
+        self.assertEqual(self.store.take("a", 2, 3), 0)
+        self.assertEqual(self.store.take("a", 2, 3), 0)
+        self.assertEqual(self.store.take("a", 2, 3), 0)
+        self.assertAlmostEqual(self.store.take("a", 2, 3), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(self.store.take("a", 2, 3), 0)
+        self.assertAlmostEqual(self.store.take("a", 2, 3), 0.5)
+
+    def test_keys_are_separate(self):
+        """It should keep a bucket per key"""
+        self.assertEqual(self.store.take("a", 1, 1), 0)
+        self.assertGreater(self.store.take("a", 1, 1), 0)
+        self.assertEqual(self.store.take("b", 1, 1), 0)
+
+    def test_bucket_refills(self):
+        """It should refill a bucket up to its burst and no further"""
+        for _ in range(2):
+            self.store.take("a", 1, 2)
+        self.clock.now += 60
+        self.assertEqual(self.store.take("a", 1, 2), 0)
+        self.assertEqual(self.store.take("a", 1, 2), 0)
+        self.assertGreater(self.store.take("a", 1, 2), 0)
+
+    def test_forgets_full_buckets(self):
+        """It should drop buckets that are full again and keep at most max_keys"""
+        store = MemoryBucketStore(clock=self.clock, max_keys=3)
+        for key in "abcd":
+            store.take(key, 1, 5)
+        self.assertEqual(list(store._arrivals), ["b", "c", "d"])  # pylint: disable=protected-access
+        self.clock.now += 60
+        store.take("e", 1, 5)
+        self.assertEqual(list(store._arrivals), ["e"])  # pylint: disable=protected-access
+
+
+class TestRateLimiter(TestCase):
+    """ Test Cases for the route decorator """
+
+    def test_limits_per_client(self):
+        """It should answer 429 with Retry-After once a client used its burst"""
+        limiter = RateLimiter(MemoryBucketStore(clock=FakeClock()))
+        client = make_app(limiter, trusted_proxies=1).test_client()
+        for _ in range(2):
+            self.assertEqual(client.get("/ping", headers={"X-Client-Id": "a"}).status_code, status.HTTP_200_OK)
+        resp = client.get("/ping", headers={"X-Client-Id": "a"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        resp = client.get("/ping", headers={"X-Client-Id": "b"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(limiter.stats(), {"ping": {"allowed": 3, "limited": 1}})
+
+    def test_client_id_needs_trusted_proxy(self):
+        """It should key on the address, ignoring client ids that did not come through a trusted proxy"""
+        limiter = RateLimiter(MemoryBucketStore(clock=FakeClock()))
+        client = make_app(limiter).test_client()
+        for client_id in ("a", "b"):
+            self.assertEqual(client.get("/ping", headers={"X-Client-Id": client_id}).status_code, status.HTTP_200_OK)
+        resp = client.get("/ping", headers={"X-Client-Id": "c"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # behind a proxy the address is the one the proxy saw, not one the client added
+        client = make_app(RateLimiter(MemoryBucketStore(clock=FakeClock())), trusted_proxies=1).test_client()
+        for _ in range(2):
+            resp = client.get("/ping", headers={"X-Forwarded-For": "spoofed, 10.0.0.1"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = client.get("/ping", headers={"X-Forwarded-For": "other, 10.0.0.1"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        resp = client.get("/ping", headers={"X-Forwarded-For": "10.0.0.2"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_shared_store(self):
+        """It should share buckets between limiters that use the same store"""
+        store = MemoryBucketStore(clock=FakeClock())
+        first = make_app(RateLimiter(store)).test_client()
+        second = make_app(RateLimiter(store)).test_client()
+        self.assertEqual(first.get("/ping").status_code, status.HTTP_200_OK)
+        self.assertEqual(second.get("/ping").status_code, status.HTTP_200_OK)
+        self.assertEqual(first.get("/ping").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(second.get("/ping").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_overrides(self):
+        """It should use the limits configured for a route over its defaults"""
+        limiter = RateLimiter(MemoryBucketStore(clock=FakeClock()))
+        limiter.overrides = {"ping": (1, 1)}
+        client = make_app(limiter).test_client()
+        self.assertEqual(client.get("/ping").status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get("/ping").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_disabled(self):
+        """It should not limit anything when RATE_LIMITING is off"""
+        limiter = RateLimiter(MemoryBucketStore(clock=FakeClock()))
+        client = make_app(limiter, enabled=False).test_client()
+        for _ in range(5):
+            self.assertEqual(client.get("/ping").status_code, status.HTTP_200_OK)
+        self.assertEqual(limiter.stats(), {})
+
+    def test_parse_limits(self):
+        """It should parse endpoint=rate:burst lists"""
+        self.assertEqual(parse_limits(""), {})
+        self.assertEqual(
+            parse_limits("create_item=5:10, list_all_shopcarts=0.5:1"),
+            {"create_item": (5.0, 10), "list_all_shopcarts": (0.5, 1)},
+        )
@@ -0,0 +1,85 @@
+"""
+Test cases for Single Flight read coalescing
+
+"""
+import threading
+import time
+from unittest import TestCase
+from service.common.singleflight import SingleFlight
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """ Test Cases for SingleFlight """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.flight = SingleFlight()
+
+    def _wait_for_waiters(self, key, count):
+        """Waits until count callers joined the read of key"""
+        deadline = time.monotonic() + 5
+        while self.flight.waiting(key) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(self.flight.waiting(key), count)
+
+    def test_runs_read(self):
+        """It should run a read nobody else is running"""
+        self.assertEqual(self.flight.do("a", lambda: 1), 1)
+        self.assertEqual(self.flight.do("a", lambda: 2), 2)
+        self.assertEqual(self.flight.stats(), {"executed": 2, "coalesced": 0, "in_flight": 0})
+
+    def test_coalesces_concurrent_reads(self):
+        """It should share one read between concurrent callers of a key"""
+        release = threading.Event()
+        calls = []
+
+        def read():
+            calls.append(1)
+            release.wait(5)
+            return {"id": 1}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.flight.do("cart", read))) for _ in range(5)]
+        threads[0].start()
+        while not calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        self._wait_for_waiters("cart", 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"id": 1}] * 5)
+        self.assertEqual(self.flight.stats()["coalesced"], 4)
+
+    def test_shares_errors(self):
+        """It should raise the error of a shared read in every caller"""
+        release = threading.Event()
+        errors = []
+
+        def read():
+            release.wait(5)
+            raise ValueError("database down")
+
+        def call():
+            try:
+                self.flight.do("cart", read)
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        threads[0].start()
+        while not self.flight.stats()["in_flight"]:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        self._wait_for_waiters("cart", 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.flight.stats()["in_flight"], 0)
@@ -0,0 +1,103 @@
+"""
+Test cases for the Slow Query Log
+
+"""
+from unittest import TestCase
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from service.common import slow_queries, status
+
+
+def make_app(**config):
+    """Creates a small Flask app with one route that runs SQL"""
+    app = Flask("slow-query-test")
+    app.config.update(
+        SLOW_QUERY_LOG=True, SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_RATE=0, SLOW_QUERY_RING_SIZE=2
+    )
+    app.config.update(config)
+    engine = create_engine("sqlite://")
+
+    @app.route("/query/<int:number>")
+    def query(number):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT :number"), {"number": number})
+        return {"ok": True}, status.HTTP_200_OK
+
+    log = slow_queries.init_slow_query_log(app, [engine])
+    return app, engine, log
+
+
+######################################################################
+#  S L O W   Q U E R Y   T E S T   C A S E S
+######################################################################
+class TestSlowQueryLog(TestCase):
+    """ Test Cases for the Slow Query Log """
+
+    def test_off_watches_nothing(self):
+        """It should not time any statement when the log is off"""
+        app, _, log = make_app(SLOW_QUERY_LOG=False)
+        app.test_client().get("/query/1")
+        self.assertEqual(log.recent(), [])
+
+    def test_under_threshold(self):
+        """It should not keep statements faster than the threshold"""
+        app, _, log = make_app(SLOW_QUERY_THRESHOLD_MS=60000)
+        app.test_client().get("/query/1")
+        self.assertEqual(log.recent(), [])
+
+    def test_records_slow_statements(self):
+        """It should keep slow statements with their parameters and route, newest first"""
+        app, _, log = make_app()
+        with self.assertLogs("flask.app", "WARNING") as logs:
+            app.test_client().get("/query/7")
+        entry = log.recent()[0]
+        self.assertEqual(entry["statement"], "SELECT ?")
+        self.assertIn("7", entry["parameters"])
+        self.assertEqual(entry["origin"], "GET /query/<int:number>")
+        self.assertNotIn("plan", entry)
+        self.assertIn("Slow query", logs.output[0])
+
+        for number in (8, 9):
+            app.test_client().get(f"/query/{number}")
+        self.assertEqual([e["parameters"] for e in log.recent()], ["(9,)", "(8,)"])
+
+    def test_failed_statement(self):
+        """It should drop the start time of a failed statement"""
+        _, engine, log = make_app()
+        with engine.connect() as conn:
+            with self.assertRaises(OperationalError):
+                conn.execute(text("SELECT * FROM missing"))
+            self.assertEqual(conn.info["slow_query_started"], [])
+            conn.execute(text("SELECT 3"))
+        self.assertEqual(log.recent()[0]["statement"], "SELECT 3")
+
+    def test_outside_requests(self):
+        """It should record statements sent outside of a request"""
+        _, engine, log = make_app()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        self.assertEqual(log.recent()[0]["origin"], "-")
+
+    def test_explains_sampled_selects(self):
+        """It should keep the plan of sampled SELECTs without logging the EXPLAIN"""
+        app, engine, log = make_app(SLOW_QUERY_EXPLAIN_RATE=1)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE item (id INTEGER PRIMARY KEY, product_id INTEGER)"))
+        log.clear()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT id FROM item WHERE product_id = :product"), {"product": 3})
+        entries = log.recent()
+        self.assertEqual(len(entries), 1)
+        self.assertIn("SCAN", " ".join(entries[0]["plan"]))
+        app.test_client().get("/query/1")
+        self.assertTrue(log.recent()[0]["plan"])
+
+    def test_explain_failure(self):
+        """It should keep the error when a statement cannot be explained"""
+        _, engine, log = make_app(SLOW_QUERY_EXPLAIN_RATE=1)
+        with engine.connect() as conn:
+            cursor = conn.connection.dbapi_connection.cursor()
+            # pylint: disable=protected-access
+            plan = log._explain(conn, cursor, "SELECT * FROM missing", ())
+        self.assertTrue(plan[0].startswith("EXPLAIN failed"))
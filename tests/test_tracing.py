@@ -0,0 +1,141 @@
+"""
+Test cases for Tracing
+
+"""
+import json
+import os
+import tempfile
+from unittest import TestCase
+from flask import Flask
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from service.common import status, tracing
+from service.common.tracing import format_traceparent, parse_traceparent, tracer
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+def make_app(**config):
+    """Creates a small Flask app with routes that run SQL"""
+    app = Flask("tracing-test")
+    app.config.update(TRACING=True, TRACING_SAMPLE_RATE=1.0, TRACING_RING_SIZE=100, TRACING_FILE="")
+    app.config.update(config)
+    engine = create_engine("sqlite://")
+
+    @app.route("/query")
+    def query():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            with tracer.span("work", step=1):
+                conn.execute(text("SELECT 2"))
+        return {"ok": True}, status.HTTP_200_OK
+
+    @app.route("/broken")
+    def broken():
+        with engine.connect() as conn:
+            try:
+                conn.execute(text("SELECT * FROM missing"))
+            except OperationalError:
+                pass
+            conn.execute(text("SELECT 3"))
+        return {"ok": True}, status.HTTP_200_OK
+
+    traces = tracing.init_tracing(app, [engine])
+    return app, traces
+
+
+######################################################################
+#  T R A C I N G   T E S T   C A S E S
+######################################################################
+class TestTraceparent(TestCase):
+    """ Test Cases for the W3C traceparent header """
+
+    def test_parse(self):
+        """It should parse valid traceparent headers"""
+        self.assertEqual(parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01"), (TRACE_ID, PARENT_ID, True))
+        self.assertEqual(parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-00"), (TRACE_ID, PARENT_ID, False))
+        # later versions may add fields
+        self.assertEqual(parse_traceparent(f"01-{TRACE_ID}-{PARENT_ID}-01-extra")[0], TRACE_ID)
+
+    def test_parse_invalid(self):
+        """It should ignore invalid traceparent headers"""
+        for header in (
+            None, "", "garbage", f"ff-{TRACE_ID}-{PARENT_ID}-01", f"00-{TRACE_ID}-{PARENT_ID}-01-extra",
+            f"00-{'0' * 32}-{PARENT_ID}-01", f"00-{TRACE_ID}-{'0' * 16}-01", f"00-{TRACE_ID[:-1]}x-{PARENT_ID}-01",
+        ):
+            self.assertIsNone(parse_traceparent(header), header)
+
+    def test_format(self):
+        """It should format a traceparent header"""
+        self.assertEqual(format_traceparent(TRACE_ID, PARENT_ID), f"00-{TRACE_ID}-{PARENT_ID}-01")
+
+
+class TestTracing(TestCase):
+    """ Test Cases for the request and SQL spans """
+
+    def tearDown(self):
+        tracer.exporters = []
+        tracer.sample_rate = 1.0
+
+    def test_off_registers_nothing(self):
+        """It should not register any hook when tracing is off"""
+        app, traces = make_app(TRACING=False)
+        self.assertIsNone(traces)
+        self.assertEqual(app.before_request_funcs, {})
+        resp = app.test_client().get("/query")
+        self.assertNotIn("traceparent", resp.headers)
+
+    def test_request_and_sql_spans(self):
+        """It should record a request span with the SQL and custom spans under it"""
+        app, traces = make_app()
+        resp = app.test_client().get("/query")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        trace_id, span_id, _ = parse_traceparent(resp.headers["traceparent"])
+        spans = {span["name"]: span for span in traces.traces(trace_id)}
+        self.assertEqual(len(traces.traces(trace_id)), 4)
+        request_span = spans["GET /query"]
+        self.assertEqual(request_span["span_id"], span_id)
+        self.assertIsNone(request_span["parent_id"])
+        self.assertEqual(request_span["attributes"]["http.status_code"], 200)
+        self.assertEqual(spans["work"]["parent_id"], span_id)
+        sql = [span for span in traces.traces(trace_id) if span["name"] == "sql"]
+        self.assertEqual([span["attributes"]["db.statement"] for span in sql], ["SELECT 1", "SELECT 2"])
+        self.assertEqual(sql[0]["parent_id"], span_id)
+        self.assertEqual(sql[1]["parent_id"], spans["work"]["span_id"])
+        self.assertIsNone(tracer.current_span())
+
+    def test_continues_incoming_trace(self):
+        """It should make the request span a child of the caller's span"""
+        app, traces = make_app(TRACING_SAMPLE_RATE=0)
+        resp = app.test_client().get("/query", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+        self.assertTrue(resp.headers["traceparent"].startswith(f"00-{TRACE_ID}-"))
+        request_span = traces.traces(TRACE_ID)[-1]
+        self.assertEqual(request_span["parent_id"], PARENT_ID)
+
+    def test_unsampled(self):
+        """It should not record requests that are not sampled"""
+        app, traces = make_app(TRACING_SAMPLE_RATE=0)
+        resp = app.test_client().get("/query")
+        self.assertNotIn("traceparent", resp.headers)
+        resp = app.test_client().get("/query", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+        self.assertNotIn("traceparent", resp.headers)
+        self.assertEqual(traces.traces(), [])
+
+    def test_failed_statement(self):
+        """It should end the span of a failed statement with its error"""
+        app, traces = make_app()
+        trace_id = parse_traceparent(app.test_client().get("/broken").headers["traceparent"])[0]
+        sql = [span for span in traces.traces(trace_id) if span["name"] == "sql"]
+        self.assertEqual(len(sql), 2)
+        self.assertIn("no such table", sql[0]["attributes"]["error"])
+        self.assertEqual(sql[1]["attributes"]["db.statement"], "SELECT 3")
+
+    def test_file_exporter(self):
+        """It should append the spans to TRACING_FILE as JSON lines"""
+        path = os.path.join(tempfile.mkdtemp(), "traces", "spans.jsonl")
+        app, _ = make_app(TRACING_FILE=path)
+        app.test_client().get("/query")
+        with open(path, encoding="utf-8") as trace_file:
+            names = [json.loads(line)["name"] for line in trace_file]
+        self.assertEqual(names, ["sql", "sql", "work", "GET /query"])
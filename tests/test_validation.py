@@ -0,0 +1,60 @@
+"""
+Test cases for the compiled Request Validation
+
+"""
+from unittest import TestCase
+from service.common.validation import INTEGER, NUMBER, STRING, Field, ListOf, compile_schema
+
+validate_line = compile_schema({
+    "sku": Field(STRING, max_length=4),
+    "quantity": Field(INTEGER, minimum=1),
+    "note": Field(STRING, required=False, nullable=True),
+})
+validate_order = compile_schema({
+    "total": Field(NUMBER, minimum=0),
+    "lines": ListOf(validate_line, max_items=2),
+})
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(TestCase):
+    """ Test Cases for compiled schemas """
+
+    def test_valid(self):
+        """It should return no errors for a valid body"""
+        self.assertEqual(validate_line({"sku": "a1", "quantity": 2}), [])
+        self.assertEqual(validate_line({"sku": "a1", "quantity": 2, "note": None}), [])
+        self.assertEqual(validate_order({"total": 1.5, "lines": [{"sku": "a", "quantity": 1}]}), [])
+
+    def test_all_errors_at_once(self):
+        """It should report every bad field of a body"""
+        errors = validate_line({"sku": "toolong", "quantity": 0, "note": 3})
+        self.assertEqual(
+            errors,
+            [
+                "sku: must be at most 4 characters",
+                "quantity: must be at least 1",
+                "note: must be a string",
+            ],
+        )
+        self.assertEqual(validate_line({}), ["sku: is required", "quantity: is required"])
+
+    def test_types(self):
+        """It should tell integers, numbers, booleans and nulls apart"""
+        self.assertEqual(validate_line({"sku": None, "quantity": True}), [
+            "sku: must not be null", "quantity: must be an integer"
+        ])
+        self.assertEqual(validate_line({"sku": "a", "quantity": 1.5}), ["quantity: must be an integer"])
+        self.assertEqual(validate_order({"total": "1", "lines": []}), ["total: must be a number"])
+        self.assertEqual(validate_line([]), ["body: must be an object"])
+
+    def test_nested_lists(self):
+        """It should prefix the errors of list entries and bound the list length"""
+        errors = validate_order({"total": 1, "lines": [{"sku": "a", "quantity": 1}, {"quantity": -1}]})
+        self.assertEqual(errors, ["lines[1].sku: is required", "lines[1].quantity: must be at least 1"])
+        errors = validate_order({"total": 1, "lines": [{"sku": "a", "quantity": 1}] * 3})
+        self.assertEqual(errors, ["lines: must hold at most 2 entries"])
+        self.assertEqual(validate_order({"total": 1, "lines": {}}), ["lines: must be a list"])
+        self.assertEqual(validate_order({"total": 1, "lines": [5]}), ["lines[0]: must be an object"])
@@ -0,0 +1,107 @@
+"""
+Test cases for the Write-Behind Buffer
+
+"""
+from unittest import TestCase
+from flask import Flask
+from service.common.write_behind import PartialFlushError, WriteBehindBuffer
+
+
+######################################################################
+#  W R I T E - B E H I N D   T E S T   C A S E S
+######################################################################
+class TestWriteBehindBuffer(TestCase):
+    """ Test Cases for WriteBehindBuffer """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.flushed = []
+        self.buffer = WriteBehindBuffer(self.flushed.append, interval=60)
+        self.buffer.start(Flask("write-behind-test"))
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.buffer.stop()
+
+    def test_accumulates_increments(self):
+        """It should add up the increments of a key until they are flushed"""
+        self.assertEqual(self.buffer.add((1, 2), 1), 1)
+        self.assertEqual(self.buffer.add((1, 2), 3), 4)
+        self.assertEqual(self.buffer.pending((1, 2)), 4)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.flushed, [{(1, 2): 4}])
+        self.assertEqual(self.buffer.pending((1, 2)), 0)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_outstanding_flushes(self):
+        """It should count one flush for waiting increments and one more for those being flushed"""
+        self.assertEqual(self.buffer.outstanding((1, 2)), (0, 0))
+        self.buffer.add((1, 2), 2)
+        self.assertEqual(self.buffer.outstanding((1, 2)), (2, 1))
+        seen = []
+
+        def flush_while_adding(_deltas):
+            self.buffer.add((1, 2), 3)
+            seen.append(self.buffer.outstanding((1, 2)))
+        self.buffer.flush_function = flush_while_adding
+        self.buffer.flush()
+        self.assertEqual(seen, [(5, 2)])
+        self.assertEqual(self.buffer.outstanding((1, 2)), (3, 1))
+
+    def test_keeps_increments_when_flush_fails(self):
+        """It should keep the increments when the flush function fails"""
+        def fail(deltas):
+            raise RuntimeError("database down")
+        self.buffer.flush_function = fail
+        self.buffer.add((1, 2), 5)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer.pending((1, 2)), 5)
+        self.buffer.flush_function = self.flushed.append
+        self.buffer.flush()
+        self.assertEqual(self.flushed, [{(1, 2): 5}])
+
+    def test_keeps_only_unwritten_increments(self):
+        """It should only keep the increments a partly failed flush did not write"""
+        def fail_second_shard(deltas):
+            raise PartialFlushError("shard down", {key: delta for key, delta in deltas.items() if key[0] == 2})
+        self.buffer.flush_function = fail_second_shard
+        self.buffer.add((1, 1), 3)
+        self.buffer.add((2, 1), 4)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.pending((1, 1)), 0)
+        self.assertEqual(self.buffer.pending((2, 1)), 4)
+        self.buffer.flush_function = self.flushed.append
+        self.buffer.flush()
+        self.assertEqual(self.flushed, [{(2, 1): 4}])
+
+    def test_flushes_at_threshold(self):
+        """It should flush as soon as max_pending keys are waiting"""
+        self.buffer.max_pending = 2
+        self.buffer.add((1, 1), 1)
+        self.buffer.add((1, 2), 1)
+        for _ in range(500):
+            if self.flushed:
+                break
+            self.buffer._stop.wait(0.01)  # pylint: disable=protected-access
+        self.assertEqual(self.flushed, [{(1, 1): 1, (1, 2): 1}])
+
+    def test_stop_flushes(self):
+        """It should flush what is buffered when it stops"""
+        self.buffer.add((3, 4), 2)
+        self.buffer.stop()
+        self.assertFalse(self.buffer.running)
+        self.assertEqual(self.flushed, [{(3, 4): 2}])
+
+    def test_after_fork_restarts_thread(self):
+        """It should drop the parent's increments and start a new flush thread after fork"""
+        # a forked child inherits the buffer but not the thread
+        thread = self.buffer._thread  # pylint: disable=protected-access
+        self.buffer._stop.set()  # pylint: disable=protected-access
+        self.buffer._wake.set()  # pylint: disable=protected-access
+        thread.join()
+        self.buffer.add((1, 2), 5)
+        self.buffer.after_fork()
+        self.assertTrue(self.buffer._thread.is_alive())  # pylint: disable=protected-access
+        self.assertEqual(self.buffer.pending((1, 2)), 0)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.flushed, [])